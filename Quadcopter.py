@@ -27,6 +27,12 @@ import select
 import os
 import struct
 import logging
+import mmap
+import fcntl
+import collections
+import zlib
+import bisect
+import marshal
 
 import RPi.GPIO as RPIO
 from RPIO import PWM
@@ -136,6 +142,135 @@ class I2C:
 		return self.misses
 
 
+####################################################################################################
+#
+# Auxiliary sensors hung off the MPU6050's own I2C master.  The MPU6050 polls each one into its
+# EXT_SENS_DATA registers, which follow straight on from the gyro registers, so a longer burst read
+# in readSensorsRaw() collects them with the accelerometer and gyro data, and no extra bus
+# transaction.  Each sensor says where its data is and how long it is, is configured directly while
+# the MPU6050 is in bypass mode, and parses its share of the burst into the raw values exposed in
+# aux_now alongside temp_now.  Only free-running sensors suit this, as the master only reads.
+#
+####################################################################################################
+class AuxSensor:
+
+	def __init__(self, name, address, register, length, fields):
+		self.name = name
+		self.address = address
+		self.register = register
+		self.length = length
+		self.fields = fields
+
+	def setup(self, i2c):
+		pass
+
+	def describe(self, values):
+		return ', '.join(['%s %d' % (field, value) for (field, code), value in zip(self.fields, values)])
+
+####################################################################################################
+#
+# HMC5883L magnetometer: continuous measurement at 75Hz, +/-1.3 gauss.  Its data registers hold X, Z
+# then Y as big endian signed shorts.
+#
+####################################################################################################
+class Hmc5883l(AuxSensor):
+
+	def __init__(self):
+		AuxSensor.__init__(self, "mag", 0x1E, 0x03, 6, [("mx", 'h'), ("mz", 'h'), ("my", 'h')])
+
+	def setup(self, i2c):
+		i2c.write8(0x00, 0x18)
+		i2c.write8(0x01, 0x20)
+		i2c.write8(0x02, 0x00)
+
+	def parse(self, data, offset):
+		values = []
+		for index in range(offset, offset + 6, 2):
+			value = (data[index] << 8) + data[index + 1]
+			if value > 32767:
+				value -= 65536
+			values.append(value)
+		return values[0], values[1], values[2]
+
+	def heading(self, mx, mz, my):
+		#-----------------------------------------------------------------------------------
+		# Magnetic heading in degrees while level; there's no tilt compensation.
+		#-----------------------------------------------------------------------------------
+		return math.degrees(math.atan2(my, mx)) % 360
+
+	def describe(self, values):
+		return "heading %f degrees" % self.heading(*values)
+
+####################################################################################################
+#
+# BMP280 barometer: normal mode, x4 pressure and x1 temperature oversampling.  Its data registers
+# hold 20 bit pressure then temperature, most significant byte first.  The factory compensation
+# coefficients are read once at set up.
+#
+####################################################################################################
+class Bmp280(AuxSensor):
+
+	def __init__(self):
+		AuxSensor.__init__(self, "baro", 0x77, 0xF7, 6, [("pressure", 'i'), ("temperature", 'i')])
+
+	def setup(self, i2c):
+		calibration = struct.pack('24B', *i2c.readList(0x88, 24))
+		self.dig_t = struct.unpack('<Hhh', calibration[0:6])
+		self.dig_p = struct.unpack('<Hhhhhhhhh', calibration[6:24])
+
+		i2c.write8(0xF5, 0x00)
+		i2c.write8(0xF4, 0x2F)
+
+	def parse(self, data, offset):
+		pressure = (data[offset] << 12) + (data[offset + 1] << 4) + (data[offset + 2] >> 4)
+		temperature = (data[offset + 3] << 12) + (data[offset + 4] << 4) + (data[offset + 5] >> 4)
+		return pressure, temperature
+
+	def pressure(self, raw_pressure, raw_temperature):
+		#-----------------------------------------------------------------------------------
+		# Pascals, from the floating point compensation in the BMP280 datasheet
+		#-----------------------------------------------------------------------------------
+		t1, t2, t3 = self.dig_t
+		p1, p2, p3, p4, p5, p6, p7, p8, p9 = self.dig_p
+
+		var1 = (raw_temperature / 16384.0 - t1 / 1024.0) * t2
+		var2 = (raw_temperature / 131072.0 - t1 / 8192.0) ** 2 * t3
+		t_fine = var1 + var2
+
+		var1 = t_fine / 2.0 - 64000.0
+		var2 = var1 * var1 * p6 / 32768.0
+		var2 = var2 + var1 * p5 * 2.0
+		var2 = var2 / 4.0 + p4 * 65536.0
+		var1 = (p3 * var1 * var1 / 524288.0 + p2 * var1) / 524288.0
+		var1 = (1.0 + var1 / 32768.0) * p1
+		if var1 == 0.0:
+			return 0.0
+
+		pressure = 1048576.0 - raw_pressure
+		pressure = (pressure - var2 / 4096.0) * 6250.0 / var1
+		var1 = p9 * pressure * pressure / 2147483648.0
+		var2 = pressure * p8 / 32768.0
+		return pressure + (var1 + var2 + p7) / 16.0
+
+	def altitude(self, raw_pressure, raw_temperature):
+		#-----------------------------------------------------------------------------------
+		# Meters above the standard atmosphere's sea level
+		#-----------------------------------------------------------------------------------
+		return 44330.0 * (1.0 - (self.pressure(raw_pressure, raw_temperature) / 101325.0) ** (1 / 5.255))
+
+	def describe(self, values):
+		return "pressure %fPa, altitude %fm" % (self.pressure(*values), self.altitude(*values))
+
+AUX_SENSORS = {"mag": Hmc5883l, "baro": Bmp280}
+
+#---------------------------------------------------------------------------------------------------
+# The MPU6050's I2C master has 4 slaves, and the burst read of their data after the 14 bytes of
+# accelerometer, temperature and gyro data is capped by the 32 byte SMBus block read
+# (I2C_SMBUS_BLOCK_MAX), which silently truncates anything longer.
+#---------------------------------------------------------------------------------------------------
+AUX_SENSORS_MAX = 4
+AUX_DATA_MAX = 32 - 14
+
 ####################################################################################################
 #
 #  Gyroscope / Accelerometer class for reading position / movement
@@ -261,49 +396,36 @@ class MPU6050 :
 	__SCALE_GYRO = 500.0 * math.pi / (65536 * 180)
 	__SCALE_ACCEL = 4.0 / 65536
 
-	def __init__(self, address=0x68, dlpf=6):
-		self.i2c = I2C(address)
+	def __init__(self, address=0x68, dlpf=6, aux_sensors=[], bus=1, accel_offsets=(0.0, 0.0, 0.0), accel_gains=(1.0, 1.0, 1.0)):
+		if bus == 1:
+			self.i2c = I2C(address)
+		else:
+			self.i2c = I2C(address, smbus.SMBus(bus))
 		self.address = address
+		self.bus = bus
 		self.sensor_data = array('B', [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])
 		self.result_array = array('h', [0, 0, 0, 0, 0, 0, 0])
 		self.misses = 0
 
+		#-----------------------------------------------------------------------------------
+		# Auxiliary sensors' data follows the 14 bytes of accelerometer, temperature and gyro
+		# data in the same burst read.
+		#-----------------------------------------------------------------------------------
+		self.aux_sensors = aux_sensors
+		self.aux_fields = [field for sensor in aux_sensors for field in sensor.fields]
+		self.read_length = 14 + sum([sensor.length for sensor in aux_sensors])
+
 		self.gx_offset = 0.0
 		self.gy_offset = 0.0
 		self.gz_offset = 0.0
 
 		#-----------------------------------------------------------------------------------
-		# These values are derived from the last calibration run.
-		#-----------------------------------------------------------------------------------
-
-		#-----------------------------------------------------------------------------------
-		# No calibration
+		# The airframe's accelerometer calibration, by default none
 		#-----------------------------------------------------------------------------------
-		self.ax_offset = 0.0
-		self.ax_gain = 1.0
-		self.ay_offset = 0.0
-		self.ay_gain = 1.0
-		self.az_offset = 0.0
-		self.az_gain = 1.0
+		self.ax_offset, self.ay_offset, self.az_offset = accel_offsets
+		self.ax_gain, self.ay_gain, self.az_gain = accel_gains
 
-		if i_am_phoebe:
-			#---------------------------------------------------------------------------
-			# Phoebe @ dlpf 6, 1180 / 40oC
-			#---------------------------------------------------------------------------
-			self.ax_offset = 46.28
-			self.ax_gain = 0.99328514
-			self.ay_offset = 78.58
-			self.ay_gain = 0.991557479
-			self.az_offset = -87.04
-			self.az_gain = 1.00327485
-
-		elif i_am_chloe:
-			self.ax_offset = -75.64
-			self.ax_gain = 0.997474655
-			self.ay_offset = -335.08
-			self.ay_gain = 1.001905479
-			self.az_offset = -1181.88
-			self.az_gain = 0.986795348
+		self.compileCorrection()
 
 		logger.info('Reseting MPU-6050')
 		#-----------------------------------------------------------------------------------
@@ -381,6 +503,9 @@ class MPU6050 :
 		logger.debug('Enable interrupt')
 		self.i2c.write8(self.__MPU6050_RA_INT_PIN_CFG, 0x10)
 		time.sleep(0.1)
+
+		if len(self.aux_sensors) > 0:
+			self.setupAuxiliary()
 	
 		#-----------------------------------------------------------------------------------
 		# Enable data ready interrupt
@@ -401,18 +526,25 @@ class MPU6050 :
 	def readSensorsRaw(self):
 		global time_now
 		global temp_now
+		global time_ready
 
 		#-----------------------------------------------------------------------------------
 		# Wait for the data ready interrupt
 		#-----------------------------------------------------------------------------------
 		RPIO.edge_detect_wait(RPIO_DATA_READY_INTERRUPT)
 
+		#-----------------------------------------------------------------------------------
+		# Only time stamp the interrupt if the timing probes want to split the wait from the read
+		#-----------------------------------------------------------------------------------
+		if stage_timing:
+			time_ready = time.time()
+
 		#-----------------------------------------------------------------------------------
 		# For speed of reading, read all the sensors and parse to SHORTs after.  This also
 		# ensures a self consistent set of sensor data compared to reading each individually
 		# where the sensor data registers could be updated between reads.
 		#-----------------------------------------------------------------------------------
-		sensor_data = self.i2c.readList(self.__MPU6050_RA_ACCEL_XOUT_H, 14)
+		sensor_data = self.i2c.readList(self.__MPU6050_RA_ACCEL_XOUT_H, self.read_length)
 
 		#-----------------------------------------------------------------------------------
 		# Time stamp the data for the best integration possible in the main
@@ -431,8 +563,82 @@ class MPU6050 :
 		#-----------------------------------------------------------------------------------
 		[ax, ay, az, temp_now, gx, gy, gz] = self.result_array
 
+		if len(self.aux_sensors) > 0:
+			self.parseAuxiliary(sensor_data)
+
+		return ax, ay, az, gx, gy, gz
+
+	def pollSensorsRaw(self):
+		#-----------------------------------------------------------------------------------
+		# For an MPU6050 without its data ready interrupt wired up: INT_STATUS immediately
+		# precedes the sensor data, so one burst read says whether this is a new sample and
+		# returns it if so, else None.
+		#-----------------------------------------------------------------------------------
+		sensor_data = self.i2c.readList(self.__MPU6050_RA_INT_STATUS, 15)
+		if not sensor_data[0] & 0x01:
+			return None
+
+		for index in range(1, 15, 2):
+			if (sensor_data[index] > 127):
+				sensor_data[index] -= 256
+			self.result_array[int(index / 2)] = (sensor_data[index] << 8) + sensor_data[index + 1]
+
+		[ax, ay, az, temp, gx, gy, gz] = self.result_array
 		return ax, ay, az, gx, gy, gz
 
+	def setupAuxiliary(self):
+		#-----------------------------------------------------------------------------------
+		# SLV0 - SLV3 can each read a sensor into EXT_SENS_DATA_00 - 23 in turn, but only
+		# the first 18 bytes fit in the one burst read.
+		#-----------------------------------------------------------------------------------
+		if len(self.aux_sensors) > AUX_SENSORS_MAX or self.read_length > 14 + AUX_DATA_MAX:
+			raise ValueError("The MPU6050 can read at most %d auxiliary sensors and %d bytes" % (AUX_SENSORS_MAX, AUX_DATA_MAX))
+
+		#-----------------------------------------------------------------------------------
+		# Configure the sensors directly from the Pi through the MPU6050's pass through.
+		#-----------------------------------------------------------------------------------
+		logger.debug('Auxiliary I2C pass through')
+		self.i2c.write8(self.__MPU6050_RA_INT_PIN_CFG, 0x12)
+		time.sleep(0.1)
+
+		for sensor in self.aux_sensors:
+			logger.debug('Configure auxiliary %s', sensor.name)
+			sensor.setup(I2C(sensor.address))
+
+		self.i2c.write8(self.__MPU6050_RA_INT_PIN_CFG, 0x10)
+		time.sleep(0.1)
+
+		#-----------------------------------------------------------------------------------
+		# Then hand them to the MPU6050's I2C master at 400kHz to read every sample.
+		# WAIT_FOR_ES holds off data ready until EXT_SENS_DATA has been refreshed, so the
+		# burst read never sees stale or half-written aux bytes.
+		#-----------------------------------------------------------------------------------
+		logger.debug('Auxiliary I2C master')
+		self.i2c.write8(self.__MPU6050_RA_I2C_MST_CTRL, 0x4D)
+
+		slave_registers = [(self.__MPU6050_RA_I2C_SLV0_ADDR, self.__MPU6050_RA_I2C_SLV0_REG, self.__MPU6050_RA_I2C_SLV0_CTRL),
+				   (self.__MPU6050_RA_I2C_SLV1_ADDR, self.__MPU6050_RA_I2C_SLV1_REG, self.__MPU6050_RA_I2C_SLV1_CTRL),
+				   (self.__MPU6050_RA_I2C_SLV2_ADDR, self.__MPU6050_RA_I2C_SLV2_REG, self.__MPU6050_RA_I2C_SLV2_CTRL),
+				   (self.__MPU6050_RA_I2C_SLV3_ADDR, self.__MPU6050_RA_I2C_SLV3_REG, self.__MPU6050_RA_I2C_SLV3_CTRL)]
+
+		for sensor, (addr_register, reg_register, ctrl_register) in zip(self.aux_sensors, slave_registers):
+			self.i2c.write8(addr_register, 0x80 | sensor.address)
+			self.i2c.write8(reg_register, sensor.register)
+			self.i2c.write8(ctrl_register, 0x80 | sensor.length)
+
+		self.i2c.write8(self.__MPU6050_RA_USER_CTRL, 0x20)
+		time.sleep(0.1)
+
+	def parseAuxiliary(self, sensor_data):
+		global aux_now
+
+		aux_values = ()
+		offset = 14
+		for sensor in self.aux_sensors:
+			aux_values += sensor.parse(sensor_data, offset)
+			offset += sensor.length
+		aux_now = aux_values
+
 	def rawCorrection(self, ax, ay, az, gx, gy, gz):
 
 		qax = (ax + self.ax_offset) * self.ax_gain * self.__SCALE_ACCEL
@@ -444,6 +650,46 @@ class MPU6050 :
 		qgz = (gz - self.gz_offset) * self.__SCALE_GYRO
 
 		return qax, qay, qaz, qgx, qgy, qgz
+
+
+	def compileCorrection(self):
+		#-----------------------------------------------------------------------------------
+		# Fold each axis' offset, gain and scale from rawCorrection into one scale and bias so
+		# rawCorrectionFixed() costs a multiply and an add per axis.  Recompiled whenever the
+		# calibration changes.
+		#-----------------------------------------------------------------------------------
+		self.correction_scales = array('d', [self.ax_gain * self.__SCALE_ACCEL,
+						     self.ay_gain * self.__SCALE_ACCEL,
+						     self.az_gain * self.__SCALE_ACCEL,
+						     self.__SCALE_GYRO,
+						     self.__SCALE_GYRO,
+						     self.__SCALE_GYRO])
+		self.correction_biases = array('d', [self.ax_offset * self.ax_gain * self.__SCALE_ACCEL,
+						     self.ay_offset * self.ay_gain * self.__SCALE_ACCEL,
+						     self.az_offset * self.az_gain * self.__SCALE_ACCEL,
+						     -self.gx_offset * self.__SCALE_GYRO,
+						     -self.gy_offset * self.__SCALE_GYRO,
+						     -self.gz_offset * self.__SCALE_GYRO])
+
+
+	def rawCorrectionFixed(self, ax, ay, az, gx, gy, gz, period_us):
+		#-----------------------------------------------------------------------------------
+		# The same as rawCorrection, but from integer sums of raw counts x microseconds over
+		# period_us microseconds, so the averaging folds into the scale too.
+		#-----------------------------------------------------------------------------------
+		scales = self.correction_scales
+		biases = self.correction_biases
+		per_us = 1.0 / period_us
+
+		qax = ax * (scales[0] * per_us) + biases[0]
+		qay = ay * (scales[1] * per_us) + biases[1]
+		qaz = az * (scales[2] * per_us) + biases[2]
+
+		qgx = gx * (scales[3] * per_us) + biases[3]
+		qgy = gy * (scales[4] * per_us) + biases[4]
+		qgz = gz * (scales[5] * per_us) + biases[5]
+
+		return qax, qay, qaz, qgx, qgy, qgz
 	
 
 	def calibrateGyros(self):
@@ -461,7 +707,7 @@ class MPU6050 :
 		self.gx_offset = gx_offset / self.__CALIBRATION_ITERATIONS
 		self.gy_offset = gy_offset / self.__CALIBRATION_ITERATIONS
 		self.gz_offset = gz_offset / self.__CALIBRATION_ITERATIONS
-
+		self.compileCorrection()
 
 
 	def calibrateGravity(self, file_name):
@@ -471,6 +717,7 @@ class MPU6050 :
 		self.ay_gain = 1.0
 		self.az_offset = 0.0
 		self.az_gain = 1.0
+		self.compileCorrection()
 
 		gravity_x = 0.0
 		gravity_y = 0.0
@@ -514,6 +761,586 @@ class MPU6050 :
 		
 
 
+####################################################################################################
+#
+# Decimation filters: an alternative to box averaging the sensor samples over each motion period
+# through the *_integrated accumulators.  Each filter takes every raw frame with sample() and is read
+# at the motion processing rate with output(), giving raw values for rawCorrection().  All state is
+# preallocated, and each primes itself from the first frame so there's no start up transient.
+#
+#     cic     order 3 recursive running sums of one motion period's samples - nulls at the motion
+#             frequency and its harmonics, the aliases of which land on DC, in integers
+#     fir     Hamming windowed sinc low pass at half the motion frequency over two motion periods
+#             of frames in a circular buffer, only computed when read
+#     biquad  4th order Butterworth low pass at half the motion frequency as two biquads
+#
+####################################################################################################
+class DecimationFilter:
+
+	def __init__(self, name, sample_rate, motion_frequency):
+		self.name = name
+		self.sample_rate = sample_rate
+		self.ratio = max(1, int(round(sample_rate / motion_frequency)))
+		self.cutoff = motion_frequency / 2
+		self.primed = False
+
+	def benchmark(self, samples):
+		#-----------------------------------------------------------------------------------
+		# Per sample and per output cost in microseconds, on synthetic frames.  The filter is
+		# left unprimed so it starts afresh from real data.
+		#-----------------------------------------------------------------------------------
+		frames = [(random.randint(-2000, 2000), random.randint(-2000, 2000), random.randint(14000, 18000), random.randint(-200, 200), random.randint(-200, 200), random.randint(-200, 200)) for frame in range(0, samples)]
+
+		start = time.time()
+		for ax, ay, az, gx, gy, gz in frames:
+			self.sample(ax, ay, az, gx, gy, gz)
+		sample_time = (time.time() - start) / samples
+
+		outputs = max(1, int(samples / self.ratio))
+		start = time.time()
+		for output in range(0, outputs):
+			self.output()
+		output_time = (time.time() - start) / outputs
+
+		self.primed = False
+		return sample_time * 1000000, output_time * 1000000
+
+class CicFilter(DecimationFilter):
+
+	_ORDER = 3
+
+	def __init__(self, sample_rate, motion_frequency):
+		DecimationFilter.__init__(self, "cic", sample_rate, motion_frequency)
+
+		#-----------------------------------------------------------------------------------
+		# The last stage's sums reach 32768 * ratio ** _ORDER, past 32 bits at 8kHz where the
+		# ratio is ~186, so they're doubles, exact for integers up to 2 ** 53.
+		#-----------------------------------------------------------------------------------
+		self.delays = array('d', [0.0] * (self._ORDER * 6 * self.ratio))
+		self.sums = array('d', [0.0] * (self._ORDER * 6))
+		self.position = 0
+		self.gain = self.ratio ** self._ORDER
+		self.delay = self._ORDER * (self.ratio - 1) / 2
+
+	def prime(self, frame):
+		for axis, value in enumerate(frame):
+			for stage in range(0, self._ORDER):
+				for slot in range(0, self.ratio):
+					self.delays[(stage * 6 + axis) * self.ratio + slot] = value
+				value *= self.ratio
+				self.sums[stage * 6 + axis] = value
+		self.primed = True
+
+	def sample(self, ax, ay, az, gx, gy, gz):
+		if not self.primed:
+			self.prime((ax, ay, az, gx, gy, gz))
+
+		delays = self.delays
+		sums = self.sums
+		ratio = self.ratio
+		position = self.position
+
+		index = 0
+		for value in (ax, ay, az, gx, gy, gz):
+			for stage in range(0, self._ORDER):
+				slot = index * ratio + position
+				sums[index] += value - delays[slot]
+				delays[slot] = value
+				value = sums[index]
+				index += 6
+			index -= 6 * self._ORDER - 1
+
+		position += 1
+		if position == ratio:
+			position = 0
+		self.position = position
+
+	def output(self):
+		last = 6 * (self._ORDER - 1)
+		sums = self.sums
+		gain = self.gain
+		return sums[last] / gain, sums[last + 1] / gain, sums[last + 2] / gain, sums[last + 3] / gain, sums[last + 4] / gain, sums[last + 5] / gain
+
+class FirFilter(DecimationFilter):
+
+	def __init__(self, sample_rate, motion_frequency):
+		DecimationFilter.__init__(self, "fir", sample_rate, motion_frequency)
+		taps = 2 * self.ratio + 1
+		self.taps = taps
+
+		#-----------------------------------------------------------------------------------
+		# Windowed sinc, normalised to unity gain at DC, newest frame first
+		#-----------------------------------------------------------------------------------
+		fc = self.cutoff / sample_rate
+		coefficients = []
+		for tap in range(0, taps):
+			n = tap - (taps - 1) / 2
+			sinc = 2 * fc if n == 0 else math.sin(2 * math.pi * fc * n) / (math.pi * n)
+			coefficients.append(sinc * (0.54 - 0.46 * math.cos(2 * math.pi * tap / (taps - 1))))
+		total = sum(coefficients)
+		self.coefficients = array('d', [coefficient / total for coefficient in coefficients])
+
+		self.frames = array('d', [0.0] * (6 * taps))
+		self.position = 0
+		self.delay = (taps - 1) / 2
+
+	def prime(self, frame):
+		for slot in range(0, self.taps):
+			self.frames[slot * 6:slot * 6 + 6] = array('d', frame)
+		self.primed = True
+
+	def sample(self, ax, ay, az, gx, gy, gz):
+		if not self.primed:
+			self.prime((ax, ay, az, gx, gy, gz))
+
+		base = self.position * 6
+		frames = self.frames
+		frames[base] = ax
+		frames[base + 1] = ay
+		frames[base + 2] = az
+		frames[base + 3] = gx
+		frames[base + 4] = gy
+		frames[base + 5] = gz
+
+		self.position += 1
+		if self.position == self.taps:
+			self.position = 0
+
+	def output(self):
+		frames = self.frames
+		results = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+		slot = self.position
+		for coefficient in self.coefficients:
+			slot -= 1
+			if slot < 0:
+				slot = self.taps - 1
+			base = slot * 6
+			for axis in range(0, 6):
+				results[axis] += coefficient * frames[base + axis]
+		return tuple(results)
+
+class BiquadFilter(DecimationFilter):
+
+	#-------------------------------------------------------------------------------------------
+	# The Qs of the two sections of a 4th order Butterworth
+	#-------------------------------------------------------------------------------------------
+	_QS = [0.5411961, 1.3065630]
+
+	def __init__(self, sample_rate, motion_frequency):
+		DecimationFilter.__init__(self, "biquad", sample_rate, motion_frequency)
+
+		#-----------------------------------------------------------------------------------
+		# Bilinear transform low pass sections, normalised by a0; per section b0, b1, b2, a1, a2
+		#-----------------------------------------------------------------------------------
+		w0 = 2 * math.pi * self.cutoff / sample_rate
+		coefficients = []
+		for q in self._QS:
+			alpha = math.sin(w0) / (2 * q)
+			a0 = 1 + alpha
+			coefficients += [(1 - math.cos(w0)) / 2 / a0, (1 - math.cos(w0)) / a0, (1 - math.cos(w0)) / 2 / a0, -2 * math.cos(w0) / a0, (1 - alpha) / a0]
+		self.coefficients = array('d', coefficients)
+		self.sections = len(self._QS)
+
+		self.z1 = array('d', [0.0] * (6 * self.sections))
+		self.z2 = array('d', [0.0] * (6 * self.sections))
+		self.outputs = array('d', [0.0] * 6)
+
+		#-----------------------------------------------------------------------------------
+		# Group delay at DC in samples, from the phase a hair above it
+		#-----------------------------------------------------------------------------------
+		w = 0.0001
+		phase = 0.0
+		for section in range(0, self.sections):
+			b0, b1, b2, a1, a2 = coefficients[section * 5:section * 5 + 5]
+			z = complex(math.cos(w), -math.sin(w))
+			response = (b0 + b1 * z + b2 * z * z) / (1 + a1 * z + a2 * z * z)
+			phase += math.atan2(response.imag, response.real)
+		self.delay = -phase / w
+
+	def prime(self, frame):
+		for section in range(0, self.sections):
+			b0, b1, b2, a1, a2 = self.coefficients[section * 5:section * 5 + 5]
+			for axis, value in enumerate(frame):
+				self.z1[section * 6 + axis] = value * (1 - b0)
+				self.z2[section * 6 + axis] = value * (b2 - a2)
+		self.outputs = array('d', frame)
+		self.primed = True
+
+	def sample(self, ax, ay, az, gx, gy, gz):
+		if not self.primed:
+			self.prime((ax, ay, az, gx, gy, gz))
+
+		z1 = self.z1
+		z2 = self.z2
+		outputs = self.outputs
+		coefficients = self.coefficients
+
+		axis = 0
+		for value in (ax, ay, az, gx, gy, gz):
+			index = axis
+			for section in range(0, self.sections):
+				b0, b1, b2, a1, a2 = coefficients[section * 5:section * 5 + 5]
+				result = b0 * value + z1[index]
+				z1[index] = b1 * value - a1 * result + z2[index]
+				z2[index] = b2 * value - a2 * result
+				value = result
+				index += 6
+			outputs[axis] = value
+			axis += 1
+
+	def output(self):
+		outputs = self.outputs
+		return outputs[0], outputs[1], outputs[2], outputs[3], outputs[4], outputs[5]
+
+DECIMATION_FILTERS = {"cic": CicFilter, "fir": FirFilter, "biquad": BiquadFilter}
+
+####################################################################################################
+#
+# Vibration monitor: Goertzel bins on the raw accelerometer and gyro samples at each motor's spin
+# frequency, estimated from its ESC pulse width, so dlpf can be tuned against the vibration actually
+# there.  Each block of VIBRATION_BLOCK_TIME watches one sensor axis, round robin, with frequencies
+# retuned from the current pulse widths at its start and that axis' mean from its last block removed
+# so gravity and gyro offsets don't leak into the bins.  A sample therefore costs one multiply-add
+# per motor whatever the block length, and that cost is measured once up front.  Amplitudes are in
+# raw sensor units (LSB).
+#
+####################################################################################################
+VIBRATION_BLOCK_TIME = 0.25
+VIBRATION_HZ_PER_US = 0.2
+VIBRATION_AXES = ["qax", "qay", "qaz", "qgx", "qgy", "qgz"]
+
+def MotorFrequency(esc):
+	return (esc.pulse_width - esc.min_pulse_width) * VIBRATION_HZ_PER_US
+
+class VibrationMonitor:
+
+	def __init__(self, esc_list, sample_rate):
+		self.esc_list = esc_list
+		self.sample_rate = sample_rate
+		self.block_size = int(round(sample_rate * VIBRATION_BLOCK_TIME))
+		self.bins = len(esc_list)
+
+		self.frequencies = array('d', [0.0] * self.bins)
+		self.coefficients = array('d', [0.0] * self.bins)
+		self.s1 = array('d', [0.0] * self.bins)
+		self.s2 = array('d', [0.0] * self.bins)
+		self.means = array('d', [0.0] * 6)
+		self.axis = 0
+		self.total = 0.0
+		self.count = 0
+		self.primed = False
+
+		#-----------------------------------------------------------------------------------
+		# Largest amplitude seen per motor over the flight, at what frequency and on which axis
+		#-----------------------------------------------------------------------------------
+		self.peaks = [(0.0, 0.0, "") for esc in esc_list]
+
+		self.blocks = 0
+
+		self.retune()
+
+	def retune(self):
+		#-----------------------------------------------------------------------------------
+		# Motors below their minimum pulse width or spinning past the Nyquist frequency have
+		# no bin this block.
+		#-----------------------------------------------------------------------------------
+		nyquist = self.sample_rate / 2
+		for index, esc in enumerate(self.esc_list):
+			frequency = MotorFrequency(esc)
+			if frequency <= 0.0 or frequency >= nyquist:
+				frequency = 0.0
+			self.frequencies[index] = frequency
+			self.coefficients[index] = 2 * math.cos(2 * math.pi * frequency / self.sample_rate)
+			self.s1[index] = 0.0
+			self.s2[index] = 0.0
+
+	def sample(self, ax, ay, az, gx, gy, gz):
+		if not self.primed:
+			self.means[0], self.means[1], self.means[2], self.means[3], self.means[4], self.means[5] = ax, ay, az, gx, gy, gz
+			self.primed = True
+
+		value = (ax, ay, az, gx, gy, gz)[self.axis]
+		self.total += value
+		value -= self.means[self.axis]
+
+		s1 = self.s1
+		s2 = self.s2
+		index = 0
+		for coefficient in self.coefficients:
+			s0 = value + coefficient * s1[index] - s2[index]
+			s2[index] = s1[index]
+			s1[index] = s0
+			index += 1
+
+		self.count += 1
+		if self.count == self.block_size:
+			self.report()
+
+	def benchmark(self, samples):
+		#-----------------------------------------------------------------------------------
+		# Per sample cost in microseconds with every bin active, on synthetic data, by a
+		# monitor of the same size kept within one block so it never reports.
+		#-----------------------------------------------------------------------------------
+		monitor = VibrationMonitor(self.esc_list, self.sample_rate)
+		for index in range(0, monitor.bins):
+			monitor.coefficients[index] = 2 * math.cos(2 * math.pi * (index + 1) * 100 / self.sample_rate)
+
+		samples = min(samples, monitor.block_size - 1)
+		frames = [[random.randint(-200, 200) for axis in range(0, 6)] for frame in range(0, samples)]
+
+		start = time.time()
+		for ax, ay, az, gx, gy, gz in frames:
+			monitor.sample(ax, ay, az, gx, gy, gz)
+		sample_time = (time.time() - start) / samples
+
+		return sample_time * 1000000
+
+	def report(self):
+		axis_name = VIBRATION_AXES[self.axis]
+		for index, esc in enumerate(self.esc_list):
+			if self.frequencies[index] == 0.0:
+				continue
+
+			s1 = self.s1[index]
+			s2 = self.s2[index]
+			power = s1 * s1 + s2 * s2 - self.coefficients[index] * s1 * s2
+			amplitude = 2 * math.sqrt(max(power, 0.0)) / self.count
+
+			logger.warning("vibration %s %fHz %s %f", esc.name, self.frequencies[index], axis_name, amplitude)
+			if amplitude > self.peaks[index][0]:
+				self.peaks[index] = (amplitude, self.frequencies[index], axis_name)
+
+		self.means[self.axis] = self.total / self.count
+		self.axis = (self.axis + 1) % 6
+		self.total = 0.0
+		self.count = 0
+		self.blocks += 1
+		self.retune()
+
+	def summary(self):
+		for esc, (peak, frequency, axis) in zip(self.esc_list, self.peaks):
+			logger.critical("vibration %s: peak %f at %fHz on %s", esc.name, peak, frequency, axis)
+		logger.critical("vibration %d blocks", self.blocks)
+
+####################################################################################################
+#
+# RPM tracking gyro notch filters: one biquad notch per motor on each gyro axis, centred on that
+# motor's spin frequency from MotorFrequency(), to take motor / prop vibration out of the rate PID
+# inputs without the phase lag of a lower dlpf cut off.  Retuning is spread out at the motion
+# processing rate, one notch per motion period and only if its motor's frequency has moved by more
+# than NOTCH_RETUNE_HZ, so a sample just runs the filters.  A notch is left as a pass through while
+# its motor is too slow to be distinguishable from real rotation.  Outputs stay integers like the
+# raw data, as the CIC decimation filter needs.
+#
+####################################################################################################
+NOTCH_Q = 4.0
+NOTCH_MIN_HZ = 40.0
+NOTCH_RETUNE_HZ = 1.0
+
+class NotchFilterBank:
+
+	def __init__(self, esc_list, sample_rate):
+		self.esc_list = esc_list
+		self.sample_rate = sample_rate
+		self.notches = len(esc_list)
+
+		#-----------------------------------------------------------------------------------
+		# Transposed direct form II state per gyro axis per notch.  A notch normalised by a0
+		# has b2 = b0 and a1 = b1, so only (notch, b0, b1, a2) of the active notches are kept,
+		# rebuilt whenever one is retuned.
+		#-----------------------------------------------------------------------------------
+		self.frequencies = array('d', [0.0] * self.notches)
+		self.coefficients = [None] * self.notches
+		self.active = []
+		self.z1 = array('d', [0.0] * (3 * self.notches))
+		self.z2 = array('d', [0.0] * (3 * self.notches))
+		self.outputs = array('l', [0, 0, 0])
+
+		self.next_notch = 0
+		self.retunes = 0
+
+	def tune(self, notch, frequency):
+		self.frequencies[notch] = frequency
+
+		if frequency < NOTCH_MIN_HZ or frequency >= self.sample_rate / 2:
+			self.coefficients[notch] = None
+		else:
+			w0 = 2 * math.pi * frequency / self.sample_rate
+			alpha = math.sin(w0) / (2 * NOTCH_Q)
+			a0 = 1 + alpha
+			self.coefficients[notch] = (notch, 1 / a0, -2 * math.cos(w0) / a0, (1 - alpha) / a0)
+
+		self.active = [coefficients for coefficients in self.coefficients if coefficients is not None]
+
+	def retune(self):
+		notch = self.next_notch
+		self.next_notch = (notch + 1) % self.notches
+
+		frequency = MotorFrequency(self.esc_list[notch])
+		if abs(frequency - self.frequencies[notch]) > NOTCH_RETUNE_HZ:
+			self.tune(notch, frequency)
+			self.retunes += 1
+
+	def sample(self, gx, gy, gz):
+		active = self.active
+		z1 = self.z1
+		z2 = self.z2
+		outputs = self.outputs
+
+		axis = 0
+		offset = 0
+		for value in (gx, gy, gz):
+			for notch, b0, b1, a2 in active:
+				index = offset + notch
+				result = b0 * value + z1[index]
+				z1[index] = b1 * (value - result) + z2[index]
+				z2[index] = b0 * value - a2 * result
+				value = result
+			outputs[axis] = int(round(value))
+			axis += 1
+			offset += self.notches
+
+		return outputs[0], outputs[1], outputs[2]
+
+	def benchmark(self, samples):
+		#-----------------------------------------------------------------------------------
+		# Per sample cost in microseconds with every notch active, on synthetic gyro data.
+		# The filter state and tuning are restored afterwards.
+		#-----------------------------------------------------------------------------------
+		frequencies = array('d', self.frequencies)
+		for notch in range(0, self.notches):
+			self.tune(notch, NOTCH_MIN_HZ + notch * 10)
+
+		frames = [(random.randint(-200, 200), random.randint(-200, 200), random.randint(-200, 200)) for frame in range(0, samples)]
+
+		start = time.time()
+		for gx, gy, gz in frames:
+			self.sample(gx, gy, gz)
+		sample_time = (time.time() - start) / samples
+
+		for notch in range(0, self.notches):
+			self.tune(notch, frequencies[notch])
+		for index in range(0, 3 * self.notches):
+			self.z1[index] = 0.0
+			self.z2[index] = 0.0
+
+		return sample_time * 1000000
+
+####################################################################################################
+#
+# Kalman filter velocity estimator: per quad frame axis, a velocity and an accelerometer bias state,
+# decoupled so each axis is a 2 x 2 problem done longhand in preallocated arrays with no allocation
+# per step.  predict() integrates the gravity-free acceleration less the estimated bias, as the plain
+# integrator did; update() folds in any scalar measurement of velocity and / or bias with its
+# variance, so a barometer or optical flow can be added later without changing the filter.  Until
+# then the one measurement is zero velocity while still on the ground, which is where the bias is
+# learned.  In flight nothing observes the velocity, so the drift from any bias left over is bounded
+# by a leak instead: the velocity estimate decays towards zero with time constant KALMAN_LEAK_TIME,
+# limiting the drift to the residual bias times KALMAN_LEAK_TIME, at the cost of under-reading a
+# sustained velocity by dt / KALMAN_LEAK_TIME of itself per step.  The leak never looks at the
+# target velocity, so the PID using this estimate still sees its real error.
+#
+####################################################################################################
+KALMAN_ACCEL_NOISE = 0.5
+KALMAN_BIAS_DRIFT = 0.01
+KALMAN_INITIAL_BIAS = 0.1
+KALMAN_GROUND_VARIANCE = 0.0001
+KALMAN_LEAK_TIME = 10.0
+
+class KalmanVelocity:
+
+	def __init__(self):
+		#-----------------------------------------------------------------------------------
+		# State (velocity, bias) and the symmetric covariance (Pvv, Pvb, Pbb) for each of the
+		# X, Y and Z axes in turn
+		#-----------------------------------------------------------------------------------
+		self.state = array('d', [0.0] * 6)
+		self.covariance = array('d', [0.0, 0.0, KALMAN_INITIAL_BIAS ** 2] * 3)
+
+		self.steps = 0
+		self.updates = 0
+
+	def predict(self, ax, ay, az, dt, leak = 0.0):
+		#-----------------------------------------------------------------------------------
+		# velocity = (1 - leak) * velocity + (acceleration - bias) * dt
+		#-----------------------------------------------------------------------------------
+		state = self.state
+		covariance = self.covariance
+		velocity_noise = (KALMAN_ACCEL_NOISE * dt) ** 2
+		bias_noise = KALMAN_BIAS_DRIFT ** 2 * dt
+		retain = 1.0 - leak
+
+		axis = 0
+		for acceleration in (ax, ay, az):
+			state[axis * 2] = retain * state[axis * 2] + (acceleration - state[axis * 2 + 1]) * dt
+
+			base = axis * 3
+			pvv, pvb, pbb = covariance[base], covariance[base + 1], covariance[base + 2]
+			covariance[base] = retain * retain * pvv - 2 * retain * dt * pvb + dt * dt * pbb + velocity_noise
+			covariance[base + 1] = retain * pvb - dt * pbb
+			covariance[base + 2] = pbb + bias_noise
+			axis += 1
+
+	def update(self, axis, measurement, variance, velocity_weight = 1.0, bias_weight = 0.0):
+		#-----------------------------------------------------------------------------------
+		# Scalar measurement = velocity_weight * velocity + bias_weight * bias + noise
+		#-----------------------------------------------------------------------------------
+		state = self.state
+		covariance = self.covariance
+		base = axis * 3
+		pvv, pvb, pbb = covariance[base], covariance[base + 1], covariance[base + 2]
+
+		ph_v = velocity_weight * pvv + bias_weight * pvb
+		ph_b = velocity_weight * pvb + bias_weight * pbb
+		innovation_variance = velocity_weight * ph_v + bias_weight * ph_b + variance
+		k_v = ph_v / innovation_variance
+		k_b = ph_b / innovation_variance
+
+		innovation = measurement - velocity_weight * state[axis * 2] - bias_weight * state[axis * 2 + 1]
+		state[axis * 2] += k_v * innovation
+		state[axis * 2 + 1] += k_b * innovation
+
+		covariance[base] = pvv - k_v * ph_v
+		covariance[base + 1] = pvb - k_v * ph_b
+		covariance[base + 2] = pbb - k_b * ph_b
+
+		self.updates += 1
+
+	def step(self, ax, ay, az, dt, grounded):
+		if grounded:
+			self.predict(ax, ay, az, dt)
+			self.update(0, 0.0, KALMAN_GROUND_VARIANCE)
+			self.update(1, 0.0, KALMAN_GROUND_VARIANCE)
+			self.update(2, 0.0, KALMAN_GROUND_VARIANCE)
+		else:
+			self.predict(ax, ay, az, dt, min(dt / KALMAN_LEAK_TIME, 1.0))
+		self.steps += 1
+
+		state = self.state
+		return state[0], state[2], state[4]
+
+	def benchmark(self, steps, dt):
+		#-----------------------------------------------------------------------------------
+		# Per step cost in microseconds on the ground and in flight, on synthetic data, by a
+		# throwaway filter so this one's state is untouched.
+		#-----------------------------------------------------------------------------------
+		estimator = KalmanVelocity()
+		frames = [(random.uniform(-1.0, 1.0), random.uniform(-1.0, 1.0), random.uniform(-1.0, 1.0)) for frame in range(0, steps)]
+
+		costs = []
+		for grounded in (True, False):
+			start = time.time()
+			for ax, ay, az in frames:
+				estimator.step(ax, ay, az, dt, grounded)
+			costs.append((time.time() - start) * 1000000 / steps)
+
+		return costs[0], costs[1]
+
+	def summary(self):
+		state = self.state
+		logger.critical("kalman velocity bias estimates %f, %f, %f m/s/s", state[1], state[3], state[5])
+		logger.critical("kalman velocity %d steps, %d updates", self.steps, self.updates)
+
 ####################################################################################################
 #
 # PID algorithm to take input sensor readings, and target requirements, and
@@ -581,113 +1408,672 @@ class PID:
 
 ####################################################################################################
 #
-#  Class for managing each blade + motor configuration via its ESC
+# PWM output backends.  The ESCs and heater set() pulse widths in microseconds by BCM pin, and
+# commit() pushes them out as one batch: a pulse width the same as what's already being output is
+# never rewritten, and one set more than once between commits is only written once.  The cost of
+# a commit is in the flight loop's "esc update" stage timing.  The backends are:
+#
+#     rpio    RPIO DMA PWM on a single shared DMA channel - the original
+#     pigpio  the pigpio daemon's hardware timed PWM
+#     sysfs   the kernel's hardware PWM, only on BCM 12 / 13 / 18 / 19 with a pwm overlay loaded
+#     fake    pulse widths just kept in memory, for testing and benchmarking away from the Pi
 #
 ####################################################################################################
-class ESC:
+PWM_PERIOD = 3000
 
-	def __init__(self, pin, location, rotation, name):
-		#-----------------------------------------------------------------------------------
-		# The GPIO BCM numbered pin providing PWM signal for this ESC
-		#-----------------------------------------------------------------------------------
-		self.bcm_pin = pin
+class PwmBackend:
 
+	def __init__(self, name):
+		self.name = name
+		self.widths = {}
+		self.pending = {}
+
+		self.updates = 0
+		self.commits = 0
+		self.writes = 0
+
+	def checkPins(self, pins):
 		#-----------------------------------------------------------------------------------
-		# Physical parameters of the ESC / motors / propellers
+		# Raise ValueError if these pins can't all be driven at once, before any are set up
 		#-----------------------------------------------------------------------------------
-		self.motor_location = location
-		self.motor_rotation = rotation
-		
+		pass
+
+	def addChannel(self, pin, pulse_width):
+		self.setupChannel(pin)
+		self.widths[pin] = None
+		self.set(pin, pulse_width)
+		self.commit()
+
+	def set(self, pin, pulse_width):
+		self.updates += 1
+		if pulse_width == self.widths[pin]:
+			self.pending.pop(pin, None)
+		else:
+			self.pending[pin] = pulse_width
+
+	def commit(self):
+		if not self.pending:
+			return
+
+		self.commits += 1
+		for pin, pulse_width in self.pending.iteritems():
+			self.write(pin, pulse_width)
+			self.writes += 1
+			self.widths[pin] = pulse_width
+		self.pending.clear()
+
+	def summary(self):
+		logger.critical("pwm %s %d updates, %d writes in %d commits", self.name, self.updates, self.writes, self.commits)
+
+	def setupChannel(self, pin):
+		pass
+
+	def write(self, pin, pulse_width):
+		raise NotImplementedError
+
+	def cleanup(self):
+		pass
+
+class RpioPwm(PwmBackend):
+
+	def __init__(self):
+		PwmBackend.__init__(self, "rpio")
+
 		#-----------------------------------------------------------------------------------
-		# Initialize the RPIO DMa PWM for this ESC in microseconds - 1ms - 2ms of
-		# pulse widths with 3ms carrier.
+		# Set up the globally shared single PWM channel
 		#-----------------------------------------------------------------------------------
-		self.min_pulse_width = 1000
-		self.max_pulse_width = 2000
+		PWM.set_loglevel(PWM.LOG_LEVEL_ERRORS)
+		PWM.setup(1)                                    # 1us resolution pulses
+		PWM.init_channel(RPIO_DMA_CHANNEL, PWM_PERIOD)  # pulse every 3ms
+
+	def write(self, pin, pulse_width):
+		PWM.add_channel_pulse(RPIO_DMA_CHANNEL, pin, 0, pulse_width)
+
+	def cleanup(self):
+		PWM.cleanup()
+
+class PigpioPwm(PwmBackend):
 
+	def __init__(self):
+		PwmBackend.__init__(self, "pigpio")
+
+		import pigpio
+		self.pi = pigpio.pi()
+		if not self.pi.connected:
+			raise IOError("pigpio daemon not running")
+
+	def setupChannel(self, pin):
 		#-----------------------------------------------------------------------------------
-		# The PWM pulse range required by this ESC
+		# pigpio picks the nearest frequency it can do to the one asked for, so set the range
+		# from what it chose to keep the duty cycle in microseconds.
 		#-----------------------------------------------------------------------------------
-		self.pulse_width = self.min_pulse_width
+		frequency = self.pi.set_PWM_frequency(pin, int(round(1000000 / PWM_PERIOD)))
+		self.pi.set_PWM_range(pin, int(round(1000000 / frequency)))
+
+	def write(self, pin, pulse_width):
+		self.pi.set_PWM_dutycycle(pin, pulse_width)
+
+	def cleanup(self):
+		for pin in self.widths:
+			self.pi.set_PWM_dutycycle(pin, 0)
+		self.pi.stop()
+
+class SysfsPwm(PwmBackend):
+
+	_CHIP = "/sys/class/pwm/pwmchip0"
+	_CHANNELS = {12: 0, 18: 0, 13: 1, 19: 1}
+
+	def __init__(self):
+		PwmBackend.__init__(self, "sysfs")
+		self.channels = {}
+		self.duty_cycles = {}
+
+	def sysfsWrite(self, name, value):
+		with open(self._CHIP + "/" + name, 'w') as sysfs_file:
+			sysfs_file.write(value)
+
+	def checkPins(self, pins):
+		channels = {}
+		for pin in pins:
+			if pin not in self._CHANNELS:
+				raise ValueError("BCM %d has no hardware PWM, only BCM %s do" % (pin, ", ".join(["%d" % channel_pin for channel_pin in sorted(self._CHANNELS)])))
+			channel = self._CHANNELS[pin]
+			if channel in channels:
+				raise ValueError("BCM %d shares hardware PWM %d with BCM %d" % (pin, channel, channels[channel]))
+			channels[channel] = pin
+
+	def setupChannel(self, pin):
+		if pin not in self._CHANNELS:
+			raise ValueError("BCM %d has no hardware PWM" % pin)
+		channel = self._CHANNELS[pin]
+		if channel in self.channels.values():
+			raise ValueError("BCM %d shares hardware PWM %d with another pin" % (pin, channel))
+		self.channels[pin] = channel
+
+		if not os.path.exists(self._CHIP + "/pwm%d" % channel):
+			self.sysfsWrite("export", "%d" % channel)
+		self.sysfsWrite("pwm%d/period" % channel, "%d" % (PWM_PERIOD * 1000))
+		self.sysfsWrite("pwm%d/enable" % channel, "1")
 
 		#-----------------------------------------------------------------------------------
-		# Initialize the RPIO DMA PWM for this ESC.
+		# Keep the duty cycle open so each update is a single write() in nanoseconds
 		#-----------------------------------------------------------------------------------
-		PWM.add_channel_pulse(RPIO_DMA_CHANNEL, self.bcm_pin, 0, self.pulse_width)
+		self.duty_cycles[pin] = os.open(self._CHIP + "/pwm%d/duty_cycle" % channel, os.O_WRONLY)
 
+	def write(self, pin, pulse_width):
+		os.write(self.duty_cycles[pin], "%d" % (pulse_width * 1000))
 
-	def update(self, spin_rate):
-		self.pulse_width = int(self.min_pulse_width + spin_rate)
+	def cleanup(self):
+		for pin, channel in self.channels.iteritems():
+			os.write(self.duty_cycles[pin], "0")
+			os.close(self.duty_cycles[pin])
+			self.sysfsWrite("pwm%d/enable" % channel, "0")
+			self.sysfsWrite("unexport", "%d" % channel)
+
+class FakePwm(PwmBackend):
 
-		if self.pulse_width < self.min_pulse_width:
-			self.pulse_width = self.min_pulse_width
-		if self.pulse_width > self.max_pulse_width:
-			self.pulse_width = self.max_pulse_width
+	def __init__(self):
+		PwmBackend.__init__(self, "fake")
+		self.outputs = {}
 
-		PWM.add_channel_pulse(RPIO_DMA_CHANNEL, self.bcm_pin, 0, self.pulse_width)
+	def write(self, pin, pulse_width):
+		self.outputs[pin] = pulse_width
 
+PWM_BACKENDS = {"rpio": RpioPwm, "pigpio": PigpioPwm, "sysfs": SysfsPwm, "fake": FakePwm}
 
 ####################################################################################################
 #
 #  Class for managing each blade + motor configuration via its ESC
 #
 ####################################################################################################
-class HEATER:
+class ESC:
 
-	def __init__(self, pin):
+	def __init__(self, pin, angle, rotation, name):
 		#-----------------------------------------------------------------------------------
 		# The GPIO BCM numbered pin providing PWM signal for this ESC
 		#-----------------------------------------------------------------------------------
 		self.bcm_pin = pin
 
 		#-----------------------------------------------------------------------------------
-		# Initialize the RPIO DMA PWM for the THERMOSTAT in microseconds - full range
-		# of pulse widths for 3ms carrier.
+		# Physical parameters of the ESC / motors / propellers
 		#-----------------------------------------------------------------------------------
-		self.min_pulse_width = 0
-		self.max_pulse_width = 2999
+		self.motor_angle = angle
+		self.motor_rotation = rotation
+		self.name = name
+		
+		#-----------------------------------------------------------------------------------
+		# Initialize the PWM for this ESC in microseconds - 1ms - 2ms of pulse widths with
+		# 3ms carrier.
+		#-----------------------------------------------------------------------------------
+		self.min_pulse_width = 1000
+		self.max_pulse_width = 2000
 
 		#-----------------------------------------------------------------------------------
 		# The PWM pulse range required by this ESC
 		#-----------------------------------------------------------------------------------
-		pulse_width = self.min_pulse_width
+		self.pulse_width = self.min_pulse_width
 
 		#-----------------------------------------------------------------------------------
-		# Initialize the RPIO DMA PWM for the THERMOSTAT.
+		# The thrust linearisation table from test case 2, if there is one
 		#-----------------------------------------------------------------------------------
-		PWM.add_channel_pulse(RPIO_DMA_CHANNEL, self.bcm_pin, 0, pulse_width)
+		self.thrust_table = None
+
+		#-----------------------------------------------------------------------------------
+		# Initialize the PWM for this ESC.
+		#-----------------------------------------------------------------------------------
+		pwm.addChannel(self.bcm_pin, self.pulse_width)
 
-	def update(self, temp_out):
-		pulse_width = int(self.min_pulse_width + temp_out)
+
+	def pulseWidth(self, spin_rate):
+		pulse_width = int(self.min_pulse_width + spin_rate)
 
 		if pulse_width < self.min_pulse_width:
-			pulse_width = self.min_pulse_width
+			return self.min_pulse_width
 		if pulse_width > self.max_pulse_width:
-			pulse_width = self.max_pulse_width
+			return self.max_pulse_width
+
+		if self.thrust_table is not None:
+			pulse_width = int(self.min_pulse_width + self.thrust_table.offset(spin_rate))
+		return pulse_width
+
+	def update(self, spin_rate):
+		self.pulse_width = self.pulseWidth(spin_rate)
+
+		pwm.set(self.bcm_pin, self.pulse_width)
+		pwm.commit()
 
-		PWM.add_channel_pulse(RPIO_DMA_CHANNEL, self.bcm_pin, 0, pulse_width)
 
-		
 ####################################################################################################
 #
-# Angles required to convert between Earth (interal reference frame) and Quadcopter (body # reference
-# frame).
+# ESC thrust linearisation.  Thrust is roughly quadratic in the ESC pulse width, so the PID gains
+# only hold near the hover speed they were tuned at.  A ThrustTable, built per motor by test case 2,
+# maps a spin rate asking for thrust in proportion to it onto the pulse width offset that delivers
+# that: entry i is the offset giving i / points of the thrust measured at the top of the table's
+# spin range.  Spin rates beyond that range pass straight through.
 #
-# This is used for reorientating gravity into the quad frame to calculated quad frame velocities
+# Tables are saved one motor per line as "name, spin range, offset, offset, ..." in qcesc.csv, and
+# being pure Python, the same file can model the motors in a simulation with thrust().
 #
 ####################################################################################################
-def GetEulerAngles(ax, ay, az):
-	#-------------------------------------------------------------------------------------------
-	# What's the angle in the x and y plane from horizontal in radians?
-	#-------------------------------------------------------------------------------------------
-	pitch = math.atan2(-ax, math.pow(math.pow(ay, 2) + math.pow(az, 2), 0.5))
-	roll = math.atan2(ay, az)
-	tilt = math.atan2(math.pow(math.pow(ax, 2) + math.pow(ay, 2), 0.5), az)
+ESC_LUT_POINTS = 16
 
-	return pitch, roll, tilt
+class ThrustTable:
 
+	def __init__(self, spin_range, offsets):
+		self.spin_range = spin_range
+		self.offsets = array('d', offsets)
+		self.slopes = array('d', [offsets[index + 1] - offsets[index] for index in range(0, len(offsets) - 1)])
+		self.scale = (len(offsets) - 1) / spin_range
 
-####################################################################################################
+	def offset(self, spin_rate):
+		if spin_rate >= self.spin_range:
+			return spin_rate
+		position = spin_rate * self.scale
+		index = int(position)
+		return self.offsets[index] + self.slopes[index] * (position - index)
+
+	def thrust(self, offset):
+		#-----------------------------------------------------------------------------------
+		# The inverse, for simulation: the fraction of the thrust at the top of the spin range
+		# that a pulse width offset gives.
+		#-----------------------------------------------------------------------------------
+		if offset >= self.spin_range:
+			return offset / self.spin_range
+		index = max(bisect.bisect_right(self.offsets, offset) - 1, 0)
+		if self.slopes[index] == 0.0:
+			return index / (len(self.offsets) - 1)
+		return (index + (offset - self.offsets[index]) / self.slopes[index]) / (len(self.offsets) - 1)
+
+	@staticmethod
+	def fromResponse(spin_rates, responses):
+		#-----------------------------------------------------------------------------------
+		# Build the table from the response measured at increasing spin rates starting at 0,
+		# smoothing out noise by forcing the response never to drop as the spin rate rises.
+		#-----------------------------------------------------------------------------------
+		monotonic = []
+		for response in responses:
+			monotonic.append(max(response, monotonic[-1]) if monotonic else response)
+
+		floor = monotonic[0]
+		ceiling = monotonic[-1]
+		if ceiling <= floor:
+			raise ValueError("no response to the ESC")
+
+		offsets = [0.0]
+		index = 0
+		for point in range(1, ESC_LUT_POINTS):
+			target = floor + (ceiling - floor) * point / ESC_LUT_POINTS
+			while monotonic[index + 1] < target:
+				index += 1
+			fraction = (target - monotonic[index]) / (monotonic[index + 1] - monotonic[index])
+			offsets.append(spin_rates[index] + (spin_rates[index + 1] - spin_rates[index]) * fraction)
+		offsets.append(float(spin_rates[-1]))
+
+		return ThrustTable(spin_rates[-1], offsets)
+
+def SaveThrustTables(file_name, thrust_tables):
+	with open(file_name, 'w') as lut_file:
+		for name, thrust_table in thrust_tables:
+			lut_file.write('%s, %f, %s\n' % (name, thrust_table.spin_range, ', '.join(['%f' % offset for offset in thrust_table.offsets])))
+
+def LoadThrustTables(file_name):
+	#-------------------------------------------------------------------------------------------
+	# Parse the tables by motor name, raising ValueError naming the first bad line
+	#-------------------------------------------------------------------------------------------
+	thrust_tables = {}
+	with open(file_name, 'r') as lut_file:
+		for line_number, line in enumerate(lut_file, 1):
+			fields = line.strip().split(', ')
+			if fields == ['']:
+				continue
+
+			if len(fields) != ESC_LUT_POINTS + 3:
+				raise ValueError("line %d: expected name, spin range and %d offsets" % (line_number, ESC_LUT_POINTS + 1))
+
+			try:
+				values = [float(field) for field in fields[1:]]
+			except ValueError:
+				raise ValueError("line %d: spin range and offsets must be numbers" % line_number)
+
+			spin_range = values[0]
+			offsets = values[1:]
+			if not 0.0 < spin_range < float('inf'):
+				raise ValueError("line %d: spin range must be finite and positive" % line_number)
+
+			for index in range(len(offsets) - 1):
+				if not offsets[index] <= offsets[index + 1] < float('inf'):
+					raise ValueError("line %d: offsets must be finite and never decrease" % line_number)
+
+			thrust_tables[fields[0]] = ThrustTable(spin_range, offsets)
+	return thrust_tables
+
+####################################################################################################
+#
+# Frame layouts: per motor, its name, its angle in degrees clockwise from the front seen from above,
+# and its propeller rotation.  The ESC pin lists in go() follow the same order.
+#
+####################################################################################################
+MOTOR_ROTATION_CW = 1
+MOTOR_ROTATION_ACW = 2
+
+FRAME_LAYOUTS = {"quad": [("front left",     -45.0, MOTOR_ROTATION_ACW),
+			  ("front right",     45.0, MOTOR_ROTATION_CW),
+			  ("back left",     -135.0, MOTOR_ROTATION_CW),
+			  ("back right",     135.0, MOTOR_ROTATION_ACW)],
+		 "hex":  [("front right",     30.0, MOTOR_ROTATION_CW),
+			  ("right",           90.0, MOTOR_ROTATION_ACW),
+			  ("back right",     150.0, MOTOR_ROTATION_CW),
+			  ("back left",     -150.0, MOTOR_ROTATION_ACW),
+			  ("left",           -90.0, MOTOR_ROTATION_CW),
+			  ("front left",     -30.0, MOTOR_ROTATION_ACW)],
+		 "octo": [("front right",     22.5, MOTOR_ROTATION_CW),
+			  ("right front",     67.5, MOTOR_ROTATION_ACW),
+			  ("right back",     112.5, MOTOR_ROTATION_CW),
+			  ("back right",     157.5, MOTOR_ROTATION_ACW),
+			  ("back left",     -157.5, MOTOR_ROTATION_CW),
+			  ("left back",     -112.5, MOTOR_ROTATION_ACW),
+			  ("left front",     -67.5, MOTOR_ROTATION_CW),
+			  ("front left",     -22.5, MOTOR_ROTATION_ACW)]}
+
+####################################################################################################
+#
+# Airframe profiles: each craft's pins, accelerometer calibrations and default flight settings, kept
+# in AIRFRAME_FILE and picked with --airframe, or else by this host's name.  The text is parsed and
+# validated once into immutable Airframe tuples, which are cached beside it in <file>.cache for
+# startup to load rather than re-parse while the text is unchanged.
+#
+####################################################################################################
+AIRFRAME_FILE = "./qcairframes.txt"
+
+Airframe = collections.namedtuple("Airframe", ["name", "hostnames", "frame", "esc_pins", "data_ready_pin", "thermostat_pin", "accel_offsets", "accel_gains", "imu_calibrations", "hover_target", "vv_gains", "hv_gains", "pr_gains", "rr_gains"])
+
+#---------------------------------------------------------------------------------------------------
+# Per setting: the number of values (None for any number), their type, and the default for a
+# setting which may be left out, or None if it must be given.  imu may be given once per extra IMU,
+# its first value the IMU's [bus:]address as for --imu, then its accelerometer offsets and gains.
+#---------------------------------------------------------------------------------------------------
+_AIRFRAME_SETTINGS = {"hostname": (None, str, ()),
+		      "frame": (1, str, None),
+		      "esc_pins": (None, int, None),
+		      "data_ready_pin": (1, int, None),
+		      "thermostat_pin": (1, int, None),
+		      "accel_offsets": (3, float, (0.0, 0.0, 0.0)),
+		      "accel_gains": (3, float, (1.0, 1.0, 1.0)),
+		      "imu": (7, float, ()),
+		      "hover_target": (1, int, None),
+		      "vv_gains": (3, float, None),
+		      "hv_gains": (3, float, None),
+		      "pr_gains": (3, float, None),
+		      "rr_gains": (3, float, None)}
+
+def CheckAirframe(name, settings):
+	#-------------------------------------------------------------------------------------------
+	# Build an Airframe from a profile's parsed settings, raising ValueError at the first problem
+	#-------------------------------------------------------------------------------------------
+	for setting, (count, value_type, default) in _AIRFRAME_SETTINGS.iteritems():
+		if setting not in settings:
+			if default is None:
+				raise ValueError("[%s]: no %s" % (name, setting))
+			settings[setting] = default
+
+	if settings["frame"] not in FRAME_LAYOUTS:
+		raise ValueError("[%s]: frame must be one of %s" % (name, ", ".join(sorted(FRAME_LAYOUTS))))
+
+	if len(settings["esc_pins"]) != len(FRAME_LAYOUTS[settings["frame"]]):
+		raise ValueError("[%s]: a %s frame needs %d esc_pins" % (name, settings["frame"], len(FRAME_LAYOUTS[settings["frame"]])))
+
+	pins = list(settings["esc_pins"]) + [settings["data_ready_pin"], settings["thermostat_pin"]]
+	for pin in pins:
+		if pins.count(pin) > 1:
+			raise ValueError("[%s]: pin %d is given to more than one of esc_pins, data_ready_pin and thermostat_pin" % (name, pin))
+
+	#-------------------------------------------------------------------------------------------
+	# Accelerometer readings are divided by their gains, so these must be finite and non-zero
+	#-------------------------------------------------------------------------------------------
+	calibrations = [("accel", settings["accel_offsets"], settings["accel_gains"])]
+	calibrations += [("imu %d:0x%02x" % imu, offsets, gains) for imu, offsets, gains in settings["imu"]]
+	for label, offsets, gains in calibrations:
+		for value in offsets + gains:
+			if math.isnan(value) or math.isinf(value):
+				raise ValueError("[%s]: %s calibration values must be finite" % (name, label))
+		for gain in gains:
+			if gain == 0.0:
+				raise ValueError("[%s]: %s gains must not be zero" % (name, label))
+
+	if not 0 <= settings["hover_target"] <= 1000:
+		raise ValueError("[%s]: hover_target must lie in 0 <= hover_target <= 1000" % name)
+
+	for setting in ("vv_gains", "hv_gains", "pr_gains", "rr_gains"):
+		for gain in settings[setting]:
+			if not gain >= 0.0:
+				raise ValueError("[%s]: %s must not be negative" % (name, setting))
+
+	return Airframe(name, settings["hostname"], settings["frame"], settings["esc_pins"], settings["data_ready_pin"], settings["thermostat_pin"],
+			settings["accel_offsets"], settings["accel_gains"], tuple(settings["imu"]), settings["hover_target"],
+			settings["vv_gains"], settings["hv_gains"], settings["pr_gains"], settings["rr_gains"])
+
+def ParseAirframes(file_name):
+	#-------------------------------------------------------------------------------------------
+	# Parse the profiles file into a dict of Airframes by name, raising ValueError naming the first
+	# bad line
+	#-------------------------------------------------------------------------------------------
+	profiles = []
+	with open(file_name, 'r') as airframe_file:
+		for line_number, line in enumerate(airframe_file, 1):
+			fields = line.split('#', 1)[0].split()
+			if len(fields) == 0:
+				continue
+
+			if len(fields) == 1 and fields[0].startswith('[') and fields[0].endswith(']'):
+				profiles.append((fields[0][1:-1], {}))
+				continue
+
+			if len(profiles) == 0:
+				raise ValueError("line %d: settings before the first [name]" % line_number)
+
+			setting = fields[0]
+			if setting not in _AIRFRAME_SETTINGS:
+				raise ValueError("line %d: unknown setting %s" % (line_number, setting))
+
+			count, value_type, default = _AIRFRAME_SETTINGS[setting]
+			if (count is None and len(fields) < 2) or (count is not None and len(fields) != count + 1):
+				raise ValueError("line %d: %s needs %s value%s" % (line_number, setting, count or "some", "" if count == 1 else "s"))
+
+			if setting == "imu":
+				try:
+					imu = ParseImuAddress(fields[1])
+					values = tuple([float(field) for field in fields[2:]])
+				except ValueError:
+					raise ValueError("line %d: imu needs a [bus:]address, three offsets and three gains" % line_number)
+
+				calibrations = profiles[-1][1].setdefault("imu", [])
+				if imu in [calibration[0] for calibration in calibrations]:
+					raise ValueError("line %d: imu %s is given twice" % (line_number, fields[1]))
+				calibrations.append((imu, values[:3], values[3:]))
+				continue
+
+			try:
+				values = tuple([value_type(field) for field in fields[1:]])
+			except ValueError:
+				raise ValueError("line %d: %s values must be %s" % (line_number, setting, value_type.__name__))
+
+			profiles[-1][1][setting] = values[0] if count == 1 else values
+
+	airframes = {}
+	for name, settings in profiles:
+		if name in airframes:
+			raise ValueError("[%s] is given twice" % name)
+		airframes[name] = CheckAirframe(name, settings)
+
+	hostnames = [hostname for airframe in airframes.itervalues() for hostname in airframe.hostnames]
+	for hostname in hostnames:
+		if hostnames.count(hostname) > 1:
+			raise ValueError("hostname %s is given to more than one airframe" % hostname)
+
+	return airframes
+
+def LoadAirframes(file_name):
+	#-------------------------------------------------------------------------------------------
+	# Load the profiles from the cache if it's newer than the text, else parse and re-cache them.
+	# The cache carries Airframe's field names, so one written for a differently shaped
+	# Airframe, or one that won't load at all, is simply re-parsed.
+	#-------------------------------------------------------------------------------------------
+	cache_name = file_name + '.cache'
+	if os.path.exists(cache_name) and os.path.getmtime(cache_name) >= os.path.getmtime(file_name):
+		try:
+			with open(cache_name, 'rb') as cache_file:
+				fields, profiles = marshal.load(cache_file)
+			if fields == Airframe._fields:
+				return dict([(name, Airframe(*values)) for name, values in profiles.iteritems()])
+		except (EOFError, ValueError, TypeError, AttributeError):
+			pass
+
+	airframes = ParseAirframes(file_name)
+
+	try:
+		with open(cache_name, 'wb') as cache_file:
+			marshal.dump((Airframe._fields, dict([(name, tuple(airframe)) for name, airframe in airframes.iteritems()])), cache_file)
+	except IOError:
+		pass
+
+	return airframes
+
+def SelectAirframe(airframes, name, hostname):
+	#-------------------------------------------------------------------------------------------
+	# The named airframe, or else the one listing this host, or None
+	#-------------------------------------------------------------------------------------------
+	if name is not None:
+		return airframes.get(name)
+
+	for airframe in airframes.itervalues():
+		if hostname in airframe.hostnames:
+			return airframe
+
+	return None
+
+####################################################################################################
+#
+# Motor mixer: a precomputed matrix mapping the vertical, pitch, roll and yaw PID outputs to each
+# motor's pulse width, built from the ESCs' angles and rotations.
+#
+# - For a left downwards roll, the x gyro goes negative, so the PID error is positive, meaning PID
+#   output is positive, meaning this needs to be added to the left blades and subtracted from the
+#   right.
+# - For a forward downwards pitch, the y gyro goes positive, but is negated in
+#   mpu6050.readSensors() so it is consistent with the accelerometer + Euler angle calculations.
+#   The PID error is postive as a result, meaning PID output is positive, meaning this needs to be
+#   added to the front blades and subtracted from the back.
+# - For CW yaw, the z gyro goes negative, so the PID error is postitive, meaning PID output is
+#   positive, meaning this need to be added to the ACW blades and subtracted from the CW blades.
+#
+# Each column is scaled so its largest entry is 1, so a quad gets exactly the same +/-1 mix as
+# before whatever its arm angles.  update() works out and clamps every motor's pulse width first,
+# then commits them to the PWM as one batch.
+#
+####################################################################################################
+class Mixer:
+
+	def __init__(self, esc_list):
+		self.esc_list = esc_list
+
+		pitch_mix = [-math.cos(math.radians(esc.motor_angle)) for esc in esc_list]
+		roll_mix = [-math.sin(math.radians(esc.motor_angle)) for esc in esc_list]
+		yaw_mix = [(1.0 if esc.motor_rotation == MOTOR_ROTATION_CW else -1.0) for esc in esc_list]
+
+		#-----------------------------------------------------------------------------------
+		# Rounded so the rows of a symmetric frame come out exactly equal and opposite
+		#-----------------------------------------------------------------------------------
+		pitch_scale = max([math.fabs(mix) for mix in pitch_mix])
+		roll_scale = max([math.fabs(mix) for mix in roll_mix])
+		self.matrix = [(round(pitch / pitch_scale, 6), round(roll / roll_scale, 6), yaw) for pitch, roll, yaw in zip(pitch_mix, roll_mix, yaw_mix)]
+
+		self.min_pulse_width = esc_list[0].min_pulse_width
+		self.max_pulse_width = esc_list[0].max_pulse_width
+		self.linear = True
+		for esc in esc_list:
+			if esc.thrust_table is not None:
+				self.linear = False
+
+	def update(self, vert_out, pr_out, rr_out, yr_out):
+		#-----------------------------------------------------------------------------------
+		# Mix and clamp all the motors in one pass, through the ESCs' own thrust linearisation
+		# if they have it.
+		#-----------------------------------------------------------------------------------
+		if self.linear:
+			min_pulse_width = self.min_pulse_width
+			max_pulse_width = self.max_pulse_width
+			base = min_pulse_width + vert_out
+			pulse_widths = [min(max(int(base + pitch_mix * pr_out + roll_mix * rr_out + yaw_mix * yr_out), min_pulse_width), max_pulse_width) for pitch_mix, roll_mix, yaw_mix in self.matrix]
+		else:
+			pulse_widths = [esc.pulseWidth(vert_out + pitch_mix * pr_out + roll_mix * rr_out + yaw_mix * yr_out) for esc, (pitch_mix, roll_mix, yaw_mix) in zip(self.esc_list, self.matrix)]
+
+		for esc, pulse_width in zip(self.esc_list, pulse_widths):
+			esc.pulse_width = pulse_width
+			pwm.set(esc.bcm_pin, pulse_width)
+		pwm.commit()
+
+####################################################################################################
+#
+#  Class for managing each blade + motor configuration via its ESC
+#
+####################################################################################################
+class HEATER:
+
+	def __init__(self, pin):
+		#-----------------------------------------------------------------------------------
+		# The GPIO BCM numbered pin providing PWM signal for this ESC
+		#-----------------------------------------------------------------------------------
+		self.bcm_pin = pin
+
+		#-----------------------------------------------------------------------------------
+		# Initialize the PWM for the THERMOSTAT in microseconds - full range of pulse
+		# widths for 3ms carrier.
+		#-----------------------------------------------------------------------------------
+		self.min_pulse_width = 0
+		self.max_pulse_width = PWM_PERIOD - 1
+
+		#-----------------------------------------------------------------------------------
+		# The PWM pulse range required by this ESC
+		#-----------------------------------------------------------------------------------
+		pulse_width = self.min_pulse_width
+
+		#-----------------------------------------------------------------------------------
+		# Initialize the PWM for the THERMOSTAT.
+		#-----------------------------------------------------------------------------------
+		pwm.addChannel(self.bcm_pin, pulse_width)
+
+	def update(self, temp_out):
+		pulse_width = int(self.min_pulse_width + temp_out)
+
+		if pulse_width < self.min_pulse_width:
+			pulse_width = self.min_pulse_width
+		if pulse_width > self.max_pulse_width:
+			pulse_width = self.max_pulse_width
+
+		pwm.set(self.bcm_pin, pulse_width)
+		pwm.commit()
+
+		
+####################################################################################################
+#
+# Angles required to convert between Earth (interal reference frame) and Quadcopter (body # reference
+# frame).
+#
+# This is used for reorientating gravity into the quad frame to calculated quad frame velocities
+#
+####################################################################################################
+def GetEulerAngles(ax, ay, az):
+	#-------------------------------------------------------------------------------------------
+	# What's the angle in the x and y plane from horizontal in radians?
+	#-------------------------------------------------------------------------------------------
+	pitch = math.atan2(-ax, math.pow(math.pow(ay, 2) + math.pow(az, 2), 0.5))
+	roll = math.atan2(ay, az)
+	tilt = math.atan2(math.pow(math.pow(ax, 2) + math.pow(ay, 2), 0.5), az)
+
+	return pitch, roll, tilt
+
+
+####################################################################################################
 #
 # Convert a body frame gyro rotation rate to Euler frame rotation
 #
@@ -844,7 +2230,7 @@ def Q2EFrame(qvx, qvy, qvz, pa, ra, ya):
 
 ####################################################################################################
 #
-# GPIO pins initialization for MPU6050 interrupt, sounder and hardware PWM
+# GPIO pins initialization for MPU6050 interrupt and sounder
 #
 ####################################################################################################
 def RpioSetup():
@@ -857,106 +2243,83 @@ def RpioSetup():
 	RPIO.setup(RPIO_DATA_READY_INTERRUPT, RPIO.IN) # , RPIO.PUD_DOWN)
 	RPIO.edge_detect_init(RPIO_DATA_READY_INTERRUPT, RPIO.RISING)
 
-	#-----------------------------------------------------------------------------------
-	# Set up the globally shared single PWM channel
-	#-----------------------------------------------------------------------------------
-	PWM.set_loglevel(PWM.LOG_LEVEL_ERRORS)
-	PWM.setup(1)                                    # 1us resolution pulses
-	PWM.init_channel(RPIO_DMA_CHANNEL, 3000)        # pulse every 3ms
-
 ####################################################################################################
 #
-# GPIO pins cleanup for MPU6050 interrupt, sounder and hardware PWM
+# GPIO pins cleanup for MPU6050 interrupt and sounder
 #
 ####################################################################################################
 def RpioCleanup():
-	PWM.cleanup()
 	RPIO.edge_detect_term(RPIO_DATA_READY_INTERRUPT)
 	RPIO.cleanup()
 
 
 ####################################################################################################
 #
-# Check CLI validity, set calibrate_sensors / fly or sys.exit(1)
+# Flight configuration: every setting from the airframe profile and command line, one attribute per
+# setting.  CheckCLI fills it in from these defaults, go() reads it, and TuningConfig updates its
+# tunables in place mid-flight.  Its string form lists every setting for the log.
 #
 ####################################################################################################
-def CheckCLI(argv):
-	cli_fly = False
-	cli_calibrate_gravity = False
-	cli_video = False
-
-	if i_am_phoebe:
-		cli_hover_target = 600
-
-		#-----------------------------------------------------------------------------------
-		# Defaults for vertical velocity PIDs
-		#-----------------------------------------------------------------------------------
-		cli_vvp_gain = 300.0
-		cli_vvi_gain = 60.0
-		cli_vvd_gain = 0.0
-
-		#-----------------------------------------------------------------------------------
-		# Defaults for horizontal velocity PIDs
-		#-----------------------------------------------------------------------------------
-		cli_hvp_gain = 0.6
-		cli_hvi_gain = 0.1
-		cli_hvd_gain = 0.005
-
-		#-----------------------------------------------------------------------------------
-		# Defaults for pitch rate PIDs
-		#-----------------------------------------------------------------------------------
-		cli_prp_gain = 90.0
-		cli_pri_gain = 0.0
-		cli_prd_gain = 0.0
-
-		#-----------------------------------------------------------------------------------
-		# Defaults for roll rate PIDs
-		#-----------------------------------------------------------------------------------
-		cli_rrp_gain = 80.0
-		cli_rri_gain = 0.0
-		cli_rrd_gain = 0.0
+class FlightConfig:
 
-	elif i_am_chloe:
-		cli_hover_target = 500
+	def __init__(self, airframe):
+		self.airframe = airframe
 
-		#-----------------------------------------------------------------------------------
-		# Defaults for vertical velocity PIDs
-		#-----------------------------------------------------------------------------------
-		cli_vvp_gain = 250.0
-		cli_vvi_gain = 50.0
-		cli_vvd_gain = 0.0
-
-		#-----------------------------------------------------------------------------------
-		# Defaults for horizontal velocity PIDs
-		#-----------------------------------------------------------------------------------
-		cli_hvp_gain = 0.6
-		cli_hvi_gain = 0.1
-		cli_hvd_gain = 0.005
+		self.flying = False
+		self.calibrate_gravity = False
+		self.shoot_video = False
+		self.test_case = 0
 
 		#-----------------------------------------------------------------------------------
-		# Defaults for pitch rate PIDs
+		# The airframe's defaults
 		#-----------------------------------------------------------------------------------
-		cli_prp_gain = 75.0
-		cli_pri_gain = 0.0
-		cli_prd_gain = 0.0
+		self.hover_target = airframe.hover_target
+		self.vvp_gain, self.vvi_gain, self.vvd_gain = airframe.vv_gains
+		self.hvp_gain, self.hvi_gain, self.hvd_gain = airframe.hv_gains
+		self.prp_gain, self.pri_gain, self.prd_gain = airframe.pr_gains
+		self.rrp_gain, self.rri_gain, self.rrd_gain = airframe.rr_gains
 
 		#-----------------------------------------------------------------------------------
-		# Defaults for roll rate PIDs
+		# Other configuration defaults
 		#-----------------------------------------------------------------------------------
-		cli_rrp_gain = 60.0
-		cli_rri_gain = 0.0
-		cli_rrd_gain = 0.0
-
-	#-------------------------------------------------------------------------------------------
-	# Other configuration defaults
-	#-------------------------------------------------------------------------------------------
-	cli_test_case = 0
-	cli_dlpf = 4
-	cli_diagnostics = False
-	cli_motion_frequency = 43
-	cli_rtf_period = 1.0
-	cli_tau = 0.5
+		self.dlpf = 4
+		self.diagnostics = False
+		self.motion_frequency = 43
+		self.rtf_period = 1.0
+		self.tau = 0.5
+		self.stage_timing = True
+		self.multi_process = False
+		self.flight_recording = False
+		self.udp_address = None
+		self.udp_rate = 10.0
+		self.command_port = None
+		self.flight_plan = None
+		self.pwm_backend = "rpio"
+		self.fixed_point = False
+		self.decimation_filter = None
+		self.vibration = False
+		self.raw_recording = False
+		self.notch = False
+		self.kalman = False
+		self.aux_sensors = []
+		self.imus = []
+		self.metrics_address = None
+		self.live_tuning = False
+		self.profile_rate = None
+
+	def __str__(self):
+		settings = ["airframe = %s" % self.airframe.name]
+		for name, value in sorted(vars(self).items()):
+			if name != "airframe":
+				settings.append("%s = %s" % (name, value))
+		return ", ".join(settings)
 
+####################################################################################################
+#
+# Check CLI validity, returning the FlightConfig it sets or sys.exit(2)
+#
+####################################################################################################
+def CheckCLI(argv):
 	hover_target_defaulted = True
 	no_drift_control = False
 	prp_set = False
@@ -970,7 +2333,7 @@ def CheckCLI(argv):
 	# Right, let's get on with reading the command line and checking consistency
 	#-------------------------------------------------------------------------------------------
 	try:
-		opts, args = getopt.getopt(argv,'dfgvh:m:r:t:', ['tc=', 'vvp=', 'vvi=', 'vvd=', 'hvp=', 'hvi=', 'hvd=', 'prp=', 'pri=', 'prd=', 'rrp=', 'rri=', 'rrd=', 'dlpf='])
+		opts, args = getopt.getopt(argv,'dfgvh:m:p:r:t:', ['tc=', 'vvp=', 'vvi=', 'vvd=', 'hvp=', 'hvi=', 'hvd=', 'prp=', 'pri=', 'prd=', 'rrp=', 'rri=', 'rrd=', 'dlpf=', 'notiming', 'mp', 'fr', 'udp=', 'udprate=', 'cmd=', 'fp=', 'pwm=', 'fixed', 'filter=', 'vib', 'raw', 'notch', 'kf', 'aux=', 'imu=', 'metrics=', 'tune', 'airframe='])
 	except getopt.GetoptError:
 		logger.critical('Must specify one of -f or -g or --tc')
 		logger.critical('  qcpi.py')
@@ -980,6 +2343,7 @@ def CheckCLI(argv):
 		logger.critical('  -d enable diagnostics')
 		logger.critical('  -v video the flight')
 		logger.critical('  -m ??  set motion processing update frequency')
+		logger.critical('  -p ??  profile the flight loop, sampling at this rate')
 		logger.critical('  -r ??  set the ready-to-fly period')
 		logger.critical('  -t ??  set the -3dB point of the complementary filter')
 		logger.critical('  --vvp  set vertical speed PID P gain')
@@ -996,119 +2360,257 @@ def CheckCLI(argv):
 		logger.critical('  --rrd  set roll rotation PID D gain')
 		logger.critical('  --tc   select which testcase to run')
 		logger.critical('  --dlpf set the digital low pass filter')
+		logger.critical('  --notiming disable the flight loop stage timing probes')
+		logger.critical('  --mp   run sensor acquisition and diagnostics logging in their own processes')
+		logger.critical('  --fr   record diagnostics in the binary flight recorder rather than the log')
+		logger.critical('  --udp  host:port to stream live telemetry to')
+		logger.critical('  --udprate set the live telemetry rate in Hz')
+		logger.critical('  --cmd  UDP port to accept ground station commands on')
+		logger.critical('  --fp   flight plan file to fly rather than the default')
+		logger.critical('  --pwm  PWM backend: rpio (default), pigpio, sysfs or fake')
+		logger.critical('  --fixed integrate the raw sensor data in fixed point integers')
+		logger.critical('  --filter decimate the raw sensor data with a cic, fir or biquad filter')
+		logger.critical('  --vib    monitor vibration at the motor frequencies')
+		logger.critical('  --raw    record the raw sensor samples for qcspectrum.py')
+		logger.critical('  --notch  notch filter the gyros at the motor frequencies')
+		logger.critical('  --kf     estimate velocity with a Kalman filter rather than integration')
+		logger.critical('  --aux    comma separated auxiliary sensors on the MPU6050 I2C master: mag, baro')
+		logger.critical('  --imu    comma separated extra MPU6050s to vote with as [bus:]address, e.g. 0x69,3:0x68')
+		logger.critical('  --metrics serve Prometheus metrics on this localhost port or unix socket path')
+		logger.critical('  --tune   publish the tunables in /dev/shm/qctuning for live editing with qctune.py')
+		logger.critical('  --airframe use this profile from %s rather than the one for this host', AIRFRAME_FILE)
+		sys.exit(2)
+
+	#-------------------------------------------------------------------------------------------
+	# The airframe is picked out first, as its profile sets the defaults the other options override
+	#-------------------------------------------------------------------------------------------
+	cli_airframe = None
+	for opt, arg in opts:
+		if opt == '--airframe':
+			cli_airframe = arg
+
+	try:
+		airframes = LoadAirframes(AIRFRAME_FILE)
+	except (IOError, OSError, ValueError), err:
+		logger.critical('Airframe profiles %s: %s', AIRFRAME_FILE, err)
 		sys.exit(2)
 
+	airframe = SelectAirframe(airframes, cli_airframe, os.uname()[1])
+	if airframe is None and cli_airframe is not None:
+		logger.critical('No airframe %s, choose one of %s', cli_airframe, ', '.join(sorted(airframes)))
+		sys.exit(2)
+
+	elif airframe is None:
+		logger.critical("Sorry, I'm not qualified to fly this quadcopter.")
+		sys.exit(0)
+
+	logger.critical("Hi, I'm %s.  Nice to meet you!", airframe.name.capitalize())
+
+	config = FlightConfig(airframe)
+
 	for opt, arg in opts:
 		if opt == '-f':
-			cli_fly = True
+			config.flying = True
+
+		elif opt == '-p':
+			config.profile_rate = float(arg)
 
 		elif opt in '-h':
-			cli_hover_target = int(arg)
+			config.hover_target = int(arg)
 			hover_target_defaulted = False
 
 		elif opt in '-v':
-			cli_video = True
+			config.shoot_video = True
 
 		elif opt in '-g':
-			cli_calibrate_gravity = True
+			config.calibrate_gravity = True
 
 		elif opt in '-m':
-			cli_motion_frequency = int(arg)
+			config.motion_frequency = int(arg)
 	
 		elif opt in '-d':
-			cli_diagnostics = True
+			config.diagnostics = True
 
 		elif opt in '-r':
-			cli_rtf_period = float(arg)
+			config.rtf_period = float(arg)
 	
 		elif opt in '-t':
-			cli_tau = float(arg)
+			config.tau = float(arg)
 	
 		elif opt in '--vvp':
-			cli_vvp_gain = float(arg)
+			config.vvp_gain = float(arg)
 
 		elif opt in '--vvi':
-			cli_vvi_gain = float(arg)
+			config.vvi_gain = float(arg)
 
 		elif opt in '--vvd':
-			cli_vvd_gain = float(arg)
+			config.vvd_gain = float(arg)
 
 		elif opt in '--hvp':
-			cli_hvp_gain = float(arg)
+			config.hvp_gain = float(arg)
 
 		elif opt in '--hvi':
-			cli_hvi_gain = float(arg)
+			config.hvi_gain = float(arg)
 
 		elif opt in '--hvd':
-			cli_hvd_gain = float(arg)
+			config.hvd_gain = float(arg)
 
 		elif opt in '--prp':
-			cli_prp_gain = float(arg)
+			config.prp_gain = float(arg)
 			prp_set = True
 
 		elif opt in '--pri':
-			cli_pri_gain = float(arg)
+			config.pri_gain = float(arg)
 			pri_set = True
 
 		elif opt in '--prd':
-			cli_prd_gain = float(arg)
+			config.prd_gain = float(arg)
 			prd_set = True
 
 		elif opt in '--rrp':
-			cli_rrp_gain = float(arg)
+			config.rrp_gain = float(arg)
 			rrp_set = True
 
 		elif opt in '--rri':
-			cli_rri_gain = float(arg)
+			config.rri_gain = float(arg)
 			rri_set = True
 
 		elif opt in '--rrd':
-			cli_rrd_gain = float(arg)
+			config.rrd_gain = float(arg)
 			rrd_set = True
 
 		elif opt in '--tc':
-			cli_test_case = int(arg)
+			config.test_case = int(arg)
 
 		elif opt in '--dlpf':
-			cli_dlpf = int(arg)
+			config.dlpf = int(arg)
+
+		elif opt in '--notiming':
+			config.stage_timing = False
+
+		elif opt in '--mp':
+			config.multi_process = True
+
+		elif opt in '--fr':
+			config.flight_recording = True
+			config.diagnostics = True
+
+		elif opt in '--udp':
+			host, port = arg.rsplit(':', 1)
+			config.udp_address = (host, int(port))
+
+		elif opt in '--udprate':
+			config.udp_rate = float(arg)
 
-	if not cli_calibrate_gravity and not cli_fly and cli_test_case == 0:
+		elif opt in '--cmd':
+			config.command_port = int(arg)
+
+		elif opt in '--fp':
+			config.flight_plan = arg
+
+		elif opt in '--pwm':
+			config.pwm_backend = arg
+
+		elif opt in '--fixed':
+			config.fixed_point = True
+
+		elif opt in '--filter':
+			config.decimation_filter = arg
+
+		elif opt in '--vib':
+			config.vibration = True
+
+		elif opt in '--raw':
+			config.raw_recording = True
+
+		elif opt in '--notch':
+			config.notch = True
+
+		elif opt in '--kf':
+			config.kalman = True
+
+		elif opt in '--aux':
+			config.aux_sensors = arg.split(',')
+
+		elif opt in '--imu':
+			for imu in arg.split(','):
+				try:
+					config.imus.append(ParseImuAddress(imu))
+				except ValueError:
+					logger.critical('IMUs must be given as [bus:]address, not %s', imu)
+					sys.exit(2)
+
+		elif opt in '--metrics':
+			if arg.isdigit():
+				config.metrics_address = int(arg)
+			else:
+				config.metrics_address = arg
+
+		elif opt in '--tune':
+			config.live_tuning = True
+
+	if not config.calibrate_gravity and not config.flying and config.test_case == 0:
 		logger.critical('Must specify one of -f, -c or --tc')
 		sys.exit(2)
 
-	elif not cli_calibrate_gravity and (cli_hover_target < 0 or cli_hover_target > 1000):
+	elif not config.calibrate_gravity and (config.hover_target < 0 or config.hover_target > 1000):
 		logger.critical('Hover speed must lie in the following range')
 		logger.critical('0 <= test speed <= 1000')
 		sys.exit(2)
 
-	elif cli_test_case == 0 and cli_fly:
+	elif config.test_case == 0 and config.flying:
 		logger.critical('Pre-flight checks passed, enjoy your flight, sir!')
 
-	elif cli_test_case == 0 and cli_calibrate_gravity:
+	elif config.test_case == 0 and config.calibrate_gravity:
 		logger.critical('Calibrate gravity is it, sir!')
-		cli_dlpf = 6
+		config.dlpf = 6
 
-	elif cli_test_case == 0:
+	elif config.test_case == 0:
 		logger.critical('You must specify flight (-f) or gravity calibration (-g)')
 		sys.exit(2)
 
-	elif cli_fly or cli_calibrate_gravity:
+	elif config.flying or config.calibrate_gravity:
 		logger.critical('Choose a specific test case (--tc) or fly (-f) or calibrate gravity (-g)')
 		sys.exit(2)
 
 	#-------------------------------------------------------------------------------------------
 	# Test case 1: Check all the blades work and spin in the right direction
+	# Test case 2: Characterise each blade's thrust for the ESC linearisation table
 	#-------------------------------------------------------------------------------------------
-	elif cli_test_case != 1:
-		logger.critical('Only testcase 1 is valid')
+	elif config.test_case != 1 and config.test_case != 2:
+		logger.critical('Only testcases 1 and 2 are valid')
 		sys.exit(2)
 
 	elif hover_target_defaulted:
 		logger.critical('You must choose a specific hover speed (-h) for all test cases.')
 		sys.exit(2)
 
+	if config.pwm_backend not in PWM_BACKENDS:
+		logger.critical('The PWM backend must be one of %s', ', '.join(sorted(PWM_BACKENDS)))
+		sys.exit(2)
+
+	if config.decimation_filter is not None and config.decimation_filter not in DECIMATION_FILTERS:
+		logger.critical('The decimation filter must be one of %s', ', '.join(sorted(DECIMATION_FILTERS)))
+		sys.exit(2)
+
+	if config.decimation_filter is not None and config.fixed_point:
+		logger.critical('Choose either a decimation filter (--filter) or fixed point integration (--fixed)')
+		sys.exit(2)
+
+	if config.profile_rate is not None and config.profile_rate <= 0:
+		logger.critical('The profiling rate must be positive')
+		sys.exit(2)
+
+	for aux_sensor in config.aux_sensors:
+		if aux_sensor not in AUX_SENSORS:
+			logger.critical('Auxiliary sensors must be from %s', ', '.join(sorted(AUX_SENSORS)))
+			sys.exit(2)
+
+	if len(config.aux_sensors) > AUX_SENSORS_MAX or sum([AUX_SENSORS[aux_sensor]().length for aux_sensor in config.aux_sensors]) > AUX_DATA_MAX:
+		logger.critical('At most %d auxiliary sensors with %d bytes of data between them', AUX_SENSORS_MAX, AUX_DATA_MAX)
+		sys.exit(2)
 
-	return cli_calibrate_gravity, cli_fly, cli_hover_target, cli_video, cli_vvp_gain, cli_vvi_gain, cli_vvd_gain, cli_hvp_gain, cli_hvi_gain, cli_hvd_gain, cli_prp_gain, cli_pri_gain, cli_prd_gain, cli_rrp_gain, cli_rri_gain, cli_rrd_gain, cli_test_case, cli_dlpf, cli_motion_frequency, cli_rtf_period, cli_tau, cli_diagnostics
+	return config
 
 ####################################################################################################
 #
@@ -1122,6 +2624,12 @@ def CleanShutdown():
 	#-------------------------------------------------------------------------------------------
 	signal.signal(signal.SIGINT, signal.SIG_IGN)
 
+	#-------------------------------------------------------------------------------------------
+	# Stop the profiler before it sees shutdown
+	#-------------------------------------------------------------------------------------------
+	if profiler is not None:
+		profiler.stop()
+
 	#-------------------------------------------------------------------------------------------
 	# Stop the blades spinning
 	#-------------------------------------------------------------------------------------------
@@ -1139,96 +2647,1684 @@ def CleanShutdown():
 	if shoot_video:
 		video.send_signal(signal.SIGINT)
 
+	#-------------------------------------------------------------------------------------------
+	# Dump the per-stage flight loop timings
+	#-------------------------------------------------------------------------------------------
+	if stage_timer is not None:
+		stage_timer.summary()
+
+	if deadline_monitor is not None:
+		deadline_monitor.summary()
+
+	if telemetry_publisher is not None:
+		telemetry_publisher.close()
+
+	pwm.summary()
+
+	if command_channel is not None:
+		command_channel.close()
+
+	if vibration_monitor is not None:
+		vibration_monitor.summary()
+
+	if velocity_estimator is not None:
+		velocity_estimator.summary()
+
+	if metrics_server is not None:
+		metrics_server.close()
+
+	if tuning is not None:
+		tuning.close()
+
 	#-------------------------------------------------------------------------------------------
 	# Record MPU6050 / i2c bus data misses.
 	#-------------------------------------------------------------------------------------------
-	mpu6050_misses, i2c_misses = mpu6050.getMisses()
+	if sensor_process is not None:
+		mpu6050_misses, i2c_misses = sensor_process.getMisses()
+	else:
+		mpu6050_misses, i2c_misses = mpu6050.getMisses()
 	logger.critical("mpu6050 %d misses, i2c %d misses", mpu6050_misses, i2c_misses)
 
 	#-------------------------------------------------------------------------------------------
-	# Copy logs from /dev/shm (shared / virtual memory) to the Logs directory.
+	# Stop the sensor process, and let the telemetry process flush before the logs are moved.
+	#-------------------------------------------------------------------------------------------
+	if sensor_process is not None:
+		logger.critical("sensor process %d frames lost", sensor_process.ring.lapped)
+		sensor_process.stop()
+
+	if imu_voter is not None:
+		imu_voter.summary()
+		for reader in imu_voter.readers:
+			reader.stop()
+
+	if telemetry_process is not None:
+		telemetry_process.stop()
+
+	#-------------------------------------------------------------------------------------------
+	# The profile summary is logged, so dump it while the log is still being offloaded
+	#-------------------------------------------------------------------------------------------
+	if profiler is not None:
+		now = datetime.now()
+		now_string = now.strftime("%y%m%d-%H:%M:%S")
+		profiler.dump("qcprofile" + now_string + ".txt")
+
+	#-------------------------------------------------------------------------------------------
+	# Finish offloading logs from /dev/shm (shared / virtual memory) to the Logs directory once
+	# the log writer has flushed everything still queued.
 	#-------------------------------------------------------------------------------------------
-	now = datetime.now()
-	now_string = now.strftime("%y%m%d-%H:%M:%S")
-	log_file_name = "qcstats" + now_string + ".csv"
-	shutil.move("/dev/shm/qclogs", log_file_name)
+	log_writer.close()
+	log_offloader.close()
+
+	if flight_recorder is not None:
+		now = datetime.now()
+		now_string = now.strftime("%y%m%d-%H:%M:%S")
+		flight_recorder.save("qcrecord" + now_string + ".bin")
+
+	if raw_recorder is not None:
+		now = datetime.now()
+		now_string = now.strftime("%y%m%d-%H:%M:%S")
+		raw_recorder.save("qcraw" + now_string + ".bin")
 
 	#-------------------------------------------------------------------------------------------
 	# Clean up PWM / GPIO
 	#-------------------------------------------------------------------------------------------
+	pwm.cleanup()
 	RpioCleanup()
 
-	#-------------------------------------------------------------------------------------------
-	# Unlock memory we've used from RAM
-	#-------------------------------------------------------------------------------------------
-	munlockall()
+	#-------------------------------------------------------------------------------------------
+	# Unlock memory we've used from RAM
+	#-------------------------------------------------------------------------------------------
+	munlockall()
+
+	#-------------------------------------------------------------------------------------------
+	# Reset the signal handler to default
+	#-------------------------------------------------------------------------------------------
+	signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+	sys.exit(0)
+
+####################################################################################################
+#
+# Signal handler for Ctrl-C => abort cleanly
+#
+####################################################################################################
+def SignalHandler(signal, frame):
+	global keep_looping
+
+	if loop_count > 0:
+		keep_looping = False
+	else:
+		CleanShutdown()
+
+####################################################################################################
+#
+# Flight plan management
+#
+# A flight plan is a sequence of segments, each a name, a duration (s) and the earth frame velocity
+# targets (m/s) flown for that duration, read from a file by --fp or defaulting to the plan below.
+# Each line of a plan file is one segment, and anything after a '#' is a comment:
+#
+#     # name     time    evx    evy    evz    interpolation
+#     ASCENT     2.0     0.0    0.0    0.5    linear
+#
+# The optional interpolation says how the targets get to the next segment's over this segment's
+# duration: "step" (the default) holds them then jumps, "linear" ramps, and "cubic" eases in and out
+# with no sudden change in rate at either end.  The last segment is what's flown as the plan
+# completes and the flight loop ends, so conventionally it's a zero length STOP.
+#
+# The plan is compiled once into arrays indexed by segment, with the cumulative end times sorted for
+# bisect, so finding the current segment costs the same for a survey of thousands of segments as for
+# the default five.
+#
+####################################################################################################
+FP_STEP   = 0
+FP_LINEAR = 1
+FP_CUBIC  = 2
+FP_INTERPOLATIONS = {"step": FP_STEP, "linear": FP_LINEAR, "cubic": FP_CUBIC}
+
+class FlightPlan:
+
+	#-------------------------------------------------------------------------------------------
+	# The default flight plan
+	#-------------------------------------------------------------------------------------------
+	_DEFAULT_PLAN = [("RTF",     0.0, 0.0, 0.0,  0.0, FP_STEP),
+			 ("ASCENT",  2.0, 0.0, 0.0,  0.5, FP_STEP),
+			 ("HOVER",   5.0, 0.0, 0.0,  0.0, FP_STEP),
+			 ("DESCENT", 2.0, 0.0, 0.0, -0.5, FP_STEP),
+			 ("STOP",    0.0, 0.0, 0.0,  0.0, FP_STEP)]
+
+	#-------------------------------------------------------------------------------------------
+	# Limit on a plan file's velocity targets (m/s), as for ground station overrides
+	#-------------------------------------------------------------------------------------------
+	_MAX_VELOCITY = 1.0
+
+	def __init__(self, file_name = None):
+		if file_name is None:
+			segments = self._DEFAULT_PLAN
+		else:
+			segments = self.load(file_name)
+
+		#-----------------------------------------------------------------------------------
+		# Compile the segments: cumulative start / end times, the targets at the start of each
+		# segment, and the change in targets over it if interpolating to the next one.
+		#-----------------------------------------------------------------------------------
+		self.fp_steps = len(segments)
+		self.fp_name = [name for name, duration, evx, evy, evz, interpolation in segments]
+		self.fp_start = array('d', [0.0] * self.fp_steps)
+		self.fp_end = array('d', [0.0] * self.fp_steps)
+		self.fp_evx_target = array('d', [segment[2] for segment in segments])
+		self.fp_evy_target = array('d', [segment[3] for segment in segments])
+		self.fp_evz_target = array('d', [segment[4] for segment in segments])
+		self.fp_evx_delta = array('d', [0.0] * self.fp_steps)
+		self.fp_evy_delta = array('d', [0.0] * self.fp_steps)
+		self.fp_evz_delta = array('d', [0.0] * self.fp_steps)
+		self.fp_interpolation = array('B', [segment[5] for segment in segments])
+
+		fp_total_time = 0.0
+		for fp_index, (name, duration, evx, evy, evz, interpolation) in enumerate(segments):
+			self.fp_start[fp_index] = fp_total_time
+			fp_total_time += duration
+			self.fp_end[fp_index] = fp_total_time
+
+			if interpolation != FP_STEP and fp_index + 1 < self.fp_steps:
+				self.fp_evx_delta[fp_index] = segments[fp_index + 1][2] - evx
+				self.fp_evy_delta[fp_index] = segments[fp_index + 1][3] - evy
+				self.fp_evz_delta[fp_index] = segments[fp_index + 1][4] - evz
+			else:
+				self.fp_interpolation[fp_index] = FP_STEP
+
+		self.fp_index = 0
+		self.fp_prev_index = 0
+		self.start_time = 0.0
+
+
+	def load(self, file_name):
+		#-----------------------------------------------------------------------------------
+		# Parse a plan file into segments, raising ValueError naming the first bad line
+		#-----------------------------------------------------------------------------------
+		segments = []
+		with open(file_name, 'r') as plan_file:
+			for line_number, line in enumerate(plan_file, 1):
+				fields = line.split('#', 1)[0].split()
+				if len(fields) == 0:
+					continue
+
+				if len(fields) not in (5, 6):
+					raise ValueError("line %d: expected name, time, evx, evy, evz [, interpolation]" % line_number)
+
+				try:
+					duration, evx, evy, evz = [float(field) for field in fields[1:5]]
+				except ValueError:
+					raise ValueError("line %d: time and targets must be numbers" % line_number)
+
+				if not duration >= 0.0 or math.isinf(duration):
+					raise ValueError("line %d: time must be finite and not negative" % line_number)
+
+				for target in (evx, evy, evz):
+					if not -self._MAX_VELOCITY <= target <= self._MAX_VELOCITY:
+						raise ValueError("line %d: targets must lie in +/-%.1f m/s" % (line_number, self._MAX_VELOCITY))
+
+				interpolation = fields[5] if len(fields) == 6 else "step"
+				if interpolation not in FP_INTERPOLATIONS:
+					raise ValueError("line %d: interpolation must be one of %s" % (line_number, ", ".join(sorted(FP_INTERPOLATIONS))))
+
+				segments.append((fields[0], duration, evx, evy, evz, FP_INTERPOLATIONS[interpolation]))
+
+		if len(segments) == 0:
+			raise ValueError("no segments")
+
+		return segments
+
+
+	def start(self, time_now):
+		self.fp_index = 0
+		self.fp_prev_index = 0
+		self.start_time = time_now
+
+
+	def getTargets(self, time_now):
+		global keep_looping
+
+		elapsed_time = time_now - self.start_time
+
+		#-----------------------------------------------------------------------------------
+		# Time only moves forwards, so the current segment usually hasn't changed since the
+		# last call, and when it has, bisect on from there.  Zero length segments are skipped.
+		#-----------------------------------------------------------------------------------
+		fp_index = self.fp_index
+		if elapsed_time >= self.fp_end[fp_index]:
+			fp_index = bisect.bisect_right(self.fp_end, elapsed_time, fp_index)
+			if fp_index == self.fp_steps:
+				keep_looping = False
+				fp_index = self.fp_steps - 1
+			self.fp_index = fp_index
+
+		evx_target = self.fp_evx_target[fp_index]
+		evy_target = self.fp_evy_target[fp_index]
+		evz_target = self.fp_evz_target[fp_index]
+
+		interpolation = self.fp_interpolation[fp_index]
+		if interpolation != FP_STEP and elapsed_time < self.fp_end[fp_index]:
+			fraction = (elapsed_time - self.fp_start[fp_index]) / (self.fp_end[fp_index] - self.fp_start[fp_index])
+			if interpolation == FP_CUBIC:
+				fraction = fraction * fraction * (3.0 - 2.0 * fraction)
+
+			evx_target += self.fp_evx_delta[fp_index] * fraction
+			evy_target += self.fp_evy_delta[fp_index] * fraction
+			evz_target += self.fp_evz_delta[fp_index] * fraction
+
+		if fp_index != self.fp_prev_index:
+			logger.critical("%s", self.fp_name[fp_index])
+			self.fp_prev_index = fp_index
+
+		return evx_target, evy_target, evz_target
+
+####################################################################################################
+#
+# Hot loop timing probes - each stage of the flight loop feeds a fixed bucket histogram held in
+# preallocated arrays so recording a timing never allocates.
+#
+####################################################################################################
+STAGE_SENSOR_WAIT    = 0
+STAGE_I2C_READ       = 1
+STAGE_INTEGRATION    = 2
+STAGE_RAW_CORRECTION = 3
+STAGE_FUSION         = 4
+STAGE_FLIGHT_PLAN    = 5
+STAGE_VELOCITY       = 6
+STAGE_HEATER         = 7
+STAGE_PIDS           = 8
+STAGE_ESC_UPDATE     = 9
+STAGE_DIAGNOSTICS    = 10
+STAGE_NAMES = ["sensor wait", "i2c read", "integration", "rawCorrection", "fusion", "flight plan", "velocity", "heater", "pids", "esc update", "diagnostics"]
+
+class StageTimer:
+
+	#-------------------------------------------------------------------------------------------
+	# 10us buckets up to 10ms; anything longer lands in the final overflow bucket
+	#-------------------------------------------------------------------------------------------
+	_BUCKET_WIDTH = 0.00001
+	_NUM_BUCKETS = 1000
+
+	def __init__(self, stage_names):
+		self.stage_names = stage_names
+		self.num_stages = len(stage_names)
+
+		self.histogram = array('L', [0] * (self.num_stages * self._NUM_BUCKETS))
+		self.counts = array('L', [0] * self.num_stages)
+		self.total_time = array('d', [0.0] * self.num_stages)
+		self.max_time = array('d', [0.0] * self.num_stages)
+
+	def record(self, stage, elapsed):
+		bucket = int(elapsed / self._BUCKET_WIDTH)
+		if bucket < 0:
+			bucket = 0
+		elif bucket >= self._NUM_BUCKETS:
+			bucket = self._NUM_BUCKETS - 1
+
+		self.histogram[stage * self._NUM_BUCKETS + bucket] += 1
+		self.counts[stage] += 1
+		self.total_time[stage] += elapsed
+		if elapsed > self.max_time[stage]:
+			self.max_time[stage] = elapsed
+
+	def lap(self, stage, start):
+		#-----------------------------------------------------------------------------------
+		# Record the time since start against this stage, and return now as the start of the
+		# next stage.
+		#-----------------------------------------------------------------------------------
+		now = time.time()
+		self.record(stage, now - start)
+		return now
+
+	def percentile(self, stage, fraction):
+		count = self.counts[stage]
+		if count == 0:
+			return 0.0
+
+		threshold = fraction * count
+		cumulative = 0
+		base = stage * self._NUM_BUCKETS
+		for bucket in range(0, self._NUM_BUCKETS):
+			cumulative += self.histogram[base + bucket]
+			if cumulative >= threshold:
+				break
+
+		#-----------------------------------------------------------------------------------
+		# Report the bucket's upper edge, but never more than the actual worst case seen; the
+		# overflow bucket has no upper edge so that's reported as the worst case.
+		#-----------------------------------------------------------------------------------
+		if bucket == self._NUM_BUCKETS - 1:
+			return self.max_time[stage]
+		return min((bucket + 1) * self._BUCKET_WIDTH, self.max_time[stage])
+
+	def summary(self):
+		logger.critical("%-16s %10s %10s %10s %10s %10s", "stage (us)", "count", "mean", "p50", "p99", "max")
+		for stage in range(0, self.num_stages):
+			count = self.counts[stage]
+			if count == 0:
+				continue
+			logger.critical("%-16s %10d %10.1f %10.1f %10.1f %10.1f", self.stage_names[stage], count,
+					self.total_time[stage] * 1000000 / count,
+					self.percentile(stage, 0.50) * 1000000,
+					self.percentile(stage, 0.99) * 1000000,
+					self.max_time[stage] * 1000000)
+
+####################################################################################################
+#
+# Motion processing deadline monitor - spots motion periods finishing late and sheds load in a fixed
+# order to keep the inner attitude loop on schedule: diagnostics first, then the outer velocity / yaw
+# angle loops run at a lower rate, and finally the heater stops being updated.
+#
+####################################################################################################
+DEGRADE_NONE        = 0
+DEGRADE_DIAGNOSTICS = 1
+DEGRADE_OUTER_LOOP  = 2
+DEGRADE_HEATER      = 3
+DEGRADE_NAMES = ["normal", "diagnostics dropped", "outer loops halved", "heater skipped"]
+
+class DeadlineMonitor:
+
+	#-------------------------------------------------------------------------------------------
+	# Escalate after _OVERRUN_LIMIT late periods within _OVERRUN_WINDOW periods; recover one
+	# level after _RECOVERY_TIME seconds without an overrun; give up on catching up and resync
+	# the schedule once _MAX_BACKLOG whole periods behind.
+	#-------------------------------------------------------------------------------------------
+	_OVERRUN_WINDOW = 10
+	_OVERRUN_LIMIT = 3
+	_RECOVERY_TIME = 2.0
+	_MAX_BACKLOG = 3
+
+	def __init__(self, motion_period, now):
+		self.motion_period = motion_period
+		self.start_time = now
+		self.level = DEGRADE_NONE
+
+		self.window_periods = 0
+		self.window_overruns = 0
+		self.last_overrun = now
+
+		self.overruns = 0
+		self.resyncs = 0
+		self.max_lateness = 0.0
+
+	def check(self, scheduled, now):
+		#-----------------------------------------------------------------------------------
+		# scheduled is the time this motion period should have started; by the time the next
+		# one is due, this one must be finished.
+		#-----------------------------------------------------------------------------------
+		lateness = now - scheduled
+		if lateness > self.max_lateness:
+			self.max_lateness = lateness
+
+		self.window_periods += 1
+		if lateness > self.motion_period:
+			self.overruns += 1
+			self.window_overruns += 1
+			self.last_overrun = now
+
+			#---------------------------------------------------------------------------
+			# Too far behind to ever catch up, so drop the missed periods rather than running
+			# a burst of back-to-back motion processing.
+			#---------------------------------------------------------------------------
+			if lateness > self._MAX_BACKLOG * self.motion_period:
+				self.resyncs += 1
+				logger.critical("%f: deadline backlog %d periods, resync", now - self.start_time, int(lateness / self.motion_period))
+				scheduled = now
+
+		if self.window_periods == self._OVERRUN_WINDOW:
+			if self.window_overruns >= self._OVERRUN_LIMIT and self.level < DEGRADE_HEATER:
+				self.level += 1
+				logger.critical("%f: deadline overruns %d / %d, degrade to %s", now - self.start_time, self.window_overruns, self.window_periods, DEGRADE_NAMES[self.level])
+			self.window_periods = 0
+			self.window_overruns = 0
+
+		if self.level > DEGRADE_NONE and now - self.last_overrun > self._RECOVERY_TIME:
+			self.level -= 1
+			self.last_overrun = now
+			logger.critical("%f: deadline recovered, restore to %s", now - self.start_time, DEGRADE_NAMES[self.level])
+
+		return scheduled, self.level
+
+	def summary(self):
+		logger.critical("deadline overruns %d, resyncs %d, max lateness %fs", self.overruns, self.resyncs, self.max_lateness)
+
+####################################################################################################
+#
+# Single writer, single reader ring buffer of fixed size records in an mmap'd /dev/shm file.  The
+# header holds the count of records written so far; a record is published by packing it into its
+# slot before bumping that count, so a reader never needs a lock, just a check afterwards that the
+# writer hasn't lapped it while it was reading.  Created before a fork, both processes share it.
+# An optional preamble between the header and the records lets the file describe itself.
+#
+####################################################################################################
+class ShmRing:
+
+	#-------------------------------------------------------------------------------------------
+	# 32 bits so the Pi updates the record count in a single store
+	#-------------------------------------------------------------------------------------------
+	_HEADER = struct.Struct('=I')
+
+	def __init__(self, name, record_format, slots, preamble=''):
+		self.record = struct.Struct(record_format)
+		self.slots = slots
+		self.file_name = "/dev/shm/" + name
+		self.base = self._HEADER.size + len(preamble)
+
+		size = self.base + self.record.size * slots
+		shm_fd = os.open(self.file_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0600)
+		os.ftruncate(shm_fd, size)
+		self.shm = mmap.mmap(shm_fd, size)
+		os.close(shm_fd)
+
+		self.shm[self._HEADER.size:self.base] = preamble
+
+		self.write_seq = 0
+		self.read_seq = 0
+		self.lapped = 0
+
+	def write(self, *values):
+		self.record.pack_into(self.shm, self.base + (self.write_seq % self.slots) * self.record.size, *values)
+		self.write_seq += 1
+		self._HEADER.pack_into(self.shm, 0, self.write_seq)
+
+	def read(self):
+		write_seq = self._HEADER.unpack_from(self.shm, 0)[0]
+		if write_seq == self.read_seq:
+			return None
+
+		#-----------------------------------------------------------------------------------
+		# The slot after the newest record may be mid-write, so anything older than that has
+		# been lost.
+		#-----------------------------------------------------------------------------------
+		if write_seq - self.read_seq >= self.slots:
+			self.lapped += write_seq - self.read_seq - self.slots + 1
+			self.read_seq = write_seq - self.slots + 1
+
+		values = self.record.unpack_from(self.shm, self.base + (self.read_seq % self.slots) * self.record.size)
+
+		#-----------------------------------------------------------------------------------
+		# Check the writer didn't get round to this slot while we were unpacking it.
+		#-----------------------------------------------------------------------------------
+		write_seq = self._HEADER.unpack_from(self.shm, 0)[0]
+		self.read_seq += 1
+		if write_seq - self.read_seq >= self.slots - 1:
+			self.lapped += 1
+			return None
+
+		return values
+
+	def close(self):
+		self.shm.close()
+		try:
+			os.unlink(self.file_name)
+		except OSError:
+			pass
+
+####################################################################################################
+#
+# Sensor acquisition process: a forked child owns the I2C bus and data ready interrupt, and streams
+# raw sensor frames to the flight loop through a ShmRing.  A byte down a pipe per frame is the
+# doorbell that lets the flight loop block until data arrives instead of spinning.  The pipe is also
+# the liveness check: if the child dies its end closes, and if it hangs no frame arrives within
+# _LIVENESS_TIMEOUT, and either way the flight is shut down cleanly rather than left waiting with
+# the motors at their last speeds.  The child owns the MPU6050 and I2C miss counts too, so each
+# frame carries them for getMisses().
+#
+####################################################################################################
+class SensorProcess:
+
+	_FRAME_FORMAT = '=dhhhhhhhII'
+	_FRAME_SLOTS = 64
+	_LIVENESS_TIMEOUT = 0.1
+
+	def __init__(self, mpu6050):
+		self.aux = len(mpu6050.aux_fields) > 0
+		self.mpu6050_misses = 0
+		self.i2c_misses = 0
+		self.ring = ShmRing("qcsensors", self._FRAME_FORMAT + ''.join([code for field, code in mpu6050.aux_fields]), self._FRAME_SLOTS)
+		self.doorbell, doorbell = os.pipe()
+		fcntl.fcntl(doorbell, fcntl.F_SETFL, os.O_NONBLOCK)
+
+		self.pid = os.fork()
+		if self.pid == 0:
+			os.close(self.doorbell)
+			self.acquire(mpu6050, doorbell)
+
+		os.close(doorbell)
+
+	def acquire(self, mpu6050, doorbell):
+		#-----------------------------------------------------------------------------------
+		# Child only: Ctrl-C is for the flight loop, which then stops us with SIGTERM.  Memory
+		# locks are not inherited across fork.
+		#-----------------------------------------------------------------------------------
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		try:
+			mlockall()
+			while True:
+				ax, ay, az, gx, gy, gz = mpu6050.readSensorsRaw()
+				mpu6050_misses, i2c_misses = mpu6050.getMisses()
+				self.ring.write(time_now, temp_now, ax, ay, az, gx, gy, gz, mpu6050_misses, i2c_misses, *aux_now)
+				try:
+					os.write(doorbell, '\0')
+				except OSError:
+					pass
+		finally:
+			os._exit(0)
+
+	def readSensorsRaw(self):
+		global time_now
+		global temp_now
+		global aux_now
+		global time_ready
+
+		#-----------------------------------------------------------------------------------
+		# Wait for the doorbell only if there's no frame already waiting.
+		#-----------------------------------------------------------------------------------
+		frame = self.ring.read()
+		while frame is None:
+			readable, writable, exceptional = select.select([self.doorbell], [], [], self._LIVENESS_TIMEOUT)
+			if not readable:
+				logger.critical("sensor process sent nothing for %fs, shutting down", self._LIVENESS_TIMEOUT)
+				CleanShutdown()
+
+			if os.read(self.doorbell, 4096) == '':
+				logger.critical("sensor process died, shutting down")
+				CleanShutdown()
+
+			frame = self.ring.read()
+
+		if stage_timing:
+			time_ready = time.time()
+
+		if self.aux:
+			aux_now = frame[10:]
+			frame = frame[:10]
+
+		[time_now, temp_now, ax, ay, az, gx, gy, gz, self.mpu6050_misses, self.i2c_misses] = frame
+		return ax, ay, az, gx, gy, gz
+
+	def getMisses(self):
+		return self.mpu6050_misses, self.i2c_misses
+
+	def stop(self):
+		os.kill(self.pid, signal.SIGTERM)
+		os.waitpid(self.pid, 0)
+		os.close(self.doorbell)
+		self.ring.close()
+
+####################################################################################################
+#
+# Extra IMUs for redundancy.  Each further MPU6050 on another I2C bus is read by its own forked
+# process into a ShmRing, so reads on different buses overlap with each other and with the
+# primary's.  One on the primary's bus, e.g. at 0x69, can't overlap with it, and polling it from a
+# process would only contend with the primary's reads, so it's read in the flight loop instead,
+# straight after each primary sample.  Without their own data ready interrupt wired up, the readers
+# poll, reading INT_STATUS in the same burst as the data to tell a new sample from a repeat.  Frames
+# are time stamped as read, and mapped through each IMU's own calibration onto the primary's, so all
+# the IMUs' raw values are comparable:
+#
+#     accelerometer   a * gain / primary gain + offset * gain / primary gain - primary offset
+#     gyro            g - offset + primary offset
+#
+####################################################################################################
+IMU_POLL_INTERVAL = 0.0002
+IMU_MAX_SKEW = 0.0015
+
+def ParseImuAddress(imu):
+	#-------------------------------------------------------------------------------------------
+	# "[bus:]address" to (bus, address), the bus defaulting to the primary's; raises ValueError
+	#-------------------------------------------------------------------------------------------
+	if ':' in imu:
+		bus, address = imu.split(':')
+		return int(bus), int(address, 0)
+	return 1, int(imu, 0)
+
+class ImuReader:
+
+	_FRAME_FORMAT = '=dhhhhhh'
+	_FRAME_SLOTS = 64
+
+	def __init__(self, bus, address, imu, primary):
+		self.name = "%d:0x%02x" % (bus, address)
+		self.bus = bus
+		self.imu = imu
+		self.inline = bus == primary.bus
+
+		#-----------------------------------------------------------------------------------
+		# Scale then add to this IMU's raw values to match the primary's calibration
+		#-----------------------------------------------------------------------------------
+		self.scales = (imu.ax_gain / primary.ax_gain,
+			       imu.ay_gain / primary.ay_gain,
+			       imu.az_gain / primary.az_gain)
+		self.deltas = (imu.ax_offset * self.scales[0] - primary.ax_offset,
+			       imu.ay_offset * self.scales[1] - primary.ay_offset,
+			       imu.az_offset * self.scales[2] - primary.az_offset,
+			       primary.gx_offset - imu.gx_offset,
+			       primary.gy_offset - imu.gy_offset,
+			       primary.gz_offset - imu.gz_offset)
+
+		self.frame = None
+		self.lost = 0
+		if self.inline:
+			return
+
+		self.ring = ShmRing("qcimu%d-%02x" % (bus, address), self._FRAME_FORMAT, self._FRAME_SLOTS)
+		self.pid = os.fork()
+		if self.pid == 0:
+			self.acquire(imu)
+
+	def acquire(self, imu):
+		#-----------------------------------------------------------------------------------
+		# Child only: as SensorProcess, plus a bus handle of our own so the I2C slave address
+		# isn't shared with the parent.
+		#-----------------------------------------------------------------------------------
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		try:
+			mlockall()
+			imu.i2c.bus = smbus.SMBus(self.bus)
+			while True:
+				frame = imu.pollSensorsRaw()
+				if frame is None:
+					time.sleep(IMU_POLL_INTERVAL)
+					continue
+				self.ring.write(time.time(), *self.mapFrame(frame))
+		finally:
+			os._exit(0)
+
+	def mapFrame(self, frame):
+		ax, ay, az, gx, gy, gz = frame
+		sax, say, saz = self.scales
+		dax, day, daz, dgx, dgy, dgz = self.deltas
+		return (min(max(int(round(ax * sax + dax)), -32768), 32767),
+			min(max(int(round(ay * say + day)), -32768), 32767),
+			min(max(int(round(az * saz + daz)), -32768), 32767),
+			min(max(int(round(gx + dgx)), -32768), 32767),
+			min(max(int(round(gy + dgy)), -32768), 32767),
+			min(max(int(round(gz + dgz)), -32768), 32767))
+
+	def latest(self):
+		#-----------------------------------------------------------------------------------
+		# The newest frame, or the last one again if nothing new has arrived
+		#-----------------------------------------------------------------------------------
+		if self.inline:
+			frame = self.imu.pollSensorsRaw()
+			if frame is not None:
+				self.frame = (time.time(),) + self.mapFrame(frame)
+			return self.frame
+
+		frame = self.ring.read()
+		while frame is not None:
+			self.frame = frame
+			frame = self.ring.read()
+		self.lost = self.ring.lapped
+		return self.frame
+
+	def stop(self):
+		if self.inline:
+			return
+
+		os.kill(self.pid, signal.SIGTERM)
+		os.waitpid(self.pid, 0)
+		self.ring.close()
+
+####################################################################################################
+#
+# IMU voting: each primary sample is matched with the other IMUs' newest frames, any more than
+# IMU_MAX_SKEW apart in time being left out as stale.  Each axis is then the median of what's left,
+# with values more than IMU_OUTLIER_LIMITS from it counted as outliers against their IMU.  With just
+# two, they're averaged if they agree, and if not, the one nearer the last voted value wins.  The
+# result stays in raw integers, like a single IMU's.
+#
+####################################################################################################
+IMU_OUTLIER_LIMITS = (2000, 2000, 2000, 500, 500, 500)
+
+class ImuVoter:
+
+	def __init__(self, readers):
+		self.readers = readers
+		self.names = ["primary"] + [reader.name for reader in readers]
+		self.last = [0, 0, 0, 0, 0, 0]
+
+		#-----------------------------------------------------------------------------------
+		# Health counters per IMU, the primary first
+		#-----------------------------------------------------------------------------------
+		self.used = [0] * len(self.names)
+		self.stale = [0] * len(self.names)
+		self.outliers = [0] * len(self.names)
+
+	def vote(self, sample_time, ax, ay, az, gx, gy, gz):
+		frames = [(0, (ax, ay, az, gx, gy, gz))]
+		index = 1
+		for reader in self.readers:
+			frame = reader.latest()
+			if frame is None or abs(frame[0] - sample_time) > IMU_MAX_SKEW:
+				self.stale[index] += 1
+			else:
+				frames.append((index, frame[1:]))
+			index += 1
+
+		for index, frame in frames:
+			self.used[index] += 1
+
+		voted = self.voteFrames(frames)
+		return voted[0], voted[1], voted[2], voted[3], voted[4], voted[5]
+
+	def voteFrames(self, frames):
+		voted = self.last
+		if len(frames) == 1:
+			voted[0], voted[1], voted[2], voted[3], voted[4], voted[5] = frames[0][1]
+
+		elif len(frames) == 2:
+			(index_a, frame_a), (index_b, frame_b) = frames
+			for axis in range(0, 6):
+				value_a = frame_a[axis]
+				value_b = frame_b[axis]
+				if abs(value_a - value_b) <= IMU_OUTLIER_LIMITS[axis]:
+					voted[axis] = (value_a + value_b) // 2
+				elif abs(value_a - voted[axis]) <= abs(value_b - voted[axis]):
+					voted[axis] = value_a
+					self.outliers[index_b] += 1
+				else:
+					voted[axis] = value_b
+					self.outliers[index_a] += 1
+
+		else:
+			middle = len(frames) // 2
+			for axis in range(0, 6):
+				values = sorted([frame[axis] for index, frame in frames])
+				if len(values) % 2:
+					median = values[middle]
+				else:
+					median = (values[middle - 1] + values[middle]) // 2
+				voted[axis] = median
+
+				for index, frame in frames:
+					if abs(frame[axis] - median) > IMU_OUTLIER_LIMITS[axis]:
+						self.outliers[index] += 1
+
+		return voted
+
+	def benchmark(self, primary, samples):
+		#-----------------------------------------------------------------------------------
+		# Per sample cost in microseconds of what vote() adds to the flight loop - gathering
+		# the other IMUs' frames, including the I2C reads of any on the primary's bus, and the
+		# vote itself - measured over samples real primary samples.  The primary's own read
+		# isn't counted, and the counters are reset afterwards.
+		#-----------------------------------------------------------------------------------
+		imus = len(self.names)
+		vote_time = 0.0
+		for sample in range(0, samples):
+			ax, ay, az, gx, gy, gz = primary.readSensorsRaw()
+			start = time.time()
+			self.vote(time_now, ax, ay, az, gx, gy, gz)
+			vote_time += time.time() - start
+
+		self.last = [0, 0, 0, 0, 0, 0]
+		self.used = [0] * imus
+		self.stale = [0] * imus
+		self.outliers = [0] * imus
+		return vote_time * 1000000 / samples
+
+	def summary(self):
+		for index, name in enumerate(self.names):
+			logger.critical("imu %s: %d used, %d stale, %d outliers", name, self.used[index], self.stale[index], self.outliers[index])
+		for reader in self.readers:
+			logger.critical("imu %s: %d frames lost", reader.name, reader.lost)
+
+####################################################################################################
+#
+# Diagnostics, one set per motion period, declared once as (name, struct code) pairs.  From this come
+# the header line, the text format applied to the values as a flat tuple, and the packed binary
+# record used by the telemetry process and the flight recorder.  The schema ends with one spin
+# column per ESC, so it's completed for the frame layout at startup by DiagnosticsSchema(), the
+# columns named by the initials of each ESC, e.g. FL spin.
+#
+####################################################################################################
+DIAGNOSTICS_SCHEMA = [
+	("time", 'd'), ("dt", 'f'), ("loop", 'I'), ("temp", 'f'), ("temp_raw", 'h'), ("tpp", 'f'), ("tpi", 'f'), ("tpd", 'f'),
+	("qgx", 'f'), ("qgy", 'f'), ("qgz", 'f'), ("qax", 'f'), ("qay", 'f'), ("qaz", 'f'), ("efrgv_x", 'f'), ("efrgv_y", 'f'),
+	("efrgv_z", 'f'), ("qfrgv_x", 'f'), ("qfrgv_y", 'f'), ("qfrgv_z", 'f'), ("qvx_input", 'f'), ("qvy_input", 'f'), ("qvz_input", 'f'), ("epa", 'f'),
+	("era", 'f'), ("eta", 'f'), ("pa", 'f'), ("ra", 'f'), ("ya", 'f'), ("evx_target", 'f'), ("qvx_target", 'f'), ("qxp", 'f'),
+	("qxi", 'f'), ("qxd", 'f'), ("pr_target", 'f'), ("prp", 'f'), ("pri", 'f'), ("prd", 'f'), ("pr_out", 'i'), ("evy_yarget", 'f'),
+	("qvy_target", 'f'), ("qyp", 'f'), ("qyi", 'f'), ("qyd", 'f'), ("rr_target", 'f'), ("rrp", 'f'), ("rri", 'f'), ("rrd", 'f'),
+	("rr_out", 'i'), ("evz_target", 'f'), ("qvz_target", 'f'), ("qzp", 'f'), ("qzi", 'f'), ("qzd", 'f'), ("qvz_out", 'f'), ("yr_target", 'f'),
+	("yrp", 'f'), ("yri", 'f'), ("yrd", 'f'), ("yr_out", 'i')]
+
+def DiagnosticsSchema(esc_list):
+	return DIAGNOSTICS_SCHEMA + [(''.join([word[0].upper() for word in esc.name.split()]) + " spin", 'H') for esc in esc_list]
+
+def DiagnosticsFormat(schema):
+	return ', '.join([('%f' if code in 'fd' else '%d') for name, code in schema])
+
+#---------------------------------------------------------------------------------------------------
+# Raw sensor samples recorded with --raw, a little over a minute of them at 1kHz
+#---------------------------------------------------------------------------------------------------
+RAW_SAMPLES_SCHEMA = [("time", 'd'), ("qax", 'h'), ("qay", 'h'), ("qaz", 'h'), ("qgx", 'h'), ("qgy", 'h'), ("qgz", 'h')]
+RAW_SAMPLES_SLOTS = 65536
+
+####################################################################################################
+#
+# Telemetry writer process: the flight loop packs each set of diagnostics into a ShmRing,
+# and a forked child does the text formatting and file I/O.  Closing the doorbell pipe tells the
+# child to drain what's left and exit.
+#
+####################################################################################################
+class TelemetryProcess:
+
+	_RECORD_SLOTS = 256
+
+	def __init__(self, file_name, schema):
+		self.ring = ShmRing("qctelemetry", '=' + ''.join([code for name, code in schema]), self._RECORD_SLOTS)
+		self.format = DiagnosticsFormat(schema)
+		doorbell, self.doorbell = os.pipe()
+		fcntl.fcntl(self.doorbell, fcntl.F_SETFL, os.O_NONBLOCK)
+
+		self.pid = os.fork()
+		if self.pid == 0:
+			os.close(self.doorbell)
+			self.drain(doorbell, file_name)
+
+		os.close(doorbell)
+
+	def drain(self, doorbell, file_name):
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		try:
+			#---------------------------------------------------------------------------
+			# O_APPEND so each line lands intact after whatever the flight loop's own
+			# logger has written.
+			#---------------------------------------------------------------------------
+			log_fd = os.open(file_name, os.O_WRONLY | os.O_APPEND)
+			while True:
+				more = os.read(doorbell, 4096)
+				values = self.ring.read()
+				while values is not None:
+					os.write(log_fd, "[WARNING] (telemetry ) diagnostics, " + self.format % values + "\n")
+					values = self.ring.read()
+				if not more:
+					break
+
+			if self.ring.lapped > 0:
+				os.write(log_fd, "[CRITICAL] (telemetry ) diagnostics, %d records lost\n" % self.ring.lapped)
+			os.close(log_fd)
+		finally:
+			os._exit(0)
+
+	def log(self, *values):
+		self.ring.write(*values)
+		try:
+			os.write(self.doorbell, '\0')
+		except OSError:
+			pass
+
+	def stop(self):
+		os.close(self.doorbell)
+		os.waitpid(self.pid, 0)
+		self.ring.close()
+
+####################################################################################################
+#
+# Binary flight recorder: each set of diagnostics is packed as one fixed size record into a ShmRing
+# that overwrites the oldest records once full, so recording costs a single struct pack and memory
+# use is capped.  The schema is written into the file's preamble so qcrecord.py can convert it to
+# CSV / NumPy offline without needing this code.  The same recorder with RAW_SAMPLES_SCHEMA keeps
+# every raw sensor sample for qcspectrum.py.
+#
+####################################################################################################
+class FlightRecorder:
+
+	_MAGIC = 'QCFR'
+	_PREAMBLE = struct.Struct('=4sII')
+	_RECORD_SLOTS = 16384
+
+	def __init__(self, name, record_schema, slots = _RECORD_SLOTS):
+		schema = ','.join(['%s:%s' % (field, code) for field, code in record_schema])
+		preamble = self._PREAMBLE.pack(self._MAGIC, slots, len(schema)) + schema
+		self.ring = ShmRing(name, '=' + ''.join([code for field, code in record_schema]), slots, preamble)
+
+	def log(self, *values):
+		self.ring.write(*values)
+
+	def save(self, file_name):
+		#-----------------------------------------------------------------------------------
+		# Trim the unused slots of a ring that never wrapped so they aren't copied to disk.
+		#-----------------------------------------------------------------------------------
+		used = self.ring.base + min(self.ring.write_seq, self.ring.slots) * self.ring.record.size
+		self.ring.shm.flush()
+		self.ring.shm.close()
+		with open(self.ring.file_name, 'r+b') as record_file:
+			record_file.truncate(used)
+		shutil.move(self.ring.file_name, file_name)
+
+####################################################################################################
+#
+# Live telemetry: a decimated stream of compact binary packets over UDP.  The packet buffer is
+# preallocated and the socket non-blocking, so a published period costs one pack_into and one sendto,
+# and a missing or slow receiver just counts as drops.  Each packet carries the motor count and
+# every ESC's pulse width in the frame layout's order, so quad, hex and octo frames all fit.
+# qctelemetry.py decodes and displays it.
+#
+####################################################################################################
+class TelemetryPublisher:
+
+	#-------------------------------------------------------------------------------------------
+	# magic, sequence, elapsed time, pitch / roll / yaw angles (degrees), quad frame velocities,
+	# pitch / roll / yaw rate PID outputs, vertical velocity PID output, temperature (oC), loop
+	# count, motion period, deadline degradation level, motor count, then that many pulse widths
+	#-------------------------------------------------------------------------------------------
+	_MAGIC = 'QCT2'
+	_HEADER = '=4sIdffffffhhhffIfBB'
+
+	def __init__(self, address, decimation, esc_list):
+		self.address = address
+		self.decimation = decimation
+		self.esc_list = esc_list
+		self.countdown = 0
+		self.sequence = 0
+		self.drops = 0
+
+		self.packet_format = struct.Struct(self._HEADER + 'H' * len(esc_list))
+		self.packet = bytearray(self.packet_format.size)
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.socket.setblocking(0)
+
+	def publish(self, *values):
+		self.countdown -= 1
+		if self.countdown > 0:
+			return
+		self.countdown = self.decimation
+
+		self.packet_format.pack_into(self.packet, 0, self._MAGIC, self.sequence, *(values + (len(self.esc_list),) + tuple([esc.pulse_width for esc in self.esc_list])))
+		self.sequence += 1
+		try:
+			self.socket.sendto(self.packet, self.address)
+		except socket.error:
+			self.drops += 1
+
+	def close(self):
+		logger.critical("telemetry %d packets sent, %d dropped", self.sequence, self.drops)
+		self.socket.close()
+
+####################################################################################################
+#
+# Ground station command channel: text commands arrive as UDP datagrams, one command per datagram.
+# poll() costs one zero-timeout select per motion period and drains whatever has arrived without
+# ever blocking; valid commands are only staged there, and apply() makes them take effect together at
+# the start of the next motion period so no PID ever runs with a half-updated set of gains.  Each
+# command is acknowledged to its sender with the latency from receipt to taking effect.
+#
+#     vel <evx> <evy> <evz>      override the flight plan's earth frame velocity targets (m/s)
+#     vel off                    hand the velocity targets back to the flight plan
+#     gain <pid> <p> <i> <d>     set a PID's gains; pid is one of vv, hv, ya, pr, rr, yr
+#     abort                      end the flight plan as if it had reached its final step
+#
+####################################################################################################
+class CommandChannel:
+
+	#-------------------------------------------------------------------------------------------
+	# Limits on velocity overrides (m/s), and per PID the upper limits for each of the P, I and D
+	# gains, all of which must be non-negative.
+	#-------------------------------------------------------------------------------------------
+	_MAX_VELOCITY = 1.0
+	_GAIN_LIMITS = {"vv": (1000.0, 500.0, 100.0),
+			"hv": (10.0, 5.0, 1.0),
+			"ya": (50.0, 10.0, 5.0),
+			"pr": (500.0, 250.0, 50.0),
+			"rr": (500.0, 250.0, 50.0),
+			"yr": (500.0, 250.0, 50.0)}
+	_MAX_DATAGRAM = 256
+
+	def __init__(self, port, pids):
+		self.pids = pids
+		self.targets = None
+		self.staged = []
+
+		self.applied = 0
+		self.rejected = 0
+		self.total_latency = 0.0
+		self.max_latency = 0.0
+
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.socket.setblocking(0)
+		self.socket.bind(('', port))
+
+	def parse(self, words):
+		#-----------------------------------------------------------------------------------
+		# Returns the staged form of a command, or raises ValueError explaining the rejection
+		#-----------------------------------------------------------------------------------
+		if words == ["abort"]:
+			return ("abort",)
+
+		if len(words) == 2 and words[0] == "vel" and words[1] == "off":
+			return ("vel", None)
+
+		if len(words) == 4 and words[0] == "vel":
+			targets = tuple([float(word) for word in words[1:]])
+			for target in targets:
+				if not -self._MAX_VELOCITY <= target <= self._MAX_VELOCITY:
+					raise ValueError("velocity must lie in +/-%.1f m/s" % self._MAX_VELOCITY)
+			return ("vel", targets)
+
+		if len(words) == 5 and words[0] == "gain":
+			if words[1] not in self._GAIN_LIMITS:
+				raise ValueError("unknown PID %s" % words[1])
+			gains = tuple([float(word) for word in words[2:]])
+			for gain, limit in zip(gains, self._GAIN_LIMITS[words[1]]):
+				if not 0.0 <= gain <= limit:
+					raise ValueError("%s gains must lie in 0 <= gain <= %s" % (words[1], self._GAIN_LIMITS[words[1]]))
+			return ("gain", words[1], gains)
+
+		raise ValueError("unknown command")
+
+	def reply(self, message, sender):
+		try:
+			self.socket.sendto(message, sender)
+		except socket.error:
+			pass
+
+	def poll(self):
+		readable, writable, exceptional = select.select([self.socket], [], [], 0)
+		if not readable:
+			return
+
+		while True:
+			try:
+				datagram, sender = self.socket.recvfrom(self._MAX_DATAGRAM)
+			except socket.error:
+				break
+
+			received = time.time()
+			command = datagram.strip()
+			try:
+				self.staged.append((self.parse(command.split()), command, received, sender))
+			except ValueError, err:
+				self.rejected += 1
+				self.reply("rejected %s: %s" % (command, err), sender)
+
+	def apply(self, now):
+		global keep_looping
+
+		if not self.staged:
+			return
+
+		for change, command, received, sender in self.staged:
+			if change[0] == "abort":
+				keep_looping = False
+
+			elif change[0] == "vel":
+				self.targets = change[1]
+
+			elif change[0] == "gain":
+				p_gain, i_gain, d_gain = change[2]
+				for pid in self.pids[change[1]]:
+					pid.p_gain = p_gain
+					pid.i_gain = i_gain
+					pid.d_gain = d_gain
+
+		for change, command, received, sender in self.staged:
+			latency = now - received
+			self.applied += 1
+			self.total_latency += latency
+			if latency > self.max_latency:
+				self.max_latency = latency
+			logger.critical("command %s, latency %fs", command, latency)
+			self.reply("applied %s: latency %fs" % (command, latency), sender)
+
+		self.staged = []
+
+	def close(self):
+		logger.critical("commands %d applied, %d rejected, mean latency %fs, max latency %fs", self.applied, self.rejected, self.total_latency / max(self.applied, 1), self.max_latency)
+		self.socket.close()
+
+####################################################################################################
+#
+# Live tuning: the tunables of the FlightConfig from CheckCLI, republished in a small mmap'd
+# /dev/shm block that qctune.py edits while the flight runs.  The block is
+#
+#     header              version uint32, applied uint32, rejected uint32
+#     magic               "QCTU"
+#     schema length       uint32
+#     schema              "name:min:max,..." so qctune.py needs nothing from this file
+#     values              one double per schema field
+#
+# version is a sequence lock: the editor makes it odd, writes the values, then makes it even again.
+# check() is called once per motion period and costs one unpack of version when nothing has changed;
+# only a new even version is copied out, and the copy only counts if version is still the same
+# afterwards, so a half-written set is never seen.  The copy is range checked and then applied all
+# together into the FlightConfig, each keeping the type it started with, and its version written
+# back to applied or rejected for the editor to see.  A tunable that can't change in flight is
+# pinned by publishing it with min and max both its current value.
+#
+# Each tunable is published under its short name, and is the FlightConfig attribute alongside.
+#
+####################################################################################################
+TUNING_FIELDS = [("vvp", "vvp_gain", 0.0, 1000.0), ("vvi", "vvi_gain", 0.0, 500.0), ("vvd", "vvd_gain", 0.0, 100.0),
+		 ("hvp", "hvp_gain", 0.0, 10.0), ("hvi", "hvi_gain", 0.0, 5.0), ("hvd", "hvd_gain", 0.0, 1.0),
+		 ("prp", "prp_gain", 0.0, 500.0), ("pri", "pri_gain", 0.0, 250.0), ("prd", "prd_gain", 0.0, 50.0),
+		 ("rrp", "rrp_gain", 0.0, 500.0), ("rri", "rri_gain", 0.0, 250.0), ("rrd", "rrd_gain", 0.0, 50.0),
+		 ("tau", "tau", 0.01, 10.0),
+		 ("motion_frequency", "motion_frequency", 10.0, 200.0),
+		 ("hover_target", "hover_target", 0.0, 1000.0),
+		 ("rtf_period", "rtf_period", 0.1, 10.0)]
+
+class TuningConfig:
+
+	#-------------------------------------------------------------------------------------------
+	# Each header word is 32 bits so the Pi updates it in a single store
+	#-------------------------------------------------------------------------------------------
+	_HEADER = struct.Struct('=III')
+	_WORD = struct.Struct('=I')
+	_APPLIED_OFFSET = 4
+	_REJECTED_OFFSET = 8
+	_PREAMBLE = struct.Struct('=4sI')
+	_MAGIC = 'QCTU'
+
+	def __init__(self, name, fields, config, pids):
+		#-----------------------------------------------------------------------------------
+		# Limits are widened to take in the starting values, so the set flown with can always
+		# be put back
+		#-----------------------------------------------------------------------------------
+		fields = [(field, attribute, min(minimum, getattr(config, attribute)), max(maximum, getattr(config, attribute))) for field, attribute, minimum, maximum in fields]
+		self.names = [field for field, attribute, minimum, maximum in fields]
+		self.attributes = [attribute for field, attribute, minimum, maximum in fields]
+		self.limits = [(minimum, maximum) for field, attribute, minimum, maximum in fields]
+		self.values = struct.Struct('=' + 'd' * len(fields))
+		self.file_name = "/dev/shm/" + name
+		self.config = config
+
+		#-----------------------------------------------------------------------------------
+		# pids maps a gain prefix to the (PID, scale) pairs its p, i and d gains are applied to
+		#-----------------------------------------------------------------------------------
+		self.pids = pids
+
+		schema = ",".join(["%s:%r:%r" % (field, float(minimum), float(maximum)) for field, attribute, minimum, maximum in fields])
+		self.base = self._HEADER.size + self._PREAMBLE.size + len(schema)
+
+		size = self.base + self.values.size
+		shm_fd = os.open(self.file_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0600)
+		os.ftruncate(shm_fd, size)
+		self.shm = mmap.mmap(shm_fd, size)
+		os.close(shm_fd)
+
+		self._PREAMBLE.pack_into(self.shm, self._HEADER.size, self._MAGIC, len(schema))
+		self.shm[self._HEADER.size + self._PREAMBLE.size:self.base] = schema
+		self.values.pack_into(self.shm, self.base, *[float(getattr(config, attribute)) for attribute in self.attributes])
+		self._HEADER.pack_into(self.shm, 0, 0, 0, 0)
+
+		self.version = 0
+		self.applied = 0
+		self.rejected = 0
+
+	def check(self):
+		version = self._WORD.unpack_from(self.shm, 0)[0]
+		if version == self.version or version & 1:
+			return False
+
+		values = self.values.unpack_from(self.shm, self.base)
+		if self._WORD.unpack_from(self.shm, 0)[0] != version:
+			return False
+		self.version = version
+
+		for field, value, (minimum, maximum) in zip(self.names, values, self.limits):
+			if not minimum <= value <= maximum:
+				self.rejected += 1
+				self._WORD.pack_into(self.shm, self._REJECTED_OFFSET, version)
+				logger.critical("tuning %d rejected: %s = %r must lie in [%r, %r]", version, field, value, minimum, maximum)
+				return False
+
+		for attribute, value in zip(self.attributes, values):
+			setattr(self.config, attribute, type(getattr(self.config, attribute))(value))
+
+		gains = dict(zip(self.names, values))
+		for prefix, pids in self.pids.iteritems():
+			for pid, scale in pids:
+				pid.p_gain = gains[prefix + "p"] * scale
+				pid.i_gain = gains[prefix + "i"] * scale
+				pid.d_gain = gains[prefix + "d"] * scale
+
+		self.applied += 1
+		self._WORD.pack_into(self.shm, self._APPLIED_OFFSET, version)
+		logger.critical("tuning %d applied: %s", version, ", ".join(["%s = %r" % (field, value) for field, value in zip(self.names, values)]))
+		return True
+
+	def close(self):
+		logger.critical("tuning %d applied, %d rejected, final %s", self.applied, self.rejected, ", ".join(["%s = %r" % (field, getattr(self.config, attribute)) for field, attribute in zip(self.names, self.attributes)]))
+		self.shm.close()
+		try:
+			os.unlink(self.file_name)
+		except OSError:
+			pass
+
+####################################################################################################
+#
+# Metrics registry: counters, gauges and fixed bucket histograms, each a plain object the flight loop
+# updates in place, so an update is an attribute add or a bisect.  Metrics are grouped into families
+# by name, each member distinguished by its labels, and rendered in the Prometheus text format.
+#
+####################################################################################################
+class Counter:
+
+	def __init__(self):
+		self.value = 0
+
+	def inc(self, amount = 1):
+		self.value += amount
+
+class Gauge:
+
+	def __init__(self):
+		self.value = 0.0
+
+	def set(self, value):
+		self.value = value
+
+class Histogram:
+
+	def __init__(self, buckets):
+		self.buckets = sorted(buckets)
+		self.counts = array('L', [0] * (len(self.buckets) + 1))
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+class MetricsRegistry:
+
+	def __init__(self):
+		self.families = collections.OrderedDict()
+
+	def register(self, metric_type, name, help_text, metric, labels):
+		if name not in self.families:
+			self.families[name] = (metric_type, help_text, [])
+		self.families[name][2].append((labels, self.labelString(labels), metric))
+		return metric
+
+	def counter(self, name, help_text, **labels):
+		return self.register("counter", name, help_text, Counter(), labels)
+
+	def gauge(self, name, help_text, **labels):
+		return self.register("gauge", name, help_text, Gauge(), labels)
+
+	def histogram(self, name, help_text, buckets, **labels):
+		return self.register("histogram", name, help_text, Histogram(buckets), labels)
+
+	def labelString(self, labels, extra = None):
+		pairs = sorted(labels.items())
+		if extra is not None:
+			pairs.append(extra)
+		if len(pairs) == 0:
+			return ""
+		return "{" + ",".join(['%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in pairs]) + "}"
+
+	def render(self):
+		lines = []
+		for name, (metric_type, help_text, members) in self.families.items():
+			lines.append("# HELP %s %s" % (name, help_text))
+			lines.append("# TYPE %s %s" % (name, metric_type))
+			for labels, label_string, metric in members:
+				if metric_type != "histogram":
+					lines.append("%s%s %r" % (name, label_string, metric.value))
+					continue
+
+				#-------------------------------------------------------------------
+				# Buckets are cumulative in the text format.  The flight loop may
+				# update the histogram mid-render, so the count comes from the buckets.
+				#-------------------------------------------------------------------
+				cumulative = 0
+				for bound, count in zip(["%r" % bound for bound in metric.buckets] + ["+Inf"], metric.counts):
+					cumulative += count
+					lines.append("%s_bucket%s %d" % (name, self.labelString(labels, ("le", bound)), cumulative))
+				lines.append("%s_sum%s %r" % (name, label_string, metric.sum))
+				lines.append("%s_count%s %d" % (name, label_string, cumulative))
+
+		return "\n".join(lines) + "\n"
+
+####################################################################################################
+#
+# Metrics server: a low priority thread answers each connection, on a localhost TCP port or a unix
+# socket, with the registry rendered as a plain HTTP response, e.g.
+#
+#     curl http://127.0.0.1:9100/metrics
+#     curl --unix-socket /tmp/qcmetrics http://localhost/metrics
+#
+# Rendering happens on this thread, so a scrape costs the flight loop nothing but the GIL.
+#
+####################################################################################################
+class MetricsServer:
+
+	_POLL_PERIOD = 0.5
+
+	def __init__(self, registry, address):
+		self.registry = registry
+		self.address = address
+		self.scrapes = 0
+		self.errors = 0
+
+		if isinstance(address, int):
+			self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			self.listener.bind(('127.0.0.1', address))
+		else:
+			if os.path.exists(address):
+				os.unlink(address)
+			self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.listener.bind(address)
+		self.listener.listen(4)
+
+		self.running = True
+		self.server = threading.Thread(target=self.serve, name='metrics')
+		self.server.daemon = True
+		self.server.start()
+
+	def serve(self):
+		#-----------------------------------------------------------------------------------
+		# On Linux, nice applies to just this thread.
+		#-----------------------------------------------------------------------------------
+		os.nice(10)
+		while self.running:
+			if not select.select([self.listener], [], [], self._POLL_PERIOD)[0]:
+				continue
+
+			connection, peer = self.listener.accept()
+			try:
+				connection.settimeout(self._POLL_PERIOD)
+				connection.recv(4096)
+				body = self.registry.render()
+				connection.sendall("HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+				self.scrapes += 1
+			except socket.error:
+				self.errors += 1
+			finally:
+				connection.close()
+
+	def close(self):
+		self.running = False
+		self.server.join()
+		self.listener.close()
+		if not isinstance(self.address, int):
+			os.unlink(self.address)
+		logger.critical("metrics %d scrapes, %d errors", self.scrapes, self.errors)
+
+####################################################################################################
+#
+# The flight loop's own metrics.  The sample interval is observed every sample; everything else is
+# brought up to date once per motion period by update().
+#
+####################################################################################################
+class FlightMetrics:
 
-	#-------------------------------------------------------------------------------------------
-	# Reset the signal handler to default
-	#-------------------------------------------------------------------------------------------
-	signal.signal(signal.SIGINT, signal.SIG_DFL)
+	def __init__(self, registry, esc_list):
+		self.esc_list = esc_list
 
-	sys.exit(0)
+		self.sample_interval = registry.histogram("qc_sample_interval_seconds", "Time between sensor samples", [0.0005, 0.00075, 0.001, 0.00125, 0.0015, 0.002, 0.003, 0.005, 0.01])
+		self.motion_period = registry.histogram("qc_motion_period_seconds", "Time between motion processing updates", [0.01, 0.015, 0.02, 0.025, 0.03, 0.04, 0.05, 0.1])
+		self.loops = registry.counter("qc_loops_total", "Sensor samples processed")
+		self.loop_rate = registry.gauge("qc_loop_rate_hertz", "Sensor samples per second since take off")
+		self.mpu6050_misses = registry.counter("qc_mpu6050_misses_total", "MPU6050 reads missed")
+		self.i2c_misses = registry.counter("qc_i2c_misses_total", "I2C transfers retried")
+		self.temperature = registry.gauge("qc_mpu6050_temperature_celsius", "MPU6050 temperature")
+		self.degradation = registry.gauge("qc_degradation_level", "Deadline monitor load shedding level")
+
+		self.escs = []
+		for esc in esc_list:
+			self.escs.append((esc,
+					  registry.gauge("qc_esc_pulse_width_microseconds", "ESC pulse width", esc=esc.name),
+					  registry.counter("qc_esc_saturated_low_total", "Motion periods with the ESC at its minimum pulse width", esc=esc.name),
+					  registry.counter("qc_esc_saturated_high_total", "Motion periods with the ESC at its maximum pulse width", esc=esc.name)))
+
+	def update(self, loop_count, elapsed_time, motion_period, temp_raw, mpu6050_misses, i2c_misses, degradation_level):
+		self.motion_period.observe(motion_period)
+		self.loops.value = loop_count
+		if elapsed_time > 0.0:
+			self.loop_rate.value = loop_count / elapsed_time
+		self.mpu6050_misses.value = mpu6050_misses
+		self.i2c_misses.value = i2c_misses
+		self.temperature.value = temp_raw / 340 + 36.53
+		self.degradation.value = degradation_level
+
+		for esc, pulse_width, saturated_low, saturated_high in self.escs:
+			pulse_width.value = esc.pulse_width
+			if esc.pulse_width <= esc.min_pulse_width:
+				saturated_low.value += 1
+			elif esc.pulse_width >= esc.max_pulse_width:
+				saturated_high.value += 1
 
 ####################################################################################################
 #
-# Signal handler for Ctrl-C => abort cleanly
+# Asynchronous log handler: the control thread only appends the log record to a bounded queue (or
+# counts it as dropped if full), and a background writer thread does the formatting and console /
+# file I/O for the real handlers.  close() drains everything still queued, then hands the logger
+# straight to the real handlers so anything logged later in shutdown still gets written.
 #
 ####################################################################################################
-def SignalHandler(signal, frame):
-	global keep_looping
+class AsyncLogHandler(logging.Handler):
 
-	if loop_count > 0:
-		keep_looping = False
-	else:
-		CleanShutdown()
+	_CAPACITY = 1024
+	_POLL_PERIOD = 0.01
+
+	def __init__(self, handlers):
+		logging.Handler.__init__(self, min([handler.level for handler in handlers]))
+		self.handlers = handlers
+		self.queue = collections.deque()
+		self.drops = 0
+		self.running = True
+
+		self.writer = threading.Thread(target=self.drain, name='logwriter')
+		self.writer.daemon = True
+		self.writer.start()
+
+	def emit(self, record):
+		#-----------------------------------------------------------------------------------
+		# No lock, no wait: deque appends are atomic under the GIL and this is the only producer
+		# that checks the length.
+		#-----------------------------------------------------------------------------------
+		if len(self.queue) < self._CAPACITY:
+			self.queue.append(record)
+		else:
+			self.drops += 1
+
+	def write(self):
+		while self.queue:
+			record = self.queue.popleft()
+			for handler in self.handlers:
+				if record.levelno >= handler.level:
+					handler.handle(record)
+
+	def drain(self):
+		while self.running:
+			self.write()
+			time.sleep(self._POLL_PERIOD)
+
+	def close(self):
+		if self.running:
+			self.running = False
+			self.writer.join()
+			self.write()
+
+			if self.drops > 0:
+				record = logging.LogRecord(logger.name, logging.CRITICAL, __file__, 0, "log writer %d records dropped", (self.drops,), None)
+				for handler in self.handlers:
+					handler.handle(record)
+
+			#---------------------------------------------------------------------------
+			# Anything queued by another thread while swapping over is written last.
+			#---------------------------------------------------------------------------
+			logger.removeHandler(self)
+			for handler in self.handlers:
+				logger.addHandler(handler)
+			self.write()
+
+			for handler in self.handlers:
+				handler.flush()
+
+		logging.Handler.close(self)
 
 ####################################################################################################
 #
-# Flight plan management
+# Background log offload: a low priority thread streams each newly completed chunk of the /dev/shm
+# log through gzip compression to the SD card, rate limited, and then punches the offloaded range
+# out of the tmpfs file so its memory use stays capped.  Every pass ends in a sync flush so the log
+# on disk is readable up to that point even if we die; shutdown only has the last pass to do.  Until
+# then the file is named for the start time with a .part suffix; close() renames it for the end
+# time, as the log was named before it was offloaded.
 #
 ####################################################################################################
-class FlightPlan:
+FALLOC_FL_KEEP_SIZE  = 1
+FALLOC_FL_PUNCH_HOLE = 2
 
-	#-------------------------------------------------------------------------------------------
-	# The flight plan - move to file at some point
-	#-------------------------------------------------------------------------------------------
-	fp_evx_target  = [0.0,       0.0,       0.0,       0.0,       0.0]
-	fp_evy_target  = [0.0,       0.0,       0.0,       0.0,       0.0]
-	fp_evz_target  = [0.0,       0.5,       0.0,      -0.5,       0.0]
-	fp_time        = [0.0,       2.0,       5.0,       2.0,       0.0]
-	fp_name        = ["RTF",  "ASCENT",   "HOVER", "DESCENT",    "STOP"]
-	_FP_STEPS = 5
+class LogOffloader:
 
-	def __init__(self, time_now):
+	_PERIOD = 1.0
+	_RATE_LIMIT = 262144
+	_COMPRESSION = 1
 
-		self.fp_index = 0
-		self.fp_prev_index = 0
-		self.start_time = time_now
+	def __init__(self, shm_file_name, log_file_prefix):
+		self.shm_file_name = shm_file_name
+		self.log_file_prefix = log_file_prefix
+		self.log_file_name = log_file_prefix + datetime.now().strftime("%y%m%d-%H:%M:%S") + ".csv.gz.part"
+		self.offset = 0
+		self.running = True
 
+		#-----------------------------------------------------------------------------------
+		# Opened read / write because punching holes needs write access
+		#-----------------------------------------------------------------------------------
+		self.shm_file = open(shm_file_name, 'r+b')
+		self.log_file = open(self.log_file_name, 'wb')
+		self.compressor = zlib.compressobj(self._COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
 
-	def getTargets(self, time_now):
-		global keep_looping
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		self.fallocate = libc.fallocate64
+		self.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+		self.punch_holes = True
 
-		elapsed_time = time_now - self.start_time
+		self.offloader = threading.Thread(target=self.offload, name='offloader')
+		self.offloader.daemon = True
+		self.offloader.start()
 
-		fp_total_time = 0.0
-		for fp_index in range(0, self._FP_STEPS):
-			fp_total_time += self.fp_time[fp_index]
-			if elapsed_time < fp_total_time:
-				break
-		else:
-			keep_looping = False
+	def copy(self, limit):
+		#-----------------------------------------------------------------------------------
+		# Only whole lines, so a line still being written is picked up complete next time.
+		#-----------------------------------------------------------------------------------
+		self.shm_file.seek(self.offset)
+		data = self.shm_file.read(limit)
+		data = data[:data.rfind('\n') + 1]
+		if not data:
+			return
+
+		self.log_file.write(self.compressor.compress(data))
+		self.log_file.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+		self.log_file.flush()
+		os.fsync(self.log_file.fileno())
+		self.offset += len(data)
+
+		if self.punch_holes:
+			if self.fallocate(self.shm_file.fileno(), FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, 0, self.offset) != 0:
+				self.punch_holes = False
+
+	def offload(self):
+		#-----------------------------------------------------------------------------------
+		# On Linux, nice applies to just this thread.
+		#-----------------------------------------------------------------------------------
+		os.nice(10)
+		while self.running:
+			time.sleep(self._PERIOD)
+			self.copy(int(self._RATE_LIMIT * self._PERIOD))
+
+	def close(self):
+		self.running = False
+		self.offloader.join()
+
+		self.copy(-1)
+		self.log_file.write(self.compressor.flush(zlib.Z_FINISH))
+		self.log_file.close()
+		self.shm_file.close()
+		os.unlink(self.shm_file_name)
+		os.rename(self.log_file_name, self.log_file_prefix + datetime.now().strftime("%y%m%d-%H:%M:%S") + ".csv.gz")
 
-		evx_target = self.fp_evx_target[fp_index]
-		evy_target = self.fp_evy_target[fp_index]
-		evz_target = self.fp_evz_target[fp_index]
+####################################################################################################
+#
+# Sampling profiler: a helper thread wakes at the sampling rate, takes the flight loop thread's
+# current frame from sys._current_frames() and walks it to the root.  Each distinct stack is keyed
+# by its code objects alone, with names only looked up when dumped, and counted in a table allocated
+# up front; stacks beyond the table's capacity are counted together as "[other]".  The dump is in
+# collapsed stack format, root first, one "frame;frame;frame count" line per stack, for
+# flamegraph.pl and friends.  Only the interpreter is involved, so it works the same flying or not.
+#
+####################################################################################################
+class SamplingProfiler:
+
+	_MAX_STACKS = 4096
+	_MAX_DEPTH = 48
+
+	def __init__(self, thread_id, rate):
+		self.thread_id = thread_id
+		self.period = 1 / rate
+
+		self.stacks = [None] * self._MAX_STACKS
+		self.counts = array('L', [0] * self._MAX_STACKS)
+		self.index = {}
+		self.used = 0
+		self.overflows = 0
+
+		self.samples = 0
+		self.total_time = 0.0
+
+		self.running = True
+		self.sampler = threading.Thread(target=self.sample, name='profiler')
+		self.sampler.daemon = True
+		self.sampler.start()
+
+	def sample(self):
+		while self.running:
+			time.sleep(self.period)
+			start = time.time()
+
+			frame = sys._current_frames().get(self.thread_id)
+			if frame is None:
+				continue
+
+			stack = []
+			depth = 0
+			while frame is not None and depth < self._MAX_DEPTH:
+				stack.append(frame.f_code)
+				frame = frame.f_back
+				depth += 1
+			stack = tuple(stack)
+
+			slot = self.index.get(stack)
+			if slot is None:
+				if self.used < self._MAX_STACKS:
+					slot = self.used
+					self.used += 1
+					self.stacks[slot] = stack
+					self.index[stack] = slot
+				else:
+					self.overflows += 1
 
-		if fp_index != self.fp_prev_index:
-			logger.critical("%s", self.fp_name[fp_index])
-			self.fp_prev_index = fp_index
+			if slot is not None:
+				self.counts[slot] += 1
 
-		return evx_target, evy_target, evz_target
+			self.samples += 1
+			self.total_time += time.time() - start
+
+	def stop(self):
+		self.running = False
+		self.sampler.join()
+
+	def dump(self, file_name):
+		with open(file_name, 'w') as profile_file:
+			for slot in range(0, self.used):
+				names = ["%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno) for code in reversed(self.stacks[slot])]
+				profile_file.write("%s %d\n" % (";".join(names), self.counts[slot]))
+			if self.overflows > 0:
+				profile_file.write("[other] %d\n" % self.overflows)
+
+		logger.critical("profiler %d samples of %d stacks to %s, mean %fus per sample", self.samples, self.used, file_name, self.total_time * 1000000 / max(self.samples, 1))
 
 ####################################################################################################
 #
@@ -1265,14 +4361,32 @@ def go():
 	global keep_looping
 	global time_now
 	global temp_now
+	global aux_now
 	global loop_count
 	global esc_list
 	global shoot_video
 	global video
-	global i_am_phoebe
-	global i_am_chloe
 	global heater
 	global mpu6050
+	global stage_timing
+	global stage_timer
+	global time_ready
+	global deadline_monitor
+	global sensor_process
+	global telemetry_process
+	global flight_recorder
+	global log_writer
+	global log_offloader
+	global telemetry_publisher
+	global command_channel
+	global vibration_monitor
+	global raw_recorder
+	global velocity_estimator
+	global imu_voter
+	global metrics_server
+	global profiler
+	global tuning
+	global pwm
 
 	#-------------------------------------------------------------------------------------------
 	# Global constants
@@ -1280,39 +4394,16 @@ def go():
 	global RPIO_DATA_READY_INTERRUPT
 	global RPIO_DMA_CHANNEL
 
-	#-------------------------------------------------------------------------------------------
-	# Who am I?
-	#-------------------------------------------------------------------------------------------
-	i_am_phoebe = False
-	i_am_chloe = False
-	my_name = os.uname()[1]
-	if my_name == "phoebe.local":
-		print "Hi, I'm Phoebe. Nice to meet you!"
-		i_am_phoebe = True
-	elif my_name == "chloe.local":
-		print "Hi, I'm Chloe.  Nice to meet you!"
-		i_am_chloe = True
-	else:
-		print "Sorry, I'm not qualified to fly this quadcopter."
-		sys.exit(0)
-
 	#-------------------------------------------------------------------------------------------
 	# Lock code permanently in memory - no swapping to disk
 	#-------------------------------------------------------------------------------------------
 	mlockall()
 
 	#-------------------------------------------------------------------------------------------
-	# Set the BCM output / intput assigned to LED and sensor interrupt respectively
+	# Set the DMA channel used for PWM
 	#-------------------------------------------------------------------------------------------
 	RPIO_DMA_CHANNEL = 1
 
-	if i_am_phoebe:
-		RPIO_DATA_READY_INTERRUPT = 24
-		RPIO_THERMOSTAT_PWM = 26
-	elif i_am_chloe:
-		RPIO_DATA_READY_INTERRUPT = 25
-		RPIO_THERMOSTAT_PWM = 26
-
 	#-------------------------------------------------------------------------------------------
 	# Set up the base logging
 	#-------------------------------------------------------------------------------------------
@@ -1321,9 +4412,11 @@ def go():
 
 	#-------------------------------------------------------------------------------------------
 	# Create file and console logger handlers - the file is written into shared memory and only
-	# dumped to disk / SD card at the end of a flight for performance reasons
+	# dumped to disk / SD card at the end of a flight for performance reasons.  It's opened for
+	# append (after truncating) so the telemetry process can safely add to it too.
 	#-------------------------------------------------------------------------------------------
-	file_handler = logging.FileHandler("/dev/shm/qclogs", 'w')
+	open("/dev/shm/qclogs", 'w').close()
+	file_handler = logging.FileHandler("/dev/shm/qclogs", 'a')
 	file_handler.setLevel(logging.WARNING)
 
 	console_handler = logging.StreamHandler()
@@ -1339,10 +4432,32 @@ def go():
 	file_handler.setFormatter(file_formatter)
 
 	#-------------------------------------------------------------------------------------------
-	# Add both handlers to the logger
+	# Add both handlers to the logger behind the asynchronous writer so console and file I/O never
+	# lands on the flight loop
+	#-------------------------------------------------------------------------------------------
+	log_writer = AsyncLogHandler([console_handler, file_handler])
+	logger.addHandler(log_writer)
+
+	#-------------------------------------------------------------------------------------------
+	# Check the command line for calibration or flight parameters
+	#-------------------------------------------------------------------------------------------
+	config = CheckCLI(sys.argv[1:])
+	shoot_video = config.shoot_video
+	stage_timing = config.stage_timing
+
+	#-------------------------------------------------------------------------------------------
+	# Stream the log from shared memory to disk / SD card in the background during the flight.
+	# Only now the command line is good, so usage and bad arguments leave no log behind; from
+	# here on every exit must close it to finish the gzip stream.
+	#-------------------------------------------------------------------------------------------
+	log_offloader = LogOffloader("/dev/shm/qclogs", "qcstats")
+	logger.warning("%s", config)
+
+	#-------------------------------------------------------------------------------------------
+	# The airframe's sensor interrupt input and heater output
 	#-------------------------------------------------------------------------------------------
-	logger.addHandler(console_handler)
-	logger.addHandler(file_handler)
+	RPIO_DATA_READY_INTERRUPT = config.airframe.data_ready_pin
+	RPIO_THERMOSTAT_PWM = config.airframe.thermostat_pin
 
 	#-------------------------------------------------------------------------------------------
 	# Enable RPIO for beeper, MPU 6050 interrupts and PWM.  This must be set up prior to adding
@@ -1350,59 +4465,98 @@ def go():
 	#-------------------------------------------------------------------------------------------
 	RpioSetup()
 
+	try:
+		pwm = PWM_BACKENDS[config.pwm_backend]()
+	except (ImportError, IOError), err:
+		logger.critical('PWM backend %s is unavailable: %s', config.pwm_backend, err)
+		RpioCleanup()
+		log_writer.close()
+		log_offloader.close()
+		sys.exit(2)
+
+	#-------------------------------------------------------------------------------------------
+	# Check the backend can drive all the airframe's ESC and heater pins before setting any up
+	#-------------------------------------------------------------------------------------------
+	try:
+		pwm.checkPins(list(config.airframe.esc_pins) + [config.airframe.thermostat_pin])
+	except ValueError, err:
+		logger.critical('PWM backend %s can\'t drive airframe %s: %s', config.pwm_backend, config.airframe.name, err)
+		logger.critical('  --pwm  PWM backend: rpio (default), pigpio, sysfs or fake')
+		RpioCleanup()
+		log_writer.close()
+		log_offloader.close()
+		sys.exit(2)
+
 	#-------------------------------------------------------------------------------------------
 	# Set the signal handler here so the core processing loop can be stopped (or not started) by
 	# Ctrl-C.
 	#-------------------------------------------------------------------------------------------
 	loop_count = 0
 	keep_looping = True
+	stage_timer = None
+	deadline_monitor = None
+	sensor_process = None
+	telemetry_process = None
+	flight_recorder = None
+	telemetry_publisher = None
+	command_channel = None
+	vibration_monitor = None
+	raw_recorder = None
+	velocity_estimator = None
+	imu_voter = None
+	metrics_server = None
+	profiler = None
+	tuning = None
 	signal.signal(signal.SIGINT, SignalHandler)
 
 	#-------------------------------------------------------------------------------------------
-	# Set up the ESC to GPIO pin and location mappings and assign to each ESC
+	# Set up the frame layout and ESC to GPIO pin mappings, the pins in FRAME_LAYOUTS order
 	#-------------------------------------------------------------------------------------------
-	if i_am_phoebe:
-		ESC_BCM_BL = 5
-		ESC_BCM_FL = 27
-		ESC_BCM_FR = 17
-		ESC_BCM_BR = 19
-	elif i_am_chloe:
-		ESC_BCM_BL = 23
-		ESC_BCM_FL = 18
-		ESC_BCM_FR = 17
-		ESC_BCM_BR = 22
-
-	MOTOR_LOCATION_FRONT = 0b00000001
-	MOTOR_LOCATION_BACK =  0b00000010
-	MOTOR_LOCATION_LEFT =  0b00000100
-	MOTOR_LOCATION_RIGHT = 0b00001000
-
-	MOTOR_ROTATION_CW = 1
-	MOTOR_ROTATION_ACW = 2
-
-	pin_list = [ESC_BCM_FL, ESC_BCM_FR, ESC_BCM_BL, ESC_BCM_BR]
-	location_list = [MOTOR_LOCATION_FRONT | MOTOR_LOCATION_LEFT, MOTOR_LOCATION_FRONT | MOTOR_LOCATION_RIGHT, MOTOR_LOCATION_BACK | MOTOR_LOCATION_LEFT, MOTOR_LOCATION_BACK | MOTOR_LOCATION_RIGHT]
-	rotation_list = [MOTOR_ROTATION_ACW, MOTOR_ROTATION_CW, MOTOR_ROTATION_CW, MOTOR_ROTATION_ACW]
-	name_list = ['front left', 'front right', 'back left', 'back right']
+	frame_layout = config.airframe.frame
+	pin_list = config.airframe.esc_pins
 
 	#-------------------------------------------------------------------------------------------
 	# Prime the ESCs with the default 0 spin rotors to shut them up.
 	#-------------------------------------------------------------------------------------------
 	esc_list = []
-	for esc_index in range(0, 4):
-		esc = ESC(pin_list[esc_index], location_list[esc_index], rotation_list[esc_index], name_list[esc_index])
+	for esc_index, (name, angle, rotation) in enumerate(FRAME_LAYOUTS[frame_layout]):
+		esc = ESC(pin_list[esc_index], angle, rotation, name)
 		esc_list.append(esc)
 
 	#-------------------------------------------------------------------------------------------
-	# Check the command line for calibration or flight parameters
+	# Linearise the ESCs' thrust if test case 2 has characterised them
 	#-------------------------------------------------------------------------------------------
-	calibrate_gravity, flying, hover_target, shoot_video, vvp_gain, vvi_gain, vvd_gain, hvp_gain, hvi_gain, hvd_gain, prp_gain, pri_gain, prd_gain, rrp_gain, rri_gain, rrd_gain, test_case, dlpf, motion_frequency, rtf_period, tau, diagnostics = CheckCLI(sys.argv[1:])
-	logger.warning("calibrate_gravity = %s, fly = %s, hover_target = %d, shoot_video = %s, vvp_gain = %f, vvi_gain = %f, vvd_gain= %f, hvp_gain = %f, hvi_gain = %f, hvd_gain = %f, prp_gain = %f, pri_gain = %f, prd_gain = %f, rrp_gain = %f, rri_gain = %f, rrd_gain = %f, test_case = %d, dlpf = %d, motion_frequency = %f, rtf_period = %f, tau = %f, diagnostics = %s", calibrate_gravity, flying, hover_target, shoot_video, vvp_gain, vvi_gain, vvd_gain, hvp_gain, hvi_gain, hvd_gain, prp_gain, pri_gain, prd_gain, rrp_gain, rri_gain, rrd_gain, test_case, dlpf, motion_frequency, rtf_period, tau, diagnostics)
+	if os.path.exists("./qcesc.csv"):
+		try:
+			thrust_tables = LoadThrustTables("./qcesc.csv")
+		except (IOError, ValueError), err:
+			logger.critical('ESC thrust tables ./qcesc.csv are unusable: %s', err)
+			log_writer.close()
+			log_offloader.close()
+			sys.exit(2)
+
+		for esc in esc_list:
+			if esc.name in thrust_tables:
+				esc.thrust_table = thrust_tables[esc.name]
+				logger.critical("%s ESC thrust linearised", esc.name)
+
+	mixer = Mixer(esc_list)
+
+	#-------------------------------------------------------------------------------------------
+	# Compile the flight plan now rather than when it's needed mid-flight
+	#-------------------------------------------------------------------------------------------
+	try:
+		fp = FlightPlan(config.flight_plan)
+	except (IOError, ValueError), err:
+		logger.critical('Flight plan %s is unusable: %s', config.flight_plan, err)
+		log_writer.close()
+		log_offloader.close()
+		sys.exit(2)
 
 	#-------------------------------------------------------------------------------------------
 	# Initialize the motion processing period
 	#-------------------------------------------------------------------------------------------
-	motion_period = 1 / motion_frequency
+	motion_period = 1 / config.motion_frequency
 
 	#-------------------------------------------------------------------------------------------
 	# Set up the global constants
@@ -1415,7 +4569,17 @@ def go():
 	#-------------------------------------------------------------------------------------------
 	# Initialize the gyroscope / accelerometer I2C object
 	#-------------------------------------------------------------------------------------------
-	mpu6050 = MPU6050(0x68, dlpf)
+	aux_now = ()
+	mpu6050 = MPU6050(0x68, config.dlpf, [AUX_SENSORS[aux_sensor]() for aux_sensor in config.aux_sensors], 1, config.airframe.accel_offsets, config.airframe.accel_gains)
+
+	#-------------------------------------------------------------------------------------------
+	# And any extra IMUs to vote with it
+	#-------------------------------------------------------------------------------------------
+	imu_calibrations = dict([(imu, (offsets, gains)) for imu, offsets, gains in config.airframe.imu_calibrations])
+	for bus, address in config.imus:
+		if (bus, address) not in imu_calibrations:
+			logger.critical("imu %d:0x%02x has no calibration in airframe %s, so has none", bus, address, config.airframe.name)
+	extra_imus = [(bus, address, MPU6050(address, config.dlpf, [], bus, *imu_calibrations.get((bus, address), ((0.0, 0.0, 0.0), (1.0, 1.0, 1.0))))) for bus, address in config.imus]
 
 	#===========================================================================================
 	# Initialize the heater and loop waiting until we have a stable temperature of 40 degrees
@@ -1471,13 +4635,15 @@ def go():
 	#-------------------------------------------------------------------------------------------
 	# Calibrate gravity at the now stabilized temperature.
 	#-------------------------------------------------------------------------------------------
-	if calibrate_gravity:
+	if config.calibrate_gravity:
 		mpu6050.calibrateGravity("./qcoffsets.csv")
 		CleanShutdown()
 
 	#-------------------------------------------------------------------------------------------
-	# Calibrate gyros - this is a one-off
+	# Calibrate gyros - this is a one-off, the primary last so temp_now and time_now are its own
 	#-------------------------------------------------------------------------------------------
+	for bus, address, imu in extra_imus:
+		imu.calibrateGyros()
 	mpu6050.calibrateGyros()
 	[p_out, i_out, d_out] = temp_pid.Compute(temp_now, MPU6050_TEMP_TARGET, time_now)
 	temp_out = p_out + i_out + d_out
@@ -1583,12 +4749,12 @@ def go():
 
 	ya_target = 0.0
 
-	qvx_diags = "0.0, 0.0, 0.0"
-	qvy_diags = "0.0, 0.0, 0.0"
-	qvz_diags = "0.0, 0.0, 0.0"
-	pr_diags = "0.0, 0.0, 0.0"
-	rr_diags = "0.0, 0.0, 0.0"
-	yr_diags = "0.0, 0.0, 0.0"
+	qvx_diags = (0.0, 0.0, 0.0)
+	qvy_diags = (0.0, 0.0, 0.0)
+	qvz_diags = (0.0, 0.0, 0.0)
+	pr_diags = (0.0, 0.0, 0.0)
+	rr_diags = (0.0, 0.0, 0.0)
+	yr_diags = (0.0, 0.0, 0.0)
 
 	hover_speed = 0
 	ready_to_fly = False
@@ -1597,9 +4763,9 @@ def go():
 	# START TESTCASE 1 CODE: spin up each blade individually for 10s each and check they all turn
 	#                        the right way
 	#-------------------------------------------------------------------------------------------
-	if test_case == 1:
+	if config.test_case == 1:
 		for esc in esc_list:
-			for count in range(0, hover_target, 10):
+			for count in range(0, config.hover_target, 10):
 				#-------------------------------------------------------------------
 				# Spin up to user determined (-h) hover speeds ~200
 				#-------------------------------------------------------------------
@@ -1612,6 +4778,50 @@ def go():
 	# END TESTCASE 1 CODE: spin up each blade individually for 10s each and check they all turn the right way
 	#-------------------------------------------------------------------------------------------
 
+	#-------------------------------------------------------------------------------------------
+	# START TESTCASE 2 CODE: step each blade in turn from 0 to the -h spin rate, measuring the
+	#                        accelerometer response at each step to build its thrust linearisation
+	#                        table.  The quad needs to be on a thrust rig or tethered for this.
+	#-------------------------------------------------------------------------------------------
+	if config.test_case == 2:
+		thrust_tables = []
+		for esc in esc_list:
+			esc.thrust_table = None
+			spin_rates = []
+			responses = []
+			for step in range(0, ESC_LUT_POINTS + 1):
+				spin_rate = config.hover_target * step / ESC_LUT_POINTS
+				esc.update(spin_rate)
+				time.sleep(1.0)
+
+				#-------------------------------------------------------------------
+				# Average out the vibration; the response is the change from rest
+				#-------------------------------------------------------------------
+				qaz_total = 0.0
+				for iteration in range(0, 100):
+					qax, qay, qaz, qgx, qgy, qgz = mpu6050.readSensorsRaw()
+					qaz_total += qaz
+				if step == 0:
+					qaz_rest = qaz_total / 100
+
+				spin_rates.append(spin_rate)
+				responses.append(math.fabs(qaz_total / 100 - qaz_rest))
+				logger.critical("%s spin %d, response %f", esc.name, spin_rate, responses[-1])
+
+			esc.update(0)
+			time.sleep(2.0)
+
+			try:
+				thrust_tables.append((esc.name, ThrustTable.fromResponse(spin_rates, responses)))
+			except ValueError, err:
+				logger.critical("%s ESC not characterised: %s", esc.name, err)
+
+		SaveThrustTables("./qcesc.csv", thrust_tables)
+		CleanShutdown()
+	#-------------------------------------------------------------------------------------------
+	# END TESTCASE 2 CODE: characterise each blade's thrust for the ESC linearisation table
+	#-------------------------------------------------------------------------------------------
+
 	#===========================================================================================
 	# Tuning: Set up the PID gains - some are hard coded mathematical approximations, some come
 	# from the CLI parameters to allow for tuning  - 7 in all
@@ -1628,23 +4838,23 @@ def go():
 	#-------------------------------------------------------------------------------------------
 	# The quad X axis speed controls forward / backward speed
 	#-------------------------------------------------------------------------------------------
-	PID_QVX_P_GAIN = hvp_gain
-	PID_QVX_I_GAIN = hvi_gain
-	PID_QVX_D_GAIN = hvd_gain	
+	PID_QVX_P_GAIN = config.hvp_gain
+	PID_QVX_I_GAIN = config.hvi_gain
+	PID_QVX_D_GAIN = config.hvd_gain	
 
 	#-------------------------------------------------------------------------------------------
 	# The quad Y axis speed controls left / right speed
 	#-------------------------------------------------------------------------------------------
-	PID_QVY_P_GAIN = hvp_gain
-	PID_QVY_I_GAIN = hvi_gain
-	PID_QVY_D_GAIN = hvd_gain	
+	PID_QVY_P_GAIN = config.hvp_gain
+	PID_QVY_I_GAIN = config.hvi_gain
+	PID_QVY_D_GAIN = config.hvd_gain	
 
 	#-------------------------------------------------------------------------------------------
 	# The quad Z axis speed controls rise / fall speed
 	#-------------------------------------------------------------------------------------------
-	PID_QVZ_P_GAIN = vvp_gain
-	PID_QVZ_I_GAIN = vvi_gain
-	PID_QVZ_D_GAIN = vvd_gain
+	PID_QVZ_P_GAIN = config.vvp_gain
+	PID_QVZ_I_GAIN = config.vvi_gain
+	PID_QVZ_D_GAIN = config.vvd_gain
 
 	#-------------------------------------------------------------------------------------------
 	# The yaw angle PID maintains a stable rotation angle about the Z-axis
@@ -1656,36 +4866,132 @@ def go():
 	#-------------------------------------------------------------------------------------------
 	# The pitch rate PID controls stable rotation rate around the Y-axis
 	#-------------------------------------------------------------------------------------------
-	PID_PR_P_GAIN = prp_gain
-	PID_PR_I_GAIN = pri_gain
-	PID_PR_D_GAIN = prd_gain
+	PID_PR_P_GAIN = config.prp_gain
+	PID_PR_I_GAIN = config.pri_gain
+	PID_PR_D_GAIN = config.prd_gain
 
 	#-------------------------------------------------------------------------------------------
 	# The roll rate PID controls stable rotation rate around the X-axis
 	#-------------------------------------------------------------------------------------------
-	PID_RR_P_GAIN = rrp_gain
-	PID_RR_I_GAIN = rri_gain
-	PID_RR_D_GAIN = rrd_gain
+	PID_RR_P_GAIN = config.rrp_gain
+	PID_RR_I_GAIN = config.rri_gain
+	PID_RR_D_GAIN = config.rrd_gain
 
 	#-------------------------------------------------------------------------------------------
 	# The yaw rate PID controls stable rotation speed around the Z-axis
 	#-------------------------------------------------------------------------------------------
-	PID_YR_P_GAIN = rrp_gain / 2.0
-	PID_YR_I_GAIN = rri_gain / 2.0
-	PID_YR_D_GAIN = rrd_gain / 2.0
+	PID_YR_P_GAIN = config.rrp_gain / 2.0
+	PID_YR_I_GAIN = config.rri_gain / 2.0
+	PID_YR_D_GAIN = config.rrd_gain / 2.0
+
+	#-------------------------------------------------------------------------------------------
+	# Report where the auxiliary sensors think we are
+	#-------------------------------------------------------------------------------------------
+	offset = 0
+	for sensor in mpu6050.aux_sensors:
+		logger.critical("%s: %s", sensor.name, sensor.describe(aux_now[offset:offset + len(sensor.fields)]))
+		offset += len(sensor.fields)
 
 	logger.critical('Thunderbirds are go!')
 
 	#-------------------------------------------------------------------------------------------
-	# Diagnostic log header
+	# Diagnostic log header, or the flight recorder which carries its own
+	#-------------------------------------------------------------------------------------------
+	diagnostics_schema = DiagnosticsSchema(esc_list)
+	diagnostics_format = DiagnosticsFormat(diagnostics_schema)
+	if config.diagnostics:
+		if config.flight_recording:
+			flight_recorder = FlightRecorder("qcrecord", diagnostics_schema)
+		else:
+			logger.warning(', '.join([name for name, code in diagnostics_schema]))
+
+	#-------------------------------------------------------------------------------------------
+	# With --filter, decimate the samples to the motion processing rate through the chosen filter
+	# rather than box averaging them.  The sensors sample at 8kHz with the DLPF off, else 1kHz.
+	#-------------------------------------------------------------------------------------------
+	sample_rate = 8000 if config.dlpf == 0 or config.dlpf == 7 else 1000
+
+	decimator = None
+	if config.decimation_filter is not None:
+		decimator = DECIMATION_FILTERS[config.decimation_filter](sample_rate, config.motion_frequency)
+		sample_cost, output_cost = decimator.benchmark(sample_rate)
+		logger.critical("%s decimation %fus per sample, %fus per output, %fms delay", decimator.name, sample_cost, output_cost, decimator.delay * 1000 / sample_rate)
+
+	#-------------------------------------------------------------------------------------------
+	# With --vib, watch for vibration at the motor frequencies, and with --raw keep every sample
+	#-------------------------------------------------------------------------------------------
+	if config.vibration:
+		vibration_monitor = VibrationMonitor(esc_list, sample_rate)
+		sample_cost = vibration_monitor.benchmark(sample_rate)
+		logger.critical("vibration monitor %fus per sample of a %fus sample period", sample_cost, 1000000 / sample_rate)
+
+	if config.raw_recording:
+		raw_recorder = FlightRecorder("qcraw", RAW_SAMPLES_SCHEMA, RAW_SAMPLES_SLOTS)
+
+	#-------------------------------------------------------------------------------------------
+	# With --notch, notch filter the gyros at the motor frequencies, checking up front that it
+	# fits in the time between samples.
+	#-------------------------------------------------------------------------------------------
+	notch_bank = None
+	if config.notch:
+		notch_bank = NotchFilterBank(esc_list, sample_rate)
+		sample_cost = notch_bank.benchmark(sample_rate)
+		logger.critical("gyro notch filters %fus per sample of a %fus sample period", sample_cost, 1000000 / sample_rate)
+
+	#-------------------------------------------------------------------------------------------
+	# With --kf, estimate velocity and accelerometer bias with a Kalman filter
+	#-------------------------------------------------------------------------------------------
+	if config.kalman:
+		velocity_estimator = KalmanVelocity()
+		ground_cost, flight_cost = velocity_estimator.benchmark(int(config.motion_frequency), motion_period)
+		logger.critical("kalman velocity %fus per step on the ground, %fus in flight", ground_cost, flight_cost)
+
+	#-------------------------------------------------------------------------------------------
+	# With --mp, hand the sensors over to their own process, and likewise the diagnostics logging.
+	# From here on, the flight loop must not touch the I2C bus directly.
+	#-------------------------------------------------------------------------------------------
+	sensor_source = mpu6050
+	if config.multi_process:
+		sensor_process = SensorProcess(mpu6050)
+		sensor_source = sensor_process
+		if config.diagnostics and not config.flight_recording:
+			telemetry_process = TelemetryProcess("/dev/shm/qclogs", diagnostics_schema)
+
+	#-------------------------------------------------------------------------------------------
+	# With --imu, read the extra IMUs and vote on every sample, checking up front that the reads
+	# and vote fit in the time between samples.
+	#-------------------------------------------------------------------------------------------
+	if len(extra_imus) > 0:
+		imu_voter = ImuVoter([ImuReader(bus, address, imu, mpu6050) for bus, address, imu in extra_imus])
+		sample_cost = imu_voter.benchmark(sensor_source, sample_rate)
+		logger.critical("imu reads and voting %fus per sample of a %fus sample period", sample_cost, 1000000 / sample_rate)
+
+	#-------------------------------------------------------------------------------------------
+	# Stream live telemetry if asked, decimated from the motion processing rate
+	#-------------------------------------------------------------------------------------------
+	if config.udp_address is not None:
+		telemetry_publisher = TelemetryPublisher(config.udp_address, max(1, int(round(config.motion_frequency / config.udp_rate))), esc_list)
+
+	#-------------------------------------------------------------------------------------------
+	# Serve the loop health metrics if asked
 	#-------------------------------------------------------------------------------------------
-	if diagnostics:
-		logger.warning('time, dt, loop, temp, temp_raw, tpp, tpi, tpd, qgx, qgy, qgz, qax, qay, qaz, efrgv_x, efrgv_y, efrgv_z, qfrgv_x, qfrgv_y, qfrgv_z, qvx_input, qvy_input, qvz_input, epa, era, eta, pa, ra, ya, evx_target, qvx_target, qxp, qxi, qxd, pr_target, prp, pri, prd, pr_out, evy_yarget, qvy_target, qyp, qyi, qyd, rr_target, rrp, rri, rrd, rr_out, evz_target, qvz_target, qzp, qzi, qzd, qvz_out, yr_target, yrp, yri, yrd, yr_out, FL spin, FR spin, BL spin, BR spin')
+	flight_metrics = None
+	if config.metrics_address is not None:
+		metrics_registry = MetricsRegistry()
+		flight_metrics = FlightMetrics(metrics_registry, esc_list)
+		try:
+			metrics_server = MetricsServer(metrics_registry, config.metrics_address)
+		except socket.error, err:
+			logger.critical("Can't serve metrics on %s: %s", config.metrics_address, err)
+			CleanShutdown()
 
 	#===========================================================================================
 	# Initialize critical timing immediately before starting the PIDs.  This is done by reading
-	# the sensors, and that also gives us a starting position of the rolling average from.
+	# the sensors, and that also gives us a starting position of the rolling average from.  The
+	# startup benchmarks and set up above take time, so they all stay ahead of this read, or the
+	# first motion period would span them.
 	#===========================================================================================
+	sensor_source.readSensorsRaw()
 
 	#-------------------------------------------------------------------------------------------
 	# Start the yaw absolute angle PID
@@ -1712,12 +5018,71 @@ def go():
 	integration_start = time_now
 	last_temp_check = time_now
 
+	#-------------------------------------------------------------------------------------------
+	# With --fixed, integrate in integer raw counts x integer microseconds
+	#-------------------------------------------------------------------------------------------
+	if config.fixed_point:
+		integration_start_us = int(integration_start * 1000000)
+		last_sample_us = integration_start_us
+
+		qax_sum = 0
+		qay_sum = 0
+		qaz_sum = 0
+		qgx_sum = 0
+		qgy_sum = 0
+		qgz_sum = 0
+
+	#-------------------------------------------------------------------------------------------
+	# Listen for ground station commands if asked
+	#-------------------------------------------------------------------------------------------
+	if config.command_port is not None:
+		command_channel = CommandChannel(config.command_port, {"vv": [qvz_pid], "hv": [qvx_pid, qvy_pid], "ya": [ya_pid], "pr": [pr_pid], "rr": [rr_pid], "yr": [yr_pid]})
+
+	#-------------------------------------------------------------------------------------------
+	# Publish the tunables for live editing if asked.  A decimation filter is designed for the
+	# motion frequency it was built with, so that is pinned while one is in use.
+	#-------------------------------------------------------------------------------------------
+	if config.live_tuning:
+		tuning_fields = TUNING_FIELDS
+		if decimator is not None:
+			tuning_fields = [(field, attribute, config.motion_frequency, config.motion_frequency) if field == "motion_frequency" else (field, attribute, minimum, maximum) for field, attribute, minimum, maximum in TUNING_FIELDS]
+
+		tuning = TuningConfig("qctuning", tuning_fields, config,
+				      {"vv": [(qvz_pid, 1.0)], "hv": [(qvx_pid, 1.0), (qvy_pid, 1.0)], "pr": [(pr_pid, 1.0)], "rr": [(rr_pid, 1.0), (yr_pid, 0.5)]})
+
+	#-------------------------------------------------------------------------------------------
+	# Set up the per-stage timing probes unless disabled with --notiming
+	#-------------------------------------------------------------------------------------------
+	if stage_timing:
+		stage_timer = StageTimer(STAGE_NAMES)
+		probe_time = time.time()
+
+	#-------------------------------------------------------------------------------------------
+	# Set up the motion processing deadline monitor
+	#-------------------------------------------------------------------------------------------
+	deadline_monitor = DeadlineMonitor(motion_period, time_now)
+	degradation_level = DEGRADE_NONE
+	outer_loop_count = 0
+
+	#-------------------------------------------------------------------------------------------
+	# Profile the flight loop if asked
+	#-------------------------------------------------------------------------------------------
+	if config.profile_rate is not None:
+		profiler = SamplingProfiler(threading.current_thread().ident, config.profile_rate)
+
 	while keep_looping:
 		#===================================================================================
 		# Sensors: Read the sensor values; note that this also sets the time_now to be as
 		# accurate a time stamp for the sensor data as possible.
 		#===================================================================================
-		qax, qay, qaz, qgx, qgy, qgz = mpu6050.readSensorsRaw()
+		qax, qay, qaz, qgx, qgy, qgz = sensor_source.readSensorsRaw()
+
+		if imu_voter is not None:
+			qax, qay, qaz, qgx, qgy, qgz = imu_voter.vote(time_now, qax, qay, qaz, qgx, qgy, qgz)
+
+		if stage_timing:
+			stage_timer.record(STAGE_SENSOR_WAIT, time_ready - probe_time)
+			probe_time = stage_timer.lap(STAGE_I2C_READ, time_ready)
 
 		#-----------------------------------------------------------------------------------
 		# Now we have the sensor snapshot, tidy up the rest of the variable so that processing
@@ -1727,24 +5092,59 @@ def go():
 		elapsed_time = time_now - start_time
 		loop_count += 1
 
+		if flight_metrics is not None:
+			flight_metrics.sample_interval.observe(delta_time)
+
 		#===================================================================================
 		# Integration: Sensor data is integrated over time, and later averaged to produce
 		# smoother yet still accurate acceleration and rotation since the last PID updates.
 		#===================================================================================
 
-		#-----------------------------------------------------------------------------------
-		# Integrate the accelerometer readings.
-		#-----------------------------------------------------------------------------------
-		qax_integrated += qax * delta_time
-		qay_integrated += qay * delta_time
-		qaz_integrated += qaz * delta_time
+		if vibration_monitor is not None:
+			vibration_monitor.sample(qax, qay, qaz, qgx, qgy, qgz)
 
-		#-----------------------------------------------------------------------------------
-		# Integrate the gyros readings.
-		#-----------------------------------------------------------------------------------
-		qgx_integrated += qgx * delta_time
-		qgy_integrated += qgy * delta_time
-		qgz_integrated += qgz * delta_time
+		if raw_recorder is not None:
+			raw_recorder.log(time_now, qax, qay, qaz, qgx, qgy, qgz)
+
+		if notch_bank is not None:
+			qgx, qgy, qgz = notch_bank.sample(qgx, qgy, qgz)
+
+		if decimator is not None:
+			decimator.sample(qax, qay, qaz, qgx, qgy, qgz)
+
+		elif config.fixed_point:
+			#---------------------------------------------------------------------------
+			# Integrate the accelerometer and gyro readings exactly in integers.
+			#---------------------------------------------------------------------------
+			sample_us = int(time_now * 1000000)
+			delta_us = sample_us - last_sample_us
+			last_sample_us = sample_us
+
+			qax_sum += qax * delta_us
+			qay_sum += qay * delta_us
+			qaz_sum += qaz * delta_us
+
+			qgx_sum += qgx * delta_us
+			qgy_sum += qgy * delta_us
+			qgz_sum += qgz * delta_us
+
+		else:
+			#---------------------------------------------------------------------------
+			# Integrate the accelerometer readings.
+			#---------------------------------------------------------------------------
+			qax_integrated += qax * delta_time
+			qay_integrated += qay * delta_time
+			qaz_integrated += qaz * delta_time
+
+			#---------------------------------------------------------------------------
+			# Integrate the gyros readings.
+			#---------------------------------------------------------------------------
+			qgx_integrated += qgx * delta_time
+			qgy_integrated += qgy * delta_time
+			qgz_integrated += qgz * delta_time
+
+		if stage_timing:
+			probe_time = stage_timer.lap(STAGE_INTEGRATION, probe_time)
 
 		#===================================================================================
 		# Motion Processing:  Use the recorded data to produce motion data and feed in the motion PIDs
@@ -1752,6 +5152,26 @@ def go():
 		if time_now - last_motion_update >= motion_period:
 			last_motion_update += motion_period
 
+			#---------------------------------------------------------------------------
+			# Ground station commands received during the last motion period all take
+			# effect now, before anything uses them.
+			#---------------------------------------------------------------------------
+			if command_channel is not None:
+				command_channel.apply(time.time())
+
+			#---------------------------------------------------------------------------
+			# Likewise a new set of tunables from qctune.py
+			#---------------------------------------------------------------------------
+			if tuning is not None and tuning.check():
+				motion_period = 1 / config.motion_frequency
+				deadline_monitor.motion_period = motion_period
+
+			#---------------------------------------------------------------------------
+			# Follow the motor speeds with the gyro notch filters, a notch at a time.
+			#---------------------------------------------------------------------------
+			if notch_bank is not None:
+				notch_bank.retune()
+
 			#---------------------------------------------------------------------------
 			# Work out the average acceleration and rotation rate
 			#---------------------------------------------------------------------------
@@ -1759,24 +5179,40 @@ def go():
 			integration_start = time_now
 
 			#---------------------------------------------------------------------------
-			# Sort out calibration and units
+			# Sort out calibration and units, and clear the integration for next time
+			# round
 			#---------------------------------------------------------------------------
-			qax, qay, qaz, qgx, qgy, qgz = mpu6050.rawCorrection(qax_integrated / integration_period,
-									     qay_integrated / integration_period,
-									     qaz_integrated / integration_period,
-									     qgx_integrated / integration_period,
-									     qgy_integrated / integration_period,
-									     qgz_integrated / integration_period)
+			if decimator is not None:
+				qax, qay, qaz, qgx, qgy, qgz = mpu6050.rawCorrection(*decimator.output())
 
-			#---------------------------------------------------------------------------
-			# Clear the integration for next time round
-			#---------------------------------------------------------------------------
-			qgx_integrated = 0.0
-			qgy_integrated = 0.0
-			qgz_integrated = 0.0
-			qax_integrated = 0.0
-			qay_integrated = 0.0
-			qaz_integrated = 0.0
+			elif config.fixed_point:
+				qax, qay, qaz, qgx, qgy, qgz = mpu6050.rawCorrectionFixed(qax_sum, qay_sum, qaz_sum, qgx_sum, qgy_sum, qgz_sum, last_sample_us - integration_start_us)
+				integration_start_us = last_sample_us
+
+				qgx_sum = 0
+				qgy_sum = 0
+				qgz_sum = 0
+				qax_sum = 0
+				qay_sum = 0
+				qaz_sum = 0
+
+			else:
+				qax, qay, qaz, qgx, qgy, qgz = mpu6050.rawCorrection(qax_integrated / integration_period,
+										     qay_integrated / integration_period,
+										     qaz_integrated / integration_period,
+										     qgx_integrated / integration_period,
+										     qgy_integrated / integration_period,
+										     qgz_integrated / integration_period)
+
+				qgx_integrated = 0.0
+				qgy_integrated = 0.0
+				qgz_integrated = 0.0
+				qax_integrated = 0.0
+				qay_integrated = 0.0
+				qaz_integrated = 0.0
+
+			if stage_timing:
+				probe_time = stage_timer.lap(STAGE_RAW_CORRECTION, probe_time)
 
 			#===========================================================================
 			# Angles: Get angles in radians
@@ -1792,31 +5228,53 @@ def go():
 			#---------------------------------------------------------------------------
 			# Merge with a complementary filter and fill in the blanks
 			#---------------------------------------------------------------------------
-			tau_fraction = tau / (tau + integration_period)
+			tau_fraction = config.tau / (config.tau + integration_period)
 			pa = tau_fraction * (pa + epr * integration_period) + (1 - tau_fraction) * epa
 			ra = tau_fraction * (ra + err * integration_period) + (1 - tau_fraction) * era
 			ta = eta
 			ya += qgz * integration_period
 
+			if stage_timing:
+				probe_time = stage_timer.lap(STAGE_FUSION, probe_time)
+
 			#---------------------------------------------------------------------------
 			# Get the curent flight plan targets
 			#---------------------------------------------------------------------------
 			if not ready_to_fly:
-				if hover_speed >= hover_target:
-					hover_speed = hover_target
+				if hover_speed >= config.hover_target:
+					hover_speed = config.hover_target
 					ready_to_fly = True	
 
 					#-----------------------------------------------------------
 					# Register the flight plan with the authorities
 					#-----------------------------------------------------------
-					fp = FlightPlan(time_now)
+					fp.start(time_now)
 
 				else:
-					hover_speed += int(hover_target * motion_period / rtf_period)
+					hover_speed += int(config.hover_target * motion_period / config.rtf_period)
 
 			else:
+				#-------------------------------------------------------------------
+				# A hover target tuned in flight is reached at the spin up rate
+				#-------------------------------------------------------------------
+				if hover_speed != config.hover_target:
+					hover_step = max(1, int(config.hover_target * motion_period / config.rtf_period))
+					if hover_speed < config.hover_target:
+						hover_speed = min(hover_speed + hover_step, config.hover_target)
+					else:
+						hover_speed = max(hover_speed - hover_step, config.hover_target)
+
 				evx_target, evy_target, evz_target = fp.getTargets(time_now)
 
+				#-------------------------------------------------------------------
+				# Ground station velocity targets override the flight plan's
+				#-------------------------------------------------------------------
+				if command_channel is not None and command_channel.targets is not None:
+					evx_target, evy_target, evz_target = command_channel.targets
+
+			if stage_timing:
+				probe_time = stage_timer.lap(STAGE_FLIGHT_PLAN, probe_time)
+
 			#---------------------------------------------------------------------------
 			# Convert earth-frame velocity targets to quadcopter frame.
 			#---------------------------------------------------------------------------
@@ -1829,11 +5287,22 @@ def go():
 
 			#---------------------------------------------------------------------------
 			# Delete reorientated gravity from raw accelerometer readings and sum to make
-			# velocity all in quad frame
+			# velocity all in quad frame, or with --kf, estimate it.  Until it's ready to
+			# fly, the quad is still on the ground.
 			#---------------------------------------------------------------------------
-			qvx_input += (qax - gax) * integration_period * GRAV_ACCEL
-			qvy_input += (qay - gay) * integration_period * GRAV_ACCEL
-			qvz_input += (qaz - gaz) * integration_period * GRAV_ACCEL
+			if velocity_estimator is not None:
+				qvx_input, qvy_input, qvz_input = velocity_estimator.step((qax - gax) * GRAV_ACCEL,
+											  (qay - gay) * GRAV_ACCEL,
+											  (qaz - gaz) * GRAV_ACCEL,
+											  integration_period,
+											  not ready_to_fly)
+			else:
+				qvx_input += (qax - gax) * integration_period * GRAV_ACCEL
+				qvy_input += (qay - gay) * integration_period * GRAV_ACCEL
+				qvz_input += (qaz - gaz) * integration_period * GRAV_ACCEL
+
+			if stage_timing:
+				probe_time = stage_timer.lap(STAGE_VELOCITY, probe_time)
 
 			#===========================================================================
 			# Temperaure PID: maintain a constant temperature for reading other sensors
@@ -1843,26 +5312,35 @@ def go():
 					logger.critical("Flight temperature range exceeded: %foC", temp_now / 340 + 36.53);
 					last_temp_check += 1.0
 
-			[p_out, i_out, d_out] = temp_pid.Compute(temp_now, MPU6050_TEMP_TARGET, time_now)
-			temp_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-			temp_out = p_out + i_out + d_out
-			heater.update(temp_out)
+			if degradation_level < DEGRADE_HEATER:
+				[p_out, i_out, d_out] = temp_pid.Compute(temp_now, MPU6050_TEMP_TARGET, time_now)
+				temp_diags = (p_out, i_out, d_out)
+				temp_out = p_out + i_out + d_out
+				heater.update(temp_out)
+
+			if stage_timing:
+				probe_time = stage_timer.lap(STAGE_HEATER, probe_time)
 
 			#===========================================================================
 			# Motion PIDs: Run the horizontal speed PIDs each rotation axis to determine
 			# targets for absolute angle PIDs and the verical speed PID to control height.
+			# Under CPU pressure, these outer loops only run every other motion period.
 			#===========================================================================
-			[p_out, i_out, d_out] = qvx_pid.Compute(qvx_input, qvx_target, time_now)
-			qvx_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-			qvx_out = p_out + i_out + d_out
+			outer_loop_count += 1
+			run_outer_loop = degradation_level < DEGRADE_OUTER_LOOP or outer_loop_count % 2 == 0
 
-			[p_out, i_out, d_out] = qvy_pid.Compute(qvy_input, qvy_target, time_now)
-			qvy_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-			qvy_out =  p_out + i_out + d_out
+			if run_outer_loop:
+				[p_out, i_out, d_out] = qvx_pid.Compute(qvx_input, qvx_target, time_now)
+				qvx_diags = (p_out, i_out, d_out)
+				qvx_out = p_out + i_out + d_out
 
-			[p_out, i_out, d_out] = qvz_pid.Compute(qvz_input, qvz_target, time_now)
-			qvz_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-			qvz_out = p_out + i_out + d_out
+				[p_out, i_out, d_out] = qvy_pid.Compute(qvy_input, qvy_target, time_now)
+				qvy_diags = (p_out, i_out, d_out)
+				qvy_out =  p_out + i_out + d_out
+
+				[p_out, i_out, d_out] = qvz_pid.Compute(qvz_input, qvz_target, time_now)
+				qvz_diags = (p_out, i_out, d_out)
+				qvz_out = p_out + i_out + d_out
 
 			#---------------------------------------------------------------------------
 			# Convert the horizontal velocity PID output i.e. the horizontal acceleration
@@ -1887,18 +5365,19 @@ def go():
 			# Attitude PIDs: Run the rotation rate PIDs each rotation axis to determine
 			# overall PWM output.
 			#===========================================================================
-			[p_out, i_out, d_out] = ya_pid.Compute(ya, ya_target, time_now)
-			ya_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-			yr_target = p_out + i_out + d_out
+			if run_outer_loop:
+				[p_out, i_out, d_out] = ya_pid.Compute(ya, ya_target, time_now)
+				ya_diags = (p_out, i_out, d_out)
+				yr_target = p_out + i_out + d_out
 
 			[p_out, i_out, d_out] = pr_pid.Compute(qgy, pr_target, time_now)
-			pr_diags = "%f, %f, %f" % (p_out, i_out, d_out)
+			pr_diags = (p_out, i_out, d_out)
 			pr_out = p_out + i_out + d_out
 			[p_out, i_out, d_out] = rr_pid.Compute(qgx, rr_target, time_now)
-			rr_diags = "%f, %f, %f" % (p_out, i_out, d_out)
+			rr_diags = (p_out, i_out, d_out)
 			rr_out = p_out + i_out + d_out
 			[p_out, i_out, d_out] = yr_pid.Compute(qgz, yr_target, time_now)
-			yr_diags = "%f, %f, %f" % (p_out, i_out, d_out)
+			yr_diags = (p_out, i_out, d_out)
 			yr_out = p_out + i_out + d_out
 
 			#---------------------------------------------------------------------------
@@ -1908,59 +5387,57 @@ def go():
 			rr_out = int(round(rr_out / 2))
 			yr_out = int(round(yr_out / 2))
 
+			if stage_timing:
+				probe_time = stage_timer.lap(STAGE_PIDS, probe_time)
+
 			#===========================================================================
-			# PID output distribution: Walk through the ESCs, and apply the PID outputs
-			# i.e. the updates PWM pulse widths according to where the ESC is sited on the
-			# frame
+			# PID output distribution: Mix the PID outputs into each ESC's updated PWM
+			# pulse width according to where the ESC is sited on the frame
 			#===========================================================================
-			for esc in esc_list:
-				#-------------------------------------------------------------------
-				# Update all blades' power in accordance with the z error
-				#-------------------------------------------------------------------
-				delta_spin = vert_out
+			mixer.update(vert_out, pr_out, rr_out, yr_out)
 
-				#-------------------------------------------------------------------
-				# For a left downwards roll, the x gyro goes negative, so the PID error is positive,
-				# meaning PID output is positive, meaning this needs to be added to the left blades
-				# and subtracted from the right.
-				#-------------------------------------------------------------------
-				if esc.motor_location & MOTOR_LOCATION_RIGHT:
-					delta_spin -= rr_out
-				else:
-					delta_spin += rr_out
+			if stage_timing:
+				probe_time = stage_timer.lap(STAGE_ESC_UPDATE, probe_time)
 
-				#-------------------------------------------------------------------
-				# For a forward downwards pitch, the y gyro goes positive, but is negated
-				# in mpu6050.readSensors() so it is consistent with the accelerometer +
-				# Euler angle calculations.  The PID error is postive as a result,
-				# meaning PID output is positive, meaning this needs to be added to the
-				# front blades and subtracted from the back.
-				#-------------------------------------------------------------------
-				if esc.motor_location & MOTOR_LOCATION_BACK:
-					delta_spin += pr_out
+			#---------------------------------------------------------------------------
+			# Diagnostic log - every motion loop
+			#---------------------------------------------------------------------------
+			if config.diagnostics and degradation_level < DEGRADE_DIAGNOSTICS:
+				diags = (elapsed_time, integration_period, loop_count, temp_now / 340 + 36.53, temp_now) + temp_diags + (qgx, qgy, qgz, qax, qay, qaz, eax, eay, eaz, gax, gay, gaz, qvx_input, qvy_input, qvz_input, math.degrees(epa), math.degrees(era), math.degrees(eta), math.degrees(pa), math.degrees(ra), math.degrees(ya), evx_target, qvx_target) + qvx_diags + (math.degrees(pr_target),) + pr_diags + (pr_out, evy_target, qvy_target) + qvy_diags + (math.degrees(rr_target),) + rr_diags + (rr_out, evz_target, qvz_target) + qvz_diags + (qvz_out, yr_target) + yr_diags + (yr_out,) + tuple([esc.pulse_width for esc in esc_list])
+				if flight_recorder is not None:
+					flight_recorder.log(*diags)
+				elif telemetry_process is not None:
+					telemetry_process.log(*diags)
 				else:
-					delta_spin -= pr_out
+					logger.warning(diagnostics_format, *diags)
 
-				#-------------------------------------------------------------------
-				# For CW yaw, the z gyro goes negative, so the PID error is postitive,
-				# meaning PID output is positive, meaning this need to be added to the
-				# ACW (FL and BR) blades and subtracted from the CW (FR & BL) blades.
-				#-------------------------------------------------------------------
-				if esc.motor_rotation == MOTOR_ROTATION_CW:
-					delta_spin += yr_out
-				else:
-					delta_spin -= yr_out
+				if stage_timing:
+					probe_time = stage_timer.lap(STAGE_DIAGNOSTICS, probe_time)
 
-				#-------------------------------------------------------------------
-				# Apply the blended outputs to the esc PWM signal
-				#-------------------------------------------------------------------
-				esc.update(delta_spin)
+			#---------------------------------------------------------------------------
+			# Loop health metrics
+			#---------------------------------------------------------------------------
+			if flight_metrics is not None:
+				mpu6050_misses, i2c_misses = sensor_source.getMisses()
+				flight_metrics.update(loop_count, elapsed_time, integration_period, temp_now, mpu6050_misses, i2c_misses, degradation_level)
 
 			#---------------------------------------------------------------------------
-			# Diagnostic log - every motion loop
+			# Live telemetry
+			#---------------------------------------------------------------------------
+			if telemetry_publisher is not None:
+				telemetry_publisher.publish(elapsed_time, math.degrees(pa), math.degrees(ra), math.degrees(ya), qvx_input, qvy_input, qvz_input, pr_out, rr_out, yr_out, qvz_out, temp_now / 340 + 36.53, loop_count, integration_period, degradation_level)
+
+			#---------------------------------------------------------------------------
+			# Pick up any ground station commands, ready for the next motion period
+			#---------------------------------------------------------------------------
+			if command_channel is not None:
+				command_channel.poll()
+
+			#---------------------------------------------------------------------------
+			# Check this motion period finished before the next was due, shedding or
+			# restoring load accordingly.
 			#---------------------------------------------------------------------------
-			if diagnostics:
-				logger.warning('%f, %f, %d, %f, %d, %s, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %s, %f, %s, %d, %f, %f, %s, %f, %s, %d, %f, %f, %s, %d, %f, %s, %d, %d, %d, %d, %d', elapsed_time, integration_period, loop_count, temp_now / 340 + 36.53, temp_now, temp_diags, qgx, qgy, qgz, qax, qay, qaz, eax, eay, eaz, gax, gay, gaz, qvx_input, qvy_input, qvz_input, math.degrees(epa), math.degrees(era), math.degrees(eta), math.degrees(pa), math.degrees(ra), math.degrees(ya), evx_target, qvx_target, qvx_diags, math.degrees(pr_target), pr_diags, pr_out, evy_target, qvy_target, qvy_diags, math.degrees(rr_target), rr_diags, rr_out, evz_target, qvz_target, qvz_diags, qvz_out, yr_target, yr_diags, yr_out, esc_list[0].pulse_width, esc_list[1].pulse_width, esc_list[2].pulse_width, esc_list[3].pulse_width)
+			last_motion_update, degradation_level = deadline_monitor.check(last_motion_update, time.time())
 
 
 	#-------------------------------------------------------------------------------------------
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Hove's Raspberry Pi Python Quadcopter Flight Controller.  Open Source @ GitHub            ##
+## PiStuffing/Quadcopter under GPL for non-commercial application.  Any code derived from    ##
+## this should retain this copyright comment.                                                ##
+##                                                                                           ##
+## Copyright 2014 Andy Baker (Hove) - andy@pistuffing.co.uk                                  ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+####################################################################################################
+#
+# Offline analysis of the diagnostics (-d) in qcstats<date>.csv[.gz] logs, or flight recorder (--fr)
+# qcrecord<date>.bin files.
+#
+# A text log is parsed just once into a columnar cache beside it - <log>.npy holding one contiguous
+# column per diagnostic, <log>.columns holding the names from the diagnostics header, and <log>.phases
+# the FlightPlan phases in the order flown - which later runs memory-map rather than re-parse.  The
+# extra "phase" column indexes each row's phase in <log>.phases.
+#
+####################################################################################################
+
+from __future__ import division
+import sys
+import os
+import gzip
+import getopt
+import numpy
+
+import qcrecord
+
+#---------------------------------------------------------------------------------------------------
+# The PID output terms by PID, in diagnostics column names
+#---------------------------------------------------------------------------------------------------
+PID_TERMS = [("temperature", ["tpp", "tpi", "tpd"]),
+	     ("x velocity", ["qxp", "qxi", "qxd"]),
+	     ("y velocity", ["qyp", "qyi", "qyd"]),
+	     ("z velocity", ["qzp", "qzi", "qzd"]),
+	     ("pitch rate", ["prp", "pri", "prd"]),
+	     ("roll rate", ["rrp", "rri", "rrd"]),
+	     ("yaw rate", ["yrp", "yri", "yrd"])]
+
+ESC_SUFFIX = " spin"
+ESC_MIN_PULSE_WIDTH = 1000
+ESC_MAX_PULSE_WIDTH = 2000
+
+TEMP_TARGET = 40.0
+TEMP_RANGE = 1.0
+
+#---------------------------------------------------------------------------------------------------
+# Motion periods before the first FlightPlan phase change are the ready-to-fly spin up; flight
+# recorder files carry no phases at all.
+#---------------------------------------------------------------------------------------------------
+FIRST_PHASE = "RTF"
+UNPHASED = "FLIGHT"
+
+####################################################################################################
+#
+# Columnar flight diagnostics: a 2D array with one column per diagnostic and the column names
+#
+####################################################################################################
+class Flight:
+
+	def __init__(self, name, names, data, phases):
+		self.name = name
+		self.names = names
+		self.index = dict([(column, index) for index, column in enumerate(names)])
+		self.data = data
+		self.phases = phases
+
+	def __getitem__(self, column):
+		return self.data[:, self.index[column]]
+
+	def __len__(self):
+		return self.data.shape[0]
+
+####################################################################################################
+#
+# Parse a text log: lines are "[LEVEL] (thread) funcName lineno, message", so the message is
+# everything after the first ", ".  The diagnostics header names the columns, and every later message
+# with that many numeric fields is a row.  FlightPlan.getTargets logs the name of each new phase.
+#
+####################################################################################################
+def ParseLog(file_name):
+	if file_name.endswith('.gz'):
+		log_file = gzip.open(file_name, 'rb')
+	else:
+		log_file = open(file_name, 'r')
+
+	names = None
+	rows = []
+	phases = [FIRST_PHASE]
+	with log_file:
+		for line in log_file:
+			fields = line.rstrip('\n').split(', ')
+			if len(fields) < 2:
+				continue
+
+			if len(fields) == 2 and ' getTargets ' in fields[0]:
+				phases.append(fields[1])
+				continue
+
+			if names is None:
+				if fields[1] == 'time' and fields[2] == 'dt':
+					names = fields[1:]
+				continue
+
+			if len(fields) != len(names) + 1:
+				continue
+
+			try:
+				rows.append([float(field) for field in fields[1:]] + [len(phases) - 1])
+			except ValueError:
+				continue
+
+	if names is None:
+		raise ValueError("%s has no diagnostics header - was it flown with -d?" % file_name)
+
+	names.append("phase")
+	return names, numpy.array(rows, dtype=numpy.float64).reshape(len(rows), len(names)), phases
+
+####################################################################################################
+#
+# Load a flight, from the cache if it's newer than the log
+#
+####################################################################################################
+def LoadFlight(file_name):
+	if file_name.endswith('.bin'):
+		records = qcrecord.LoadNumpy(file_name)
+		names = list(records.dtype.names)
+		data = numpy.zeros((len(records), len(names) + 1), dtype=numpy.float64, order='F')
+		for index, column in enumerate(names):
+			data[:, index] = records[column]
+		return Flight(file_name, names + ["phase"], data, [UNPHASED])
+
+	cache_name = file_name + '.npy'
+	columns_name = file_name + '.columns'
+	phases_name = file_name + '.phases'
+
+	if os.path.exists(cache_name) and os.path.exists(columns_name) and os.path.exists(phases_name) and os.path.getmtime(cache_name) >= os.path.getmtime(file_name):
+		with open(columns_name, 'r') as columns_file:
+			names = columns_file.read().split('\n')
+		with open(phases_name, 'r') as phases_file:
+			phases = phases_file.read().split('\n')
+		return Flight(file_name, names, numpy.load(cache_name, mmap_mode='r'), phases)
+
+	names, data, phases = ParseLog(file_name)
+
+	#-------------------------------------------------------------------------------------------
+	# Fortran order so each column is contiguous on disk and in the memory map
+	#-------------------------------------------------------------------------------------------
+	data = numpy.asfortranarray(data)
+	numpy.save(cache_name, data)
+	with open(columns_name, 'w') as columns_file:
+		columns_file.write('\n'.join(names))
+	with open(phases_name, 'w') as phases_file:
+		phases_file.write('\n'.join(phases))
+
+	return Flight(file_name, names, data, phases)
+
+####################################################################################################
+#
+# Loop rate: sensor loops per second across each motion period, and the motion period itself
+#
+####################################################################################################
+def LoopRate(flight):
+	time = flight["time"]
+	dt = flight["dt"]
+	loops = flight["loop"]
+
+	print "  loop rate: %f loops per second overall" % (loops[-1] / time[-1])
+	rates = numpy.diff(loops) / numpy.diff(time)
+	print "  loop rate: min %f, mean %f, max %f loops per second" % (rates.min(), rates.mean(), rates.max())
+	print "  motion dt: min %f, mean %f, max %f, std %fs" % (dt.min(), dt.mean(), dt.max(), dt.std())
+
+####################################################################################################
+#
+# PID term ranges
+#
+####################################################################################################
+def PidRanges(flight):
+	for pid, terms in PID_TERMS:
+		ranges = []
+		for term, column in zip("PID", terms):
+			values = flight[column]
+			ranges.append("%s [%f, %f]" % (term, values.min(), values.max()))
+		print "  %-12s %s" % (pid, ", ".join(ranges))
+
+####################################################################################################
+#
+# ESC saturation: time each ESC's spin column, however many the frame has, spent at either end of
+# the pulse width range
+#
+####################################################################################################
+def EscSaturation(flight):
+	dt = flight["dt"]
+	for column in [name for name in flight.names if name.endswith(ESC_SUFFIX)]:
+		spin = flight[column]
+		low = dt[spin <= ESC_MIN_PULSE_WIDTH].sum()
+		high = dt[spin >= ESC_MAX_PULSE_WIDTH].sum()
+		print "  %-8s min %fs, max %fs" % (column, low, high)
+
+####################################################################################################
+#
+# Temperature excursions: time spent more than TEMP_RANGE from TEMP_TARGET
+#
+####################################################################################################
+def TempExcursions(flight):
+	dt = flight["dt"]
+	temp = flight["temp"]
+	outside = numpy.fabs(temp - TEMP_TARGET) > TEMP_RANGE
+	print "  temp: min %foC, max %foC, %fs outside %.1f +/- %.1foC" % (temp.min(), temp.max(), dt[outside].sum(), TEMP_TARGET, TEMP_RANGE)
+
+COMMANDS = {"rate": LoopRate, "pid": PidRanges, "esc": EscSaturation, "temp": TempExcursions}
+
+####################################################################################################
+#
+# qcanalyse.py [-c commands] log...
+#
+####################################################################################################
+def Usage():
+	print 'qcanalyse.py [-c rate,pid,esc,temp] log...'
+	print '  -c ??  comma separated summaries to run (default all)'
+	print '         rate  loop rate and motion period statistics'
+	print '         pid   PID term ranges'
+	print '         esc   ESC saturation time'
+	print '         temp  temperature excursions'
+	sys.exit(2)
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'c:')
+	except getopt.GetoptError:
+		Usage()
+
+	if len(args) == 0:
+		Usage()
+
+	commands = ["rate", "pid", "esc", "temp"]
+	for opt, arg in opts:
+		if opt == '-c':
+			commands = arg.split(',')
+
+	for command in commands:
+		if command not in COMMANDS:
+			Usage()
+
+	for file_name in args:
+		flight = LoadFlight(file_name)
+		print "%s: %d motion periods" % (file_name, len(flight))
+		for command in commands:
+			COMMANDS[command](flight)
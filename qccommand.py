@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Hove's Raspberry Pi Python Quadcopter Flight Controller.  Open Source @ GitHub            ##
+## PiStuffing/Quadcopter under GPL for non-commercial application.  Any code derived from    ##
+## this should retain this copyright comment.                                                ##
+##                                                                                           ##
+## Copyright 2014 Andy Baker (Hove) - andy@pistuffing.co.uk                                  ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+####################################################################################################
+#
+# Ground station sender for Quadcopter.py --cmd port.  Each argument is sent as one command, and the
+# replies - rejection reasons, or the latency from receipt to taking effect - are printed, e.g.
+#
+#     qccommand.py -a phoebe.local:5006 "gain pr 95 0 0" "vel 0 0 0.2"
+#
+# See CommandChannel in Quadcopter.py for the commands.
+#
+####################################################################################################
+
+from __future__ import division
+import socket
+import sys
+import getopt
+
+####################################################################################################
+#
+# Send the commands, then print replies until none arrives within timeout seconds
+#
+####################################################################################################
+def Send(address, commands, timeout):
+	sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sender.settimeout(timeout)
+
+	for command in commands:
+		sender.sendto(command, address)
+
+	replies = 0
+	while replies < len(commands):
+		try:
+			reply, flyer = sender.recvfrom(256)
+		except socket.timeout:
+			break
+		print reply
+		replies += 1
+
+	sender.close()
+	return replies
+
+####################################################################################################
+#
+# qccommand.py -a host:port [-w timeout] command...
+#
+####################################################################################################
+def Usage():
+	print 'qccommand.py -a host:port [-w timeout] command...'
+	print '  -a ??  host:port the quadcopter is listening on with --cmd'
+	print '  -w ??  seconds to wait for each reply (default 1.0)'
+	print '  vel <evx> <evy> <evz> | vel off | gain <vv|hv|ya|pr|rr|yr> <p> <i> <d> | abort'
+	sys.exit(2)
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'a:w:')
+	except getopt.GetoptError:
+		Usage()
+
+	address = None
+	timeout = 1.0
+	for opt, arg in opts:
+		if opt == '-a':
+			host, port = arg.rsplit(':', 1)
+			address = (host, int(port))
+		elif opt == '-w':
+			timeout = float(arg)
+
+	if address is None or len(args) == 0:
+		Usage()
+
+	sys.exit(0 if Send(address, args, timeout) == len(args) else 1)
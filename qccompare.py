@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Hove's Raspberry Pi Python Quadcopter Flight Controller.  Open Source @ GitHub            ##
+## PiStuffing/Quadcopter under GPL for non-commercial application.  Any code derived from    ##
+## this should retain this copyright comment.                                                ##
+##                                                                                           ##
+## Copyright 2014 Andy Baker (Hove) - andy@pistuffing.co.uk                                  ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+####################################################################################################
+#
+# Flight-to-flight regression report.  Each flight's diagnostics are split by FlightPlan phase, time
+# aligned from the start of each phase, and reduced to per-phase metrics which are then compared
+# against the first (baseline) flight:
+#
+#     vel_err     RMS quad frame velocity tracking error (m/s)
+#     att_rms     RMS pitch / roll angle (degrees)
+#     esc_spread  mean spread between the highest and lowest ESC pulse widths (us)
+#     loop_rate   sensor loops per second
+#     dt_jitter   standard deviation of the motion period (ms)
+#
+####################################################################################################
+
+from __future__ import division
+import sys
+import getopt
+import collections
+import numpy
+
+import qcanalyse
+
+#---------------------------------------------------------------------------------------------------
+# Metric names, and whether a bigger value is a regression
+#---------------------------------------------------------------------------------------------------
+METRICS = [("vel_err", True), ("att_rms", True), ("esc_spread", True), ("loop_rate", False), ("dt_jitter", True)]
+
+####################################################################################################
+#
+# Per-phase metrics for one flight, as an ordered dict of phase name to (motion periods, metrics).
+# Every metric is a per-row quantity summed by phase with bincount, so the cost is a handful of
+# vector operations per flight however many phases there are.  Rows within skip seconds of the
+# start of their phase are left out to ignore the transient at each target change.
+#
+####################################################################################################
+def PhaseMetrics(flight, skip):
+	phase = flight["phase"].astype(numpy.intp)
+	time = flight["time"]
+	dt = flight["dt"]
+	num_phases = len(flight.phases)
+
+	#-------------------------------------------------------------------------------------------
+	# Time since the start of each row's phase
+	#-------------------------------------------------------------------------------------------
+	phase_start = numpy.full(num_phases, numpy.inf)
+	numpy.minimum.at(phase_start, phase, time)
+	keep = (time - phase_start[phase]) >= skip
+
+	phase = phase[keep]
+	dt = dt[keep]
+
+	vel_err_sq = (numpy.square(flight["qvx_target"] - flight["qvx_input"]) +
+		      numpy.square(flight["qvy_target"] - flight["qvy_input"]) +
+		      numpy.square(flight["qvz_target"] - flight["qvz_input"]))[keep]
+	att_sq = (numpy.square(flight["pa"]) + numpy.square(flight["ra"]))[keep]
+
+	spins = numpy.column_stack([flight[column] for column in qcanalyse.ESC_COLUMNS])[keep]
+	esc_spread = spins.max(axis=1) - spins.min(axis=1)
+
+	loops = numpy.diff(flight["loop"], prepend=flight["loop"][0])[keep]
+
+	count = numpy.bincount(phase, minlength=num_phases)
+	total_dt = numpy.bincount(phase, weights=dt, minlength=num_phases)
+	mean_dt = total_dt / numpy.maximum(count, 1)
+	var_dt = numpy.bincount(phase, weights=numpy.square(dt - mean_dt[phase]), minlength=num_phases) / numpy.maximum(count, 1)
+
+	with numpy.errstate(invalid='ignore', divide='ignore'):
+		metrics = numpy.column_stack([numpy.sqrt(numpy.bincount(phase, weights=vel_err_sq, minlength=num_phases) / count),
+					      numpy.sqrt(numpy.bincount(phase, weights=att_sq, minlength=num_phases) / count),
+					      numpy.bincount(phase, weights=esc_spread, minlength=num_phases) / count,
+					      numpy.bincount(phase, weights=loops, minlength=num_phases) / total_dt,
+					      numpy.sqrt(var_dt) * 1000])
+
+	#-------------------------------------------------------------------------------------------
+	# A phase flown more than once is combined, weighted by motion periods
+	#-------------------------------------------------------------------------------------------
+	results = collections.OrderedDict()
+	for index, name in enumerate(flight.phases):
+		if count[index] == 0:
+			continue
+		if name in results:
+			previous_count, previous = results[name]
+			combined = (previous * previous_count + metrics[index] * count[index]) / (previous_count + count[index])
+			results[name] = (previous_count + count[index], combined)
+		else:
+			results[name] = (count[index], metrics[index])
+
+	return results
+
+####################################################################################################
+#
+# Print the per-phase comparison, marking metrics that regressed by more than threshold percent
+# against the baseline flight
+#
+####################################################################################################
+def Report(file_names, results, threshold):
+	phase_order = []
+	for flight_results in results:
+		for name in flight_results:
+			if name not in phase_order:
+				phase_order.append(name)
+
+	regressions = 0
+	width = max([len(file_name) for file_name in file_names])
+	for name in phase_order:
+		print "%s" % name
+		print "  %-*s %6s %s" % (width, "flight", "n", " ".join(["%18s" % metric for metric, worse_if_bigger in METRICS]))
+
+		baseline = None
+		for file_name, flight_results in zip(file_names, results):
+			if name not in flight_results:
+				print "  %-*s %6s" % (width, file_name, "-")
+				continue
+
+			count, metrics = flight_results[name]
+			columns = []
+			for index, (metric, worse_if_bigger) in enumerate(METRICS):
+				if baseline is None or baseline[index] == 0 or numpy.isnan(baseline[index]):
+					columns.append("%18.4f" % metrics[index])
+					continue
+
+				change = (metrics[index] - baseline[index]) * 100 / abs(baseline[index])
+				regressed = change > threshold if worse_if_bigger else change < -threshold
+				if regressed:
+					regressions += 1
+				columns.append("%10.4f %+6.1f%%%s" % (metrics[index], change, "*" if regressed else " "))
+
+			print "  %-*s %6d %s" % (width, file_name, count, " ".join(columns))
+
+			if baseline is None:
+				baseline = metrics
+		print
+
+	print "%d regressions beyond %.1f%% against %s" % (regressions, threshold, file_names[0])
+	return regressions
+
+####################################################################################################
+#
+# qccompare.py [-s skip] [-t threshold] baseline log...
+#
+####################################################################################################
+def Usage():
+	print 'qccompare.py [-s skip] [-t threshold] baseline log...'
+	print '  -s ??  seconds to ignore at the start of each phase (default 0.5)'
+	print '  -t ??  percentage change counted as a regression (default 10)'
+	sys.exit(2)
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 's:t:')
+	except getopt.GetoptError:
+		Usage()
+
+	if len(args) < 2:
+		Usage()
+
+	skip = 0.5
+	threshold = 10.0
+	for opt, arg in opts:
+		if opt == '-s':
+			skip = float(arg)
+		elif opt == '-t':
+			threshold = float(arg)
+
+	results = [PhaseMetrics(qcanalyse.LoadFlight(file_name), skip) for file_name in args]
+	sys.exit(1 if Report(args, results, threshold) > 0 else 0)
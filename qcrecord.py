@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Hove's Raspberry Pi Python Quadcopter Flight Controller.  Open Source @ GitHub            ##
+## PiStuffing/Quadcopter under GPL for non-commercial application.  Any code derived from    ##
+## this should retain this copyright comment.                                                ##
+##                                                                                           ##
+## Copyright 2014 Andy Baker (Hove) - andy@pistuffing.co.uk                                  ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+####################################################################################################
+#
+# Offline converter for the binary flight recorder files (qcrecord<date>.bin) written by Quadcopter.py
+# with --fr.  The file describes itself, so this doesn't need Quadcopter.py or the Pi libraries:
+#
+#     record count        uint32
+#     magic 'QCFR'        4 bytes
+#     ring slots          uint32
+#     schema length       uint32
+#     schema              "name:code,name:code,..." using struct codes
+#     records             ring of fixed size records, oldest overwritten first once full
+#
+####################################################################################################
+
+from __future__ import division
+import struct
+import sys
+import getopt
+
+_HEADER = struct.Struct('=I')
+_PREAMBLE = struct.Struct('=4sII')
+_MAGIC = 'QCFR'
+
+#---------------------------------------------------------------------------------------------------
+# Struct codes to NumPy dtypes for the codes the flight recorder uses
+#---------------------------------------------------------------------------------------------------
+_NUMPY_TYPES = {'d': 'f8', 'f': 'f4', 'i': 'i4', 'I': 'u4', 'h': 'i2', 'H': 'u2', 'b': 'i1', 'B': 'u1'}
+
+####################################################################################################
+#
+# Read the header and schema, returning the field names, struct codes, the raw record bytes in
+# oldest-first order and the number of records.
+#
+####################################################################################################
+def ReadRecorder(file_name):
+	with open(file_name, 'rb') as record_file:
+		data = record_file.read()
+
+	count = _HEADER.unpack_from(data, 0)[0]
+	magic, slots, schema_length = _PREAMBLE.unpack_from(data, _HEADER.size)
+	if magic != _MAGIC:
+		raise ValueError("%s is not a flight recorder file" % file_name)
+
+	offset = _HEADER.size + _PREAMBLE.size
+	schema = data[offset:offset + schema_length]
+	offset += schema_length
+
+	names = []
+	codes = []
+	for field in schema.split(','):
+		name, code = field.rsplit(':', 1)
+		names.append(name)
+		codes.append(code)
+
+	record_size = struct.calcsize('=' + ''.join(codes))
+
+	#-------------------------------------------------------------------------------------------
+	# Once the ring has wrapped, the oldest record is in the slot the next write would have used.
+	#-------------------------------------------------------------------------------------------
+	if count <= slots:
+		records = data[offset:offset + count * record_size]
+	else:
+		split = offset + (count % slots) * record_size
+		end = offset + slots * record_size
+		records = data[split:end] + data[offset:split]
+		count = slots
+
+	return names, codes, records, count
+
+####################################################################################################
+#
+# Unpack every record as a tuple
+#
+####################################################################################################
+def LoadRecords(file_name):
+	names, codes, records, count = ReadRecorder(file_name)
+	record = struct.Struct('=' + ''.join(codes))
+	return names, [record.unpack_from(records, index * record.size) for index in range(0, count)]
+
+####################################################################################################
+#
+# Load as a NumPy structured array without unpacking record by record
+#
+####################################################################################################
+def LoadNumpy(file_name):
+	import numpy
+
+	names, codes, records, count = ReadRecorder(file_name)
+	dtype = numpy.dtype([(name, '=' + _NUMPY_TYPES[code]) for name, code in zip(names, codes)])
+	return numpy.frombuffer(records, dtype=dtype, count=count)
+
+####################################################################################################
+#
+# Write CSV in the same column layout as the text diagnostics
+#
+####################################################################################################
+def WriteCSV(file_name, csv_name):
+	names, codes, records, count = ReadRecorder(file_name)
+	record = struct.Struct('=' + ''.join(codes))
+	line_format = ', '.join([('%f' if code in 'fd' else '%d') for code in codes]) + '\n'
+
+	with open(csv_name, 'w') as csv_file:
+		csv_file.write(', '.join(names) + '\n')
+		for index in range(0, count):
+			csv_file.write(line_format % record.unpack_from(records, index * record.size))
+
+	return count
+
+####################################################################################################
+#
+# qcrecord.py [-c csv file] [-n npy file] qcrecord<date>.bin
+#
+####################################################################################################
+def Usage():
+	print 'qcrecord.py [-c csv file] [-n npy file] qcrecord<date>.bin'
+	print '  -c ??  write the records as CSV'
+	print '  -n ??  write the records as a NumPy structured array (.npy)'
+	sys.exit(2)
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'c:n:')
+	except getopt.GetoptError:
+		Usage()
+
+	if len(args) != 1:
+		Usage()
+
+	csv_name = None
+	npy_name = None
+	for opt, arg in opts:
+		if opt == '-c':
+			csv_name = arg
+		elif opt == '-n':
+			npy_name = arg
+
+	if csv_name is None and npy_name is None:
+		csv_name = args[0].rsplit('.', 1)[0] + '.csv'
+
+	if csv_name is not None:
+		print '%d records written to %s' % (WriteCSV(args[0], csv_name), csv_name)
+
+	if npy_name is not None:
+		import numpy
+		records = LoadNumpy(args[0])
+		numpy.save(npy_name, records)
+		print '%d records written to %s' % (len(records), npy_name)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Hove's Raspberry Pi Python Quadcopter Flight Controller.  Open Source @ GitHub            ##
+## PiStuffing/Quadcopter under GPL for non-commercial application.  Any code derived from    ##
+## this should retain this copyright comment.                                                ##
+##                                                                                           ##
+## Copyright 2014 Andy Baker (Hove) - andy@pistuffing.co.uk                                  ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+####################################################################################################
+#
+# Offline vibration spectra of the raw sensor samples recorded by Quadcopter.py --raw in
+# qcraw<date>.bin.  Each axis is cut into overlapping Hann windowed frames, all transformed in one
+# vectorised rfft, giving a spectrogram per axis.  The report lists the strongest peaks in the mean
+# spectrum of each axis, and how the biggest peak moved through the flight; the spectrograms can be
+# saved as .npz for plotting.  Amplitudes are in raw sensor units (LSB), as in the in-flight
+# vibration monitor.
+#
+####################################################################################################
+
+from __future__ import division
+import sys
+import getopt
+import numpy
+
+import qcrecord
+
+AXES = ["qax", "qay", "qaz", "qgx", "qgy", "qgz"]
+
+####################################################################################################
+#
+# Sample rate from the median interval between sample times, so the odd late sample doesn't skew it
+#
+####################################################################################################
+def SampleRate(times):
+	return 1 / numpy.median(numpy.diff(times))
+
+####################################################################################################
+#
+# Spectrogram of one axis as (frame start times, frequencies, amplitudes[frame, frequency]).  The
+# frames are strided views of the samples, so only the windowed copy and the FFT output are
+# allocated.  Each frame's mean is removed first to keep gravity and gyro offsets out of the low bins.
+#
+####################################################################################################
+def Spectrogram(times, samples, sample_rate, window, step):
+	frames = 1 + (len(samples) - window) // step
+	if frames < 1:
+		raise ValueError("%d samples is less than one %d sample window" % (len(samples), window))
+
+	samples = numpy.ascontiguousarray(samples, dtype=numpy.float64)
+	stride = samples.strides[0]
+	framed = numpy.lib.stride_tricks.as_strided(samples, shape=(frames, window), strides=(step * stride, stride))
+
+	hann = numpy.hanning(window)
+	windowed = (framed - framed.mean(axis=1)[:, numpy.newaxis]) * hann
+
+	#-------------------------------------------------------------------------------------------
+	# Scale so a sine of amplitude A shows as A, correcting for the window's coherent gain
+	#-------------------------------------------------------------------------------------------
+	amplitudes = numpy.abs(numpy.fft.rfft(windowed, axis=1)) * 2 / hann.sum()
+	frequencies = numpy.fft.rfftfreq(window, 1 / sample_rate)
+	starts = times[numpy.arange(frames) * step]
+
+	return starts, frequencies, amplitudes
+
+####################################################################################################
+#
+# The biggest local maxima in a spectrum, ignoring the DC bin, as (frequency, amplitude) pairs
+#
+####################################################################################################
+def Peaks(frequencies, spectrum, count):
+	inner = spectrum[1:-1]
+	maxima = numpy.nonzero((inner > spectrum[:-2]) & (inner >= spectrum[2:]))[0] + 1
+	biggest = maxima[numpy.argsort(spectrum[maxima])[::-1][:count]]
+	return [(frequencies[index], spectrum[index]) for index in biggest]
+
+####################################################################################################
+#
+# Print the peaks of each axis' mean spectrum and the track of its biggest peak over time
+#
+####################################################################################################
+def Report(file_name, axes, window, step, count, track, npz_name):
+	records = qcrecord.LoadNumpy(file_name)
+	times = records["time"]
+	sample_rate = SampleRate(times)
+	print "%s: %d samples over %fs at %fHz, %fHz resolution" % (file_name, len(records), times[-1] - times[0], sample_rate, sample_rate / window)
+
+	saved = {}
+	for axis in axes:
+		starts, frequencies, amplitudes = Spectrogram(times, records[axis], sample_rate, window, step)
+		saved[axis] = amplitudes
+
+		mean_spectrum = amplitudes.mean(axis=0)
+		print "  %s: %s" % (axis, ", ".join(["%.1fHz %.2f" % (frequency, amplitude) for frequency, amplitude in Peaks(frequencies, mean_spectrum, count)]))
+
+		if track:
+			peak_bins = amplitudes[:, 1:].argmax(axis=1) + 1
+			for frame, peak_bin in enumerate(peak_bins):
+				print "    %8.3fs %7.1fHz %.2f" % (starts[frame] - times[0], frequencies[peak_bin], amplitudes[frame, peak_bin])
+
+	if npz_name is not None:
+		saved["time"] = starts
+		saved["frequency"] = frequencies
+		numpy.savez(npz_name, **saved)
+		print "spectrograms written to %s" % npz_name
+
+####################################################################################################
+#
+# qcspectrum.py [-a axes] [-w window] [-s step] [-n peaks] [-t] [-o npz file] qcraw<date>.bin
+#
+####################################################################################################
+def Usage():
+	print 'qcspectrum.py [-a axes] [-w window] [-s step] [-n peaks] [-t] [-o npz file] qcraw<date>.bin'
+	print '  -a ??  comma separated axes (default qax,qay,qaz,qgx,qgy,qgz)'
+	print '  -w ??  samples per FFT window (default 256)'
+	print '  -s ??  samples between windows (default half a window)'
+	print '  -n ??  peaks listed per axis (default 5)'
+	print '  -t     track the biggest peak of each window through the flight'
+	print '  -o ??  save the spectrograms as a NumPy .npz'
+	sys.exit(2)
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'a:w:s:n:to:')
+	except getopt.GetoptError:
+		Usage()
+
+	if len(args) != 1:
+		Usage()
+
+	axes = AXES
+	window = 256
+	step = None
+	count = 5
+	track = False
+	npz_name = None
+	for opt, arg in opts:
+		if opt == '-a':
+			axes = arg.split(',')
+		elif opt == '-w':
+			window = int(arg)
+		elif opt == '-s':
+			step = int(arg)
+		elif opt == '-n':
+			count = int(arg)
+		elif opt == '-t':
+			track = True
+		elif opt == '-o':
+			npz_name = arg
+
+	for axis in axes:
+		if axis not in AXES:
+			Usage()
+
+	if step is None:
+		step = max(1, window // 2)
+
+	Report(args[0], axes, window, step, count, track, npz_name)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Hove's Raspberry Pi Python Quadcopter Flight Controller.  Open Source @ GitHub            ##
+## PiStuffing/Quadcopter under GPL for non-commercial application.  Any code derived from    ##
+## this should retain this copyright comment.                                                ##
+##                                                                                           ##
+## Copyright 2014 Andy Baker (Hove) - andy@pistuffing.co.uk                                  ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+####################################################################################################
+#
+# Receiver for the live telemetry streamed by Quadcopter.py --udp host:port.  Run it first, e.g.
+#
+#     qctelemetry.py -p 5005
+#     qc.py -f --udp 127.0.0.1:5005
+#
+# The packet layout must match TelemetryPublisher in Quadcopter.py.  The pulse widths are shown as
+# M1, M2... in the order of the flight's frame layout, e.g. FL FR BL BR for a quad.
+#
+####################################################################################################
+
+from __future__ import division
+import socket
+import struct
+import sys
+import getopt
+
+MAGIC = 'QCT2'
+HEADER = struct.Struct('=4sIdffffffhhhffIfBB')
+FIELDS = ["sequence", "time", "pa", "ra", "ya", "qvx", "qvy", "qvz", "pr_out", "rr_out", "yr_out", "qvz_out", "temp", "loop", "dt", "degraded", "motors"]
+MAX_MOTORS = 8
+
+####################################################################################################
+#
+# Decode one packet to a dict of field values, with the pulse widths as a tuple under
+# "pulse_widths", or None if it isn't telemetry
+#
+####################################################################################################
+def Decode(packet):
+	if len(packet) < HEADER.size:
+		return None
+
+	values = HEADER.unpack_from(packet)
+	if values[0] != MAGIC:
+		return None
+
+	telemetry = dict(zip(FIELDS, values[1:]))
+	if len(packet) != HEADER.size + 2 * telemetry["motors"]:
+		return None
+
+	telemetry["pulse_widths"] = struct.unpack_from('=' + 'H' * telemetry["motors"], packet, HEADER.size)
+	return telemetry
+
+####################################################################################################
+#
+# Print each packet, with the sensor loop rate since the previous one and a count of packets lost
+#
+####################################################################################################
+def Receive(port, count):
+	receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	receiver.bind(('', port))
+
+	previous = None
+	lost = 0
+	received = 0
+	while count == 0 or received < count:
+		packet, sender = receiver.recvfrom(HEADER.size + 2 * MAX_MOTORS + 1)
+		telemetry = Decode(packet)
+		if telemetry is None:
+			continue
+		received += 1
+
+		if received == 1:
+			print '%8s %8s %7s %7s %7s %6s %6s %6s %5s %5s %5s %6s %7s %5s' % ("time", "rate", "pitch", "roll", "yaw", "qvx", "qvy", "qvz", "pr", "rr", "yr", "temp", "lost", "level") + ''.join([' %5s' % ("M%d" % (motor + 1)) for motor in range(telemetry["motors"])])
+
+		rate = 0.0
+		if previous is not None:
+			lost += telemetry["sequence"] - previous["sequence"] - 1
+			if telemetry["time"] > previous["time"]:
+				rate = (telemetry["loop"] - previous["loop"]) / (telemetry["time"] - previous["time"])
+		previous = telemetry
+
+		print '%8.3f %8.1f %7.2f %7.2f %7.2f %6.2f %6.2f %6.2f %5d %5d %5d %6.2f %7d %5d' % (telemetry["time"], rate, telemetry["pa"], telemetry["ra"], telemetry["ya"], telemetry["qvx"], telemetry["qvy"], telemetry["qvz"], telemetry["pr_out"], telemetry["rr_out"], telemetry["yr_out"], telemetry["temp"], lost, telemetry["degraded"]) + ''.join([' %5d' % pulse_width for pulse_width in telemetry["pulse_widths"]])
+
+	receiver.close()
+
+####################################################################################################
+#
+# qctelemetry.py [-p port] [-n count]
+#
+####################################################################################################
+def Usage():
+	print 'qctelemetry.py [-p port] [-n count]'
+	print '  -p ??  UDP port to listen on (default 5005)'
+	print '  -n ??  stop after this many packets (default never)'
+	sys.exit(2)
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'p:n:')
+	except getopt.GetoptError:
+		Usage()
+
+	port = 5005
+	count = 0
+	for opt, arg in opts:
+		if opt == '-p':
+			port = int(arg)
+		elif opt == '-n':
+			count = int(arg)
+
+	try:
+		Receive(port, count)
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Hove's Raspberry Pi Python Quadcopter Flight Controller.  Open Source @ GitHub            ##
+## PiStuffing/Quadcopter under GPL for non-commercial application.  Any code derived from    ##
+## this should retain this copyright comment.                                                ##
+##                                                                                           ##
+## Copyright 2014 Andy Baker (Hove) - andy@pistuffing.co.uk                                  ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+####################################################################################################
+#
+# Live editor for the tunables of a flight started with Quadcopter.py --tune.  With no arguments it
+# lists them with their limits; otherwise each name=value is checked against its limits, and all are
+# written together as one new version, e.g.
+#
+#     qctune.py prp=95 pri=5 tau=0.4
+#
+# The flight picks the new version up at its next motion period; qctune.py waits to see it applied
+# or rejected.  The shared memory layout must match TuningConfig in Quadcopter.py.
+#
+####################################################################################################
+
+from __future__ import division
+import sys
+import os
+import mmap
+import fcntl
+import struct
+import time
+import getopt
+
+_HEADER = struct.Struct('=III')
+_WORD = struct.Struct('=I')
+_PREAMBLE = struct.Struct('=4sI')
+_MAGIC = 'QCTU'
+
+####################################################################################################
+#
+# The shared memory block of a running flight, with its schema as field names and (min, max) limits
+#
+####################################################################################################
+class Tuning:
+
+	def __init__(self, file_name):
+		self.fd = os.open(file_name, os.O_RDWR)
+		self.shm = mmap.mmap(self.fd, os.fstat(self.fd).st_size)
+
+		magic, schema_length = _PREAMBLE.unpack_from(self.shm, _HEADER.size)
+		if magic != _MAGIC:
+			raise ValueError("%s is not a tuning block" % file_name)
+
+		offset = _HEADER.size + _PREAMBLE.size
+		self.names = []
+		self.limits = []
+		for field in self.shm[offset:offset + schema_length].split(','):
+			name, minimum, maximum = field.split(':')
+			self.names.append(name)
+			self.limits.append((float(minimum), float(maximum)))
+
+		self.values = struct.Struct('=' + 'd' * len(self.names))
+		self.base = offset + schema_length
+
+	def read(self):
+		return dict(zip(self.names, self.values.unpack_from(self.shm, self.base)))
+
+	def write(self, changes):
+		#-----------------------------------------------------------------------------------
+		# Editors take turns with a file lock; the flight never takes it, and relies on the odd
+		# version alone to ignore a half-written set.
+		#-----------------------------------------------------------------------------------
+		fcntl.flock(self.fd, fcntl.LOCK_EX)
+		try:
+			values = self.read()
+			values.update(changes)
+
+			version = _WORD.unpack_from(self.shm, 0)[0]
+			_WORD.pack_into(self.shm, 0, version + 1)
+			self.values.pack_into(self.shm, self.base, *[values[name] for name in self.names])
+			_WORD.pack_into(self.shm, 0, version + 2)
+		finally:
+			fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+		return version + 2
+
+	def result(self, version, timeout):
+		#-----------------------------------------------------------------------------------
+		# True once applied, False if rejected, or None if the flight didn't answer in time
+		#-----------------------------------------------------------------------------------
+		deadline = time.time() + timeout
+		while time.time() < deadline:
+			latest, applied, rejected = _HEADER.unpack_from(self.shm, 0)
+			if applied == version:
+				return True
+			if rejected == version:
+				return False
+			if latest != version:
+				return None
+			time.sleep(0.01)
+		return None
+
+	def close(self):
+		self.shm.close()
+		os.close(self.fd)
+
+####################################################################################################
+#
+# Parse name=value arguments, checking each against the flight's limits
+#
+####################################################################################################
+def ParseChanges(tuning, args):
+	limits = dict(zip(tuning.names, tuning.limits))
+	changes = {}
+	for arg in args:
+		if '=' not in arg:
+			raise ValueError("%s is not name=value" % arg)
+		name, value = arg.split('=', 1)
+		if name not in limits:
+			raise ValueError("unknown tunable %s" % name)
+		value = float(value)
+		minimum, maximum = limits[name]
+		if not minimum <= value <= maximum:
+			raise ValueError("%s must lie in [%r, %r]" % (name, minimum, maximum))
+		changes[name] = value
+	return changes
+
+####################################################################################################
+#
+# qctune.py [-n name] [-w timeout] [name=value...]
+#
+####################################################################################################
+def Usage():
+	print 'qctune.py [-n name] [-w timeout] [name=value...]'
+	print '  -n ??  shared memory name under /dev/shm (default qctuning)'
+	print '  -w ??  seconds to wait for the flight to apply the change (default 1.0)'
+	print '  with no name=value, list the tunables and their limits'
+	sys.exit(2)
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'n:w:')
+	except getopt.GetoptError:
+		Usage()
+
+	name = "qctuning"
+	timeout = 1.0
+	for opt, arg in opts:
+		if opt == '-n':
+			name = arg
+		elif opt == '-w':
+			timeout = float(arg)
+
+	try:
+		tuning = Tuning("/dev/shm/" + name)
+	except (OSError, ValueError), err:
+		print "no tuning block: %s - was the flight started with --tune?" % err
+		sys.exit(1)
+
+	if len(args) == 0:
+		values = tuning.read()
+		for name, (minimum, maximum) in zip(tuning.names, tuning.limits):
+			print "%-16s %12r  [%r, %r]" % (name, values[name], minimum, maximum)
+		tuning.close()
+		sys.exit(0)
+
+	try:
+		changes = ParseChanges(tuning, args)
+	except ValueError, err:
+		print "rejected: %s" % err
+		tuning.close()
+		sys.exit(1)
+
+	version = tuning.write(changes)
+	result = tuning.result(version, timeout)
+	tuning.close()
+
+	if result is None:
+		print "version %d written, not yet applied" % version
+		sys.exit(1)
+	elif not result:
+		print "version %d rejected by the flight - see its log" % version
+		sys.exit(1)
+	print "version %d applied" % version